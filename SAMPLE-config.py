@@ -13,8 +13,85 @@ chromedriver_path = 'REPLACE'
 # webscraper_proxy = '127.0.0.1:8080'
 # webscraper_proxy = 'socks5://127.0.0.1:8080'
 webscraper_proxy = None
+# Time zone of the timestamps written to the database: result timestamps and last_run of search jobs
+time_zone = 'Europe/Berlin'
+# Number of browsers kept alive per process and page loads before a browser is replaced
+webscraper_pool_size = 1
+webscraper_recycle_after = 500
+# 'selenium' loads every page in the browser, 'http' fetches pages over a keep-alive
+# session with the browser cookies and falls back to the browser on bot challenges
+webscraper_backend = 'selenium'
+# Offers fetched in parallel (needs webscraper_pool_size >= scrape_concurrency, one more
+# while crawling keeps the search pages on a browser of their own)
+scrape_concurrency = 1
+# Requests per second per host and proxy adapt to the responses (AIMD): healthy pages
+# raise the rate by scrape_rate_increase per second up to scrape_rate_max, errors and
+# empty pages multiply it by scrape_rate_decrease, captcha and consent walls also pause
+# all requests for scrape_block_cooldown seconds, doubled per block in a row.
+# Without scrape_adaptive_rate the rate is fixed to scrape_rate_per_host (None = unlimited),
+# otherwise scrape_rate_per_host caps the rate if set. scrape_burst is the burst size.
+# The rates are per process, with restweb-runner_multi a host gets up to runner_pool_size times them.
+scrape_adaptive_rate = True
+scrape_rate_per_host = None
+scrape_burst = 1
+scrape_rate_start = 1.0
+scrape_rate_min = 0.1
+scrape_rate_max = 10.0
+scrape_rate_increase = 0.1
+scrape_rate_decrease = 0.5
+scrape_block_cooldown = 60
+scrape_block_max_cooldown = 900
+# Search pages buffered between crawling and scraping their offers
+pipeline_queue_size = 2
+# Seconds to wait for elements of the search form, JSON file caching resolved search URLs
+search_wait_timeout = 10
+search_url_cache_file = 'search_url_cache.json'
 
 #MySQL-Databse
 mysql_host = 'REPLACE'
 mysql_user = 'REPLACE'
-mysql_password = 'REPLACE'
\ No newline at end of file
+mysql_password = 'REPLACE'
+# Pooled connections per process and database
+mysql_pool_size = 4
+# Rows per multi-row INSERT when writing results
+mysql_batch_size = 500
+# GeoNames postal code file for Germany (DE.txt) for offline geocoding,
+# None uses the pgeocode cache and downloads it once if missing
+geocode_data_file = None
+# Job scheduling of restweb-runner: seconds between runs of a job, per job overrides {job_id: seconds},
+# random deviation of the interval, search areas crawled in parallel (at most webscraper_pool_size,
+# each takes up to 1 + scrape_concurrency free browsers) and seconds between job syncs
+search_job_interval = 300
+search_job_intervals = {}
+search_job_jitter = 0.1
+search_job_workers = 1
+search_job_sync_interval = 10
+# Worker processes of restweb-runner_multi, each with its own browser and database connections,
+# seconds a job may run before its worker is replaced and seconds before a worker that failed
+# to start is started again, doubled per failed start in a row up to the maximum
+runner_pool_size = 4
+runner_task_timeout = 3600
+runner_restart_backoff = 1
+runner_restart_max_backoff = 300
+# Folder of the raw page cache (None disables it), seconds cached offer pages are served
+# and kept, and the maximum size of the cache in bytes
+page_cache_folder = None
+page_cache_ttl = 86400
+page_cache_max_bytes = 2147483648
+# Port of the local metrics endpoint (/metrics, /metrics.json) of the runners, None disables it,
+# and file for structured JSON logs of pipeline stages, None disables them
+metrics_port = None
+metrics_log_file = None
+# Write-ahead journal of rows written to the database, replayed after a crash.
+# Defaults to tmp_folder, should be on a local disk.
+journal_folder = './tmp'
+journal_fsync_every = 8
+journal_fsync_interval = 1.0
+# Retries of offers that failed to scrape: failure classes retried, seconds before the
+# first retry (doubled per attempt up to the maximum), attempts before giving up and
+# due retries scraped along with every crawl
+error_retry_classes = ('timeout', 'network', 'browser', 'blocked')
+error_retry_base = 600
+error_retry_max_delay = 86400
+error_retry_max_attempts = 5
+error_retry_batch = 20
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks for the scraping pipeline on saved pages.
+
+Usage:
+    python benchmark.py parse <dir with saved offer pages (*.html)> [--repeat N]
+    python benchmark.py keywords [--corpus <file with one description per line>] [--size N] [--jobs N]
+    python benchmark.py record <corpus dir> --postalcode P [--radius R]
+    python benchmark.py replay <corpus dir> [--database DB] [--max-number N]
+    python benchmark.py memory <dir with saved offer pages (*.html)> [--offers N]
+    python benchmark.py --output results.json <command> ...
+
+A replay corpus is a folder of recorded search and offer pages with a manifest.json,
+recorded from the page cache. `replay` serves it from a local HTTP stand-in and runs
+SearchPage, OfferPage and offers_to_mysql against it end to end.
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import time
+import random
+import tempfile
+import threading
+import multiprocessing
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import misc
+import pandas as pd
+import dateutil.parser as dparser
+from offer_parser import parse_offer
+from job_matcher import JobMatcher
+
+
+def legacy_parse_offer(content_raw):
+    """The line based offer parser used before offer_parser.parse_offer, kept for comparison."""
+    from bs4 import BeautifulSoup
+    content = content_raw.split('\n')
+    result = {}
+    result['title'] = misc.get_lines(content, '<title>')[0][0].split(sep='>')[1].split(sep='<')[0].split('|')[0]
+    parsed_html = BeautifulSoup(content_raw, "html.parser")
+    data = parsed_html.find('meta', attrs={'itemprop': 'description'})
+    description_raw = data['content'] if data else None
+    if not description_raw:
+        data = parsed_html.find('p', class_='text-force-linebreak', id='viewad-description-text')
+        description_raw = data.get_text(strip=True)
+    result['description'] = BeautifulSoup(description_raw.replace('&lt;', '<').replace('&gt;', '>'),
+                                          'html.parser').get_text(separator=' ', strip=True)
+    result['date'] = dparser.parse(misc.get_lines(content, 'icon icon-small icon-calendar-gray-simple')[0][0], fuzzy=True, dayfirst=True)
+    num1 = misc.get_numbers(misc.get_lines(content, 'adPrice:')[0][0])[0]
+    num2 = misc.get_numbers(misc.get_lines(content, 'adPrice:')[0][0])[1]
+    result['price'] = float(int(num1) + (int(num2) / 100))
+    adress_line = content[misc.get_lines(content, 'initMap')[1][0] + 1]
+    result['postalcode'] = int(re.findall(r"\D(\d{5})\D", " " + adress_line + " ")[0])
+    details = [x.split(sep='<')[0].split()[0] for x in misc.get_lines(content, '<span class="addetailslist--detail--value">')[0]]
+    value_lines = [x + 1 for x in misc.get_lines(content, '<span class="addetailslist--detail--value">')[1]]
+    values = [' '.join(content[x].split(sep='<')[0].split()) for x in value_lines]
+    result['details'] = dict(zip(details, values))
+    return result
+
+
+def load_pages(folder):
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(folder, '*.html'))):
+        with open(filename, encoding='utf-8') as f:
+            pages.append((os.path.basename(filename), f.read()))
+    return pages
+
+
+def time_per_call(function, items, repeat):
+    """Return the mean time per call in µs and the number of failed calls."""
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            try:
+                function(item)
+            except Exception:
+                failures += 1
+    elapsed = time.perf_counter() - start
+    return elapsed / (repeat * len(items)) * 1e6, failures // repeat
+
+
+def bench_parse(args):
+    pages = load_pages(args.folder)
+    if not pages:
+        raise SystemExit(f'No *.html pages found in {args.folder}')
+    contents = [x[1] for x in pages]
+
+    # Both parsers have to agree on every field the legacy parser extracts
+    mismatches = []
+    for name, content in pages:
+        try:
+            legacy = legacy_parse_offer(content)
+        except Exception:
+            continue
+        parsed = parse_offer(content)
+        fields = [k for k in legacy if legacy[k] != parsed[k]]
+        if fields:
+            mismatches.append((name, fields))
+
+    results = {'pages': len(pages), 'mismatches': len(mismatches)}
+    for label, function in (('legacy', legacy_parse_offer), ('single_pass', parse_offer)):
+        us, failures = time_per_call(function, contents, args.repeat)
+        results[label] = {'us_per_offer': round(us, 1), 'failures': failures}
+    results['speedup'] = round(results['legacy']['us_per_offer'] / results['single_pass']['us_per_offer'], 1)
+
+    for name, fields in mismatches:
+        print(f'[BENCHMARK][PARSE][MISMATCH] {name}: {", ".join(fields)}')
+    return results
+
+
+KEYWORD_VOCABULARY = [
+    'balkon', 'terrasse', 'garten', 'einbauküche', 'aufzug', 'tiefgarage', 'stellplatz', 'altbau',
+    'neubau', 'wg', 'möbliert', 'zwischenmiete', 'tausch', 'provision', 'keller', 'dachgeschoss',
+    'erdgeschoss', 'fußbodenheizung', 'badewanne', 'haustiere', 'ruhig', 'zentral', 'hell', 'saniert',
+]
+
+def legacy_keyword_filter(df, filter_include, filter_exclude):
+    """The str.contains based keyword filter used before keyword_filter, kept for comparison."""
+    include_mask = df['title'].str.contains('|'.join(filter_include), case=False, na=False) | \
+                   df['description'].str.contains('|'.join(filter_include), case=False, na=False)
+    df = df[include_mask]
+    exclude_mask = ~(df['title'].str.contains('|'.join(filter_exclude), case=False, na=False) | \
+                     df['description'].str.contains('|'.join(filter_exclude), case=False, na=False))
+    return df[exclude_mask]
+
+def bench_keywords(args):
+    rng = random.Random(0)
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            descriptions = [x.strip() for x in f if x.strip()]
+    else:
+        filler = ['wohnung', 'zimmer', 'miete', 'lage', 'nähe', 'bus', 'bahn', 'schule', 'der', 'die', 'und', 'mit']
+        descriptions = [' '.join(rng.choice(filler + KEYWORD_VOCABULARY) for _ in range(120)) for _ in range(args.size)]
+    df = pd.DataFrame({'title': [' '.join(rng.sample(KEYWORD_VOCABULARY, 3)) for _ in descriptions],
+                       'description': descriptions})
+    jobs = [(rng.sample(KEYWORD_VOCABULARY, 3), rng.sample(KEYWORD_VOCABULARY, 2)) for _ in range(args.jobs)]
+    # search_jobs rows without range filters and without a last run, so only the keywords decide
+    entries = [(job_id, 0, '', 0) + (None,) * 6 + (','.join(include), ','.join(exclude), 1, None)
+               for job_id, (include, exclude) in enumerate(jobs)]
+    offers = df.assign(price=0.0, rooms=0.0, size=0, timestamp=pd.Timestamp.now(), id_index=range(len(df)))
+
+    start = time.perf_counter()
+    legacy_counts = [len(legacy_keyword_filter(df, include, exclude)) for include, exclude in jobs]
+    legacy_seconds = time.perf_counter() - start
+
+    # JobMatcher.match as the runner calls it, compiling the jobs included
+    start = time.perf_counter()
+    matched = JobMatcher().match(offers, entries)
+    seconds = time.perf_counter() - start
+    counts = [0] * len(jobs)
+    for job_id, _ in matched:
+        counts[job_id] += 1
+
+    return {
+        'offers': len(df),
+        'jobs': len(jobs),
+        'legacy': {'seconds': round(legacy_seconds, 3), 'us_per_offer_and_job': round(legacy_seconds / len(df) / len(jobs) * 1e6, 2)},
+        'job_matcher': {'seconds': round(seconds, 3), 'us_per_offer_and_job': round(seconds / len(df) / len(jobs) * 1e6, 2)},
+        'speedup': round(legacy_seconds / seconds, 1),
+        'differing_jobs': sum(a != b for a, b in zip(legacy_counts, counts)),
+    }
+
+
+def url_path(url):
+    parts = urlsplit(url)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+def bench_record(args):
+    """Export the cached pages of one search and all cached offer pages into a replay corpus."""
+    from kleinanzeigen import Kleinanzeigen
+    from page_cache import page_cache
+    from search_url_cache import search_url_cache
+    cache = page_cache()
+    template = search_url_cache().get(Kleinanzeigen.SEARCH_TEMPLATE_URL, args.postalcode)
+    if cache is None or template is None:
+        raise SystemExit('Recording needs a page cache and a cached search URL for the postal code')
+
+    os.makedirs(args.folder, exist_ok=True)
+    search_prefix = template.split('{page}')[0]
+    offer_prefix = Kleinanzeigen.OFFER_TEMPLATE_URL.split('{')[0]
+    pages = {}
+    for url, _, content in cache.items():
+        if not (url.startswith(search_prefix) or url.startswith(offer_prefix)):
+            continue
+        filename = f'page-{len(pages):05d}.html'
+        with open(os.path.join(args.folder, filename), 'w', encoding='utf-8') as f:
+            f.write(content)
+        pages[url_path(url)] = filename
+    manifest = {
+        'category': url_path(Kleinanzeigen.SEARCH_TEMPLATE_URL),
+        'offer_template': url_path(Kleinanzeigen.OFFER_TEMPLATE_URL),
+        'search_template': url_path(template),
+        'postalcode': args.postalcode,
+        'radius': args.radius,
+        'pages': pages,
+    }
+    with open(os.path.join(args.folder, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    return {'pages': len(pages)}
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Local HTTP stand-in serving a replay corpus.
+
+    Like the live site, search pages beyond the last recorded one redirect to it.
+    """
+    daemon_threads = True
+
+    def __init__(self, folder, manifest):
+        self.folder = folder
+        self.pages = manifest['pages']
+        search_prefix = manifest['search_template'].split('{page}')[0]
+        self.search_pages = sorted(x for x in self.pages if x.startswith(search_prefix))
+        self.search_prefix = search_prefix
+        self.hits = {'search': 0, 'offer': 0, 'missing': 0}
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), ReplayHandler)
+
+    def count(self, kind):
+        with self.lock:
+            self.hits[kind] += 1
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        filename = server.pages.get(self.path)
+        if filename is None and self.path.startswith(server.search_prefix) and server.search_pages:
+            self.send_response(302)
+            self.send_header('Location', server.search_pages[-1])
+            self.end_headers()
+            return
+        if filename is None:
+            server.count('missing')
+            self.send_error(404)
+            return
+        server.count('search' if self.path.startswith(server.search_prefix) else 'offer')
+        with open(os.path.join(server.folder, filename), 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_replay(args):
+    import search_url_cache
+    from kleinanzeigen import Kleinanzeigen
+    from webscraper import HTTPFetcher
+    from geocode import postal_code_table
+
+    with open(os.path.join(args.folder, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    server = ReplayServer(args.folder, manifest)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+
+    # Point the scraper at the stand-in with the search URL already resolved, the plain HTTPFetcher is not rate limited
+    Kleinanzeigen.SEARCH_TEMPLATE_URL = base + manifest['category']
+    Kleinanzeigen.OFFER_TEMPLATE_URL = base + manifest['offer_template']
+    tmp_dir = tempfile.mkdtemp()
+    search_url_cache._search_url_cache = search_url_cache.SearchUrlCache(os.path.join(tmp_dir, 'search_url_cache.json'))
+    search_url_cache._search_url_cache.set(Kleinanzeigen.SEARCH_TEMPLATE_URL, manifest['postalcode'], base + manifest['search_template'])
+    fetcher = HTTPFetcher()
+    fetcher.session.trust_env = False
+    fetcher.session.proxies.clear()
+
+    results = {'corpus': {'pages': len(manifest['pages']), 'search_pages': len(server.search_pages)}}
+
+    start = time.perf_counter()
+    search = Kleinanzeigen.SearchPage(None, manifest['postalcode'], manifest['radius'], max_number=args.max_number, fetcher=fetcher)
+    seconds = time.perf_counter() - start
+    results['search'] = {'pages': server.hits['search'], 'offers': len(search.offers_indices), 'seconds': round(seconds, 3),
+                         'pages_per_s': round(server.hits['search'] / seconds, 1)}
+
+    offer_prefix = manifest['offer_template'].split('{')[0]
+    offer_pages = [filename for path, filename in manifest['pages'].items() if path.startswith(offer_prefix)]
+    contents = []
+    for filename in offer_pages:
+        with open(os.path.join(args.folder, filename), encoding='utf-8') as f:
+            contents.append(f.read())
+    if contents:
+        us, failures = time_per_call(parse_offer, contents, args.repeat)
+        results['parse'] = {'offers': len(contents), 'us_per_offer': round(us, 1), 'failures': failures}
+
+    start = time.perf_counter()
+    table = postal_code_table()
+    load_seconds = time.perf_counter() - start
+    postalcodes = []
+    for content in contents:
+        try:
+            postalcodes.append(parse_offer(content)['postalcode'])
+        except Exception:
+            pass
+    postalcodes = [x for x in postalcodes if x is not None]
+    # One query per offer, as OfferPage geocodes
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for postalcode in postalcodes:
+            table.query(postalcode)
+    query_seconds = (time.perf_counter() - start) / args.repeat
+    results['geocode'] = {'load_seconds': round(load_seconds, 3), 'offers': len(postalcodes),
+                          'us_per_offer': round(query_seconds / max(len(postalcodes), 1) * 1e6, 2)}
+
+    hits_before = server.hits['offer']
+    if args.database:
+        import config
+        from mysql_wrapper import MySQL
+        mysql_obj = MySQL(mysql_host=config.mysql_host, mysql_user=config.mysql_user,
+                          mysql_password=config.mysql_password, mysql_database=args.database)
+        results_table, errors_table = 'benchmark_results', 'benchmark_errors'
+        for name in (results_table, errors_table):
+            mysql_obj.execute(f"DROP TABLE IF EXISTS {name}")
+        mysql_obj.create_table(results_table, config.mysql_columns, config.mysql_types)
+        mysql_obj.create_table(errors_table, config.mysql_columns_err, config.mysql_types_err)
+
+        start = time.perf_counter()
+        Kleinanzeigen.offers_to_mysql(search, mysql_obj, results_table, errors_table, fetchers=[fetcher])
+        seconds = time.perf_counter() - start
+        rows = mysql_obj.execute(f"SELECT COUNT(*) FROM {results_table}", fetch=True)[0][0]
+        errors = mysql_obj.execute(f"SELECT COUNT(*) FROM {errors_table}", fetch=True)[0][0]
+        results['offers'] = {'pages': server.hits['offer'] - hits_before, 'rows': rows, 'errors': errors,
+                             'seconds': round(seconds, 3), 'rows_per_s': round(rows / seconds, 1)}
+
+        # Write throughput of the database alone, rewriting the scraped rows as upserts
+        values = mysql_obj.execute(f"SELECT {', '.join(Kleinanzeigen.OFFER_COLUMNS)} FROM {results_table}", fetch=True)
+        if values:
+            start = time.perf_counter()
+            mysql_obj.bulk_write(results_table, Kleinanzeigen.OFFER_COLUMNS, values)
+            seconds = time.perf_counter() - start
+            results['db'] = {'rows': len(values), 'seconds': round(seconds, 3), 'rows_per_s': round(len(values) / seconds, 1)}
+        for name in (results_table, errors_table):
+            mysql_obj.execute(f"DROP TABLE IF EXISTS {name}")
+    else:
+        start = time.perf_counter()
+        failures = 0
+        for index in search.offers_indices:
+            try:
+                Kleinanzeigen.scrape_offer(fetcher, index)
+            except Exception:
+                failures += 1
+        seconds = time.perf_counter() - start
+        results['offers'] = {'pages': server.hits['offer'] - hits_before, 'failures': failures, 'seconds': round(seconds, 3),
+                             'pages_per_s': round((server.hits['offer'] - hits_before) / seconds, 1) if seconds else None}
+    results['missing_pages'] = server.hits['missing']
+    server.shutdown()
+    return results
+
+
+class SavedPageFetcher:
+    """Fetcher handing out saved offer pages in turn, read from disk on every fetch like a fresh download."""
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.calls = 0
+        self.last = None
+
+    def fetch(self, url):
+        filename = self.filenames[self.calls % len(self.filenames)]
+        self.calls += 1
+        with open(filename, encoding='utf-8') as f:
+            self.last = f.read()
+        return self.last
+
+
+def rss_kb(field):
+    """Return VmRSS or VmHWM of this process in kB."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+def memory_run(mode, filenames, offers, results):
+    """Parse offers in a fresh process and report its peak RSS above the RSS it started with."""
+    from kleinanzeigen import Kleinanzeigen
+    from offer_frame import OfferColumns
+
+    fetcher = SavedPageFetcher(filenames)
+    kept = []
+    columns = OfferColumns()
+    # Reset the peak RSS inherited from the parent
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    baseline = rss_kb('VmRSS')
+    start = time.perf_counter()
+    failures = 0
+    for index in range(offers):
+        try:
+            offer = Kleinanzeigen.OfferPage(fetcher, index)
+        except Exception:
+            failures += 1
+            continue
+        if mode == 'retained':
+            # What an offer kept alive before: its page source and the raw details next to the fields
+            kept.append((offer, fetcher.last, parse_offer(fetcher.last)['details']))
+        elif mode == 'compact':
+            kept.append(offer)
+        else:
+            columns.append(offer)
+    seconds = time.perf_counter() - start
+    growth = rss_kb('VmHWM') - baseline
+    results.put((mode, {'offers': offers - failures, 'failures': failures, 'peak_rss_growth_mb': round(growth / 1024, 1),
+                        'kb_per_offer': round(growth / max(offers - failures, 1), 2), 'seconds': round(seconds, 3)}))
+
+def bench_memory(args):
+    from geocode import postal_code_table
+
+    filenames = sorted(glob.glob(os.path.join(args.folder, '*.html')))
+    if not filenames:
+        raise SystemExit(f'No *.html pages found in {args.folder}')
+    # Loaded once before forking, so the runs only measure the offers they hold
+    postal_code_table()
+    context = multiprocessing.get_context('fork')
+    results = {'pages': len(filenames)}
+    for mode in ('retained', 'compact', 'columns'):
+        queue = context.Queue()
+        process = context.Process(target=memory_run, args=(mode, filenames, args.offers, queue))
+        process.start()
+        name, result = queue.get()
+        process.join()
+        results[name] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parse_parser = subparsers.add_parser('parse', help='Compare the offer page parsers on saved pages')
+    parse_parser.add_argument('folder', help='Folder with saved offer pages (*.html)')
+    parse_parser.add_argument('--repeat', type=int, default=20)
+    parse_parser.set_defaults(function=bench_parse)
+
+    keywords_parser = subparsers.add_parser('keywords', help='Compare the keyword filters on a corpus of descriptions')
+    keywords_parser.add_argument('--corpus', help='File with one offer description per line, synthetic if omitted')
+    keywords_parser.add_argument('--size', type=int, default=20000, help='Number of synthetic descriptions')
+    keywords_parser.add_argument('--jobs', type=int, default=50, help='Number of random keyword jobs')
+    keywords_parser.set_defaults(function=bench_keywords)
+
+    record_parser = subparsers.add_parser('record', help='Export cached pages of a search into a replay corpus')
+    record_parser.add_argument('folder', help='Folder to write the corpus to')
+    record_parser.add_argument('--postalcode', required=True)
+    record_parser.add_argument('--radius', type=int, default=None)
+    record_parser.set_defaults(function=bench_record)
+
+    replay_parser = subparsers.add_parser('replay', help='Run the scraper end to end against a replay corpus')
+    replay_parser.add_argument('folder', help='Folder of the replay corpus')
+    replay_parser.add_argument('--database', help='Local MySQL database for offers_to_mysql, only fetched and parsed if omitted')
+    replay_parser.add_argument('--max-number', type=int, default=None, help='Maximum number of offers to take from the search')
+    replay_parser.add_argument('--repeat', type=int, default=20)
+    replay_parser.set_defaults(function=bench_replay)
+
+    memory_parser = subparsers.add_parser('memory', help='Compare the peak RSS of holding parsed offers with and without their pages')
+    memory_parser.add_argument('folder', help='Folder with saved offer pages (*.html), used in turn')
+    memory_parser.add_argument('--offers', type=int, default=1000, help='Number of offers to parse')
+    memory_parser.set_defaults(function=bench_memory)
+
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    results = args.function(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
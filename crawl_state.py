@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import datetime
+import config
+
+# Table holding the crawl state of every search query, optional in config.py
+mysql_crawl_state_table = getattr(config, 'mysql_crawl_state_table', 'crawl_state')
+
+CRAWL_STATE_COLUMNS = ['query_key', 'high_water', 'fingerprint', 'updated_at']
+CRAWL_STATE_TYPES = ['VARCHAR(255) PRIMARY KEY', 'BIGINT', 'CHAR(40)', 'DATETIME']
+
+
+def page_fingerprint(offer_indices):
+    """Return a fingerprint of the offers listed on a search page, in listing order."""
+    return hashlib.sha1(','.join(map(str, offer_indices)).encode()).hexdigest()
+
+
+class CrawlState:
+    """
+    Stored crawl state of one search query.
+
+    Offer ids grow over time, so a search page whose oldest listed offer is not above
+    the high-water id of the last crawl reaches into offers already seen. Together with
+    the fingerprint of the first page this lets a crawl stop after the first page that
+    holds no new listings.
+
+    Args:
+        mysql_obj (MySQL): Database holding the crawl state table.
+        query_key (str): Identifier of the search query, see `query_key`.
+
+    Attributes:
+        high_water (int): Highest offer id seen by previous crawls, None before the first crawl.
+        fingerprint (str): Fingerprint of the first search page of the last crawl.
+    """
+    def __init__(self, mysql_obj, query_key):
+        self.mysql_obj = mysql_obj
+        self.query_key = query_key
+        self.high_water = None
+        self.fingerprint = None
+        self.__load()
+
+    @staticmethod
+    def query_key(search_url, postalcode, radius):
+        return f"{search_url}|{postalcode}|{radius}"
+
+    def __load(self):
+        self.mysql_obj.create_table(mysql_crawl_state_table, CRAWL_STATE_COLUMNS, CRAWL_STATE_TYPES)
+        with self.mysql_obj.transaction() as mycursor:
+            mycursor.execute(
+                f"SELECT high_water, fingerprint FROM {mysql_crawl_state_table} WHERE query_key = %s",
+                (self.query_key,)
+            )
+            row = mycursor.fetchone()
+        if row:
+            self.high_water, self.fingerprint = row
+
+    def is_known_page(self, offer_indices, first_page=False):
+        """
+        Check whether a search page holds no offers newer than the previous crawl.
+
+        Args:
+            offer_indices (list[int]): Offer ids of the page in listing order, without top ads.
+            first_page (bool): Whether this is the first page of the search.
+        """
+        if not offer_indices:
+            return True
+        if first_page and page_fingerprint(offer_indices) == self.fingerprint:
+            return True
+        return self.high_water is not None and offer_indices[-1] <= self.high_water
+
+    def update(self, offer_indices, first_page_indices=None):
+        """Advance the state in memory with the offers of a crawl."""
+        if offer_indices:
+            self.high_water = max([self.high_water or 0] + list(offer_indices))
+        if first_page_indices is not None:
+            self.fingerprint = page_fingerprint(first_page_indices)
+
+    def save(self):
+        """Store the state, to be called once the crawled offers were written."""
+        with self.mysql_obj.transaction() as mycursor:
+            mycursor.execute(
+                f"INSERT INTO {mysql_crawl_state_table} ({', '.join(CRAWL_STATE_COLUMNS)}) VALUES (%s, %s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE high_water = VALUES(high_water), fingerprint = VALUES(fingerprint), "
+                "updated_at = VALUES(updated_at)",
+                (self.query_key, self.high_water, self.fingerprint, datetime.datetime.now())
+            )
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import random
+import datetime
+import threading
+import config
+import metrics
+from timeout import TimeoutException
+from webscraper import ChallengeException
+
+# Retry settings of failed offers, optional in config.py. Failures of these classes are
+# retried, all others exclude the offer for good.
+error_retry_classes = getattr(config, 'error_retry_classes', ('timeout', 'network', 'browser', 'blocked'))
+# Seconds before the first retry, doubled with every further attempt up to the maximum
+error_retry_base = getattr(config, 'error_retry_base', 600)
+error_retry_max_delay = getattr(config, 'error_retry_max_delay', 86400)
+# Attempts after which an offer is not retried anymore
+error_retry_max_attempts = getattr(config, 'error_retry_max_attempts', 5)
+# Due retries scraped along with every crawl and seconds they are claimed for
+error_retry_batch = getattr(config, 'error_retry_batch', 20)
+error_retry_lease = getattr(config, 'error_retry_lease', 3600)
+
+# Columns added to the error tables, rows of older tables are never retried
+ERROR_COLUMNS = ['failure_class', 'attempts', 'next_retry', 'last_error', 'updated_at']
+ERROR_TYPES = ["VARCHAR(32) DEFAULT 'unknown'", 'INT DEFAULT 1', 'DATETIME NULL DEFAULT NULL', 'VARCHAR(255)', 'DATETIME']
+
+
+def failure_class(exception):
+    """Return the class of failure an exception stands for, see `error_retry_classes`."""
+    name = type(exception).__name__
+    module = type(exception).__module__
+    status = getattr(getattr(exception, 'response', None), 'status_code', None)
+    if isinstance(exception, (TimeoutException, TimeoutError)) or 'Timeout' in name:
+        return 'timeout'
+    if isinstance(exception, ChallengeException):
+        return 'blocked'
+    if status in (404, 410):
+        return 'gone'
+    if module.startswith('selenium'):
+        return 'browser'
+    if isinstance(exception, OSError) or module.startswith(('requests', 'urllib3')):
+        return 'network'
+    if isinstance(exception, (ValueError, KeyError, IndexError, AttributeError, TypeError)):
+        return 'parse'
+    return 'other'
+
+
+class ErrorIndex:
+    """
+    Table of offers that failed to scrape, with the failure class, the number of
+    attempts and the time of the next retry.
+
+    Transient failures are retried with exponential backoff: a retry is due
+    `error_retry_base * 2 ** (attempts - 1)` seconds (at most `error_retry_max_delay`,
+    +-10% jitter) after the last attempt. Offers with a permanent failure or too many
+    attempts have no retry time and stay excluded. Listed offers with a row are never
+    scraped as new ones, retries only come from `claim_due`. Both lookups are indexed,
+    by id for the exclusion of listed offers and by retry time for due retries.
+
+    Args:
+        mysql_obj (MySQL): Database holding the table.
+        table (str): The error table, created with at least an `id` column.
+    """
+    def __init__(self, mysql_obj, table):
+        self.mysql_obj = mysql_obj
+        self.table = table
+        self.__ensure_schema()
+
+    def __ensure_schema(self):
+        """Add the retry columns and the indexes to an existing error table."""
+        with self.mysql_obj.transaction() as mycursor:
+            mycursor.execute(
+                "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                (self.table,)
+            )
+            existing = {x[0].lower() for x in mycursor.fetchall()}
+            missing = [(col, typ) for col, typ in zip(ERROR_COLUMNS, ERROR_TYPES) if col not in existing]
+            if missing:
+                mycursor.execute(f"ALTER TABLE {self.table} " + ', '.join(f"ADD COLUMN {col} {typ}" for col, typ in missing))
+                print(f'[MYSQL] Added {", ".join(x[0] for x in missing)} to {self.table}')
+            mycursor.execute(
+                "SELECT COLUMN_NAME FROM information_schema.STATISTICS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND SEQ_IN_INDEX = 1",
+                (self.table,)
+            )
+            indexed = {x[0].lower() for x in mycursor.fetchall()}
+            for column in ('id', 'next_retry'):
+                if column not in indexed:
+                    mycursor.execute(f"ALTER TABLE {self.table} ADD INDEX {self.table}_{column} ({column})")
+                    print(f'[MYSQL] Index on {self.table}.{column} created')
+
+    @staticmethod
+    def next_retry(failure, attempts, now=None):
+        """Return the time of the next retry after a failed attempt, None if there is none."""
+        if failure not in error_retry_classes or attempts >= error_retry_max_attempts:
+            return None
+        delay = min(error_retry_base * 2 ** (attempts - 1), error_retry_max_delay) * random.uniform(0.9, 1.1)
+        return (now or datetime.datetime.now()) + datetime.timedelta(seconds=delay)
+
+    def filter_new(self, candidates):
+        """
+        Returns the candidates without a row in the table, keeping their order.
+
+        Failed offers are left out even when their retry is due, they are only retried
+        through `claim_due`, so a crawl listing them cannot scrape them a second time.
+
+        Args:
+            candidates (list[int]): Offer ids to check.
+        """
+        candidates = list(candidates)
+        if not candidates:
+            return candidates
+        with metrics.timed('db_read'), self.mysql_obj.transaction() as mycursor:
+            mycursor.execute(
+                f"SELECT id FROM {self.table} WHERE id IN ({', '.join(['%s'] * len(candidates))})",
+                candidates
+            )
+            excluded = {int(x[0]) for x in mycursor.fetchall()}
+        return [x for x in candidates if x not in excluded]
+
+    def record(self, failures):
+        """
+        Record failed attempts, in one transaction.
+
+        Args:
+            failures (list): (offer id, exception) of every failed offer.
+        """
+        failures = dict(failures)
+        if not failures:
+            return
+        now = datetime.datetime.now()
+        ids = list(failures)
+        with metrics.timed('db_write'), self.mysql_obj.transaction() as mycursor:
+            mycursor.execute(
+                f"SELECT id, attempts FROM {self.table} WHERE id IN ({', '.join(['%s'] * len(ids))}) FOR UPDATE", ids
+            )
+            attempts = {int(x[0]): x[1] or 1 for x in mycursor.fetchall()}
+            updates, inserts = [], []
+            for offer_id, exception in failures.items():
+                failure = failure_class(exception)
+                attempt = attempts.get(offer_id, 0) + 1
+                row = (failure, attempt, self.next_retry(failure, attempt, now), str(exception)[:255], now)
+                if offer_id in attempts:
+                    updates.append(row + (offer_id,))
+                else:
+                    inserts.append((offer_id,) + row)
+                metrics.inc('scraper_offer_failures_total', failure_class=failure)
+            if updates:
+                mycursor.executemany(
+                    f"UPDATE {self.table} SET {' = %s, '.join(ERROR_COLUMNS)} = %s WHERE id = %s", updates
+                )
+            if inserts:
+                mycursor.executemany(
+                    f"INSERT INTO {self.table} (id, {', '.join(ERROR_COLUMNS)}) VALUES ({', '.join(['%s'] * (len(ERROR_COLUMNS) + 1))})",
+                    inserts
+                )
+        metrics.inc('scraper_db_rows_total', len(failures), table=self.table)
+
+    def claim_due(self, limit=error_retry_batch, lease=error_retry_lease):
+        """
+        Take the offers whose retry is due, oldest first.
+
+        Their retry time is moved `lease` seconds ahead, so concurrent crawls do not
+        take the same offers and offers of a crashed crawl come back later.
+
+        Returns:
+            list[int]: Ids of the claimed offers.
+        """
+        with self.mysql_obj.transaction() as mycursor:
+            mycursor.execute(
+                f"SELECT id FROM {self.table} WHERE next_retry <= NOW() ORDER BY next_retry LIMIT %s FOR UPDATE", (limit,)
+            )
+            ids = [int(x[0]) for x in mycursor.fetchall()]
+            if ids:
+                mycursor.execute(
+                    f"UPDATE {self.table} SET next_retry = NOW() + INTERVAL %s SECOND WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                    [lease] + ids
+                )
+        return ids
+
+    def resolve(self, ids):
+        """Remove offers that were scraped after all."""
+        ids = list(ids)
+        if not ids:
+            return
+        with self.mysql_obj.transaction() as mycursor:
+            mycursor.execute(f"DELETE FROM {self.table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+
+
+_error_indices = {}
+_error_indices_lock = threading.Lock()
+
+def error_index(mysql_obj, table):
+    """Return the process-wide ErrorIndex of a table in the database of `mysql_obj`."""
+    key = (mysql_obj.host, mysql_obj.database, table)
+    with _error_indices_lock:
+        if key not in _error_indices:
+            _error_indices[key] = ErrorIndex(mysql_obj, table)
+        return _error_indices[key]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+import threading
+import config
+
+# GeoNames postal code file for Germany. Either the raw GeoNames DE.txt (tab separated,
+# no header) or the cached copy pgeocode writes to its storage directory (CSV with header).
+# When not configured the pgeocode cache is used and downloaded once if missing.
+geocode_data_file = getattr(config, 'geocode_data_file', None)
+
+DATA_FIELDS = [
+    'country_code', 'postal_code', 'place_name', 'state_name', 'state_code',
+    'county_name', 'county_code', 'community_name', 'community_code',
+    'latitude', 'longitude', 'accuracy',
+]
+RESULT_FIELDS = ['state_name', 'state_code', 'place_name', 'latitude', 'longitude']
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PostalCodeTable:
+    """
+    In-memory lookup table of German postal codes.
+
+    Rows of the same postal code are merged like pgeocode does: place names are joined
+    with ', ', state name and code are taken from the first row and the coordinates
+    are averaged.
+
+    Args:
+        path (str): Path of the GeoNames postal code file.
+
+    Attributes:
+        codes (dict): Postal code (str) -> (state_name, state_code, place_name, latitude, longitude).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.codes = self.__load(path)
+
+    def __load(self, path):
+        with open(path, encoding='utf-8', newline='') as f:
+            header = f.readline()
+            f.seek(0)
+            if header.startswith('country_code'):
+                rows = csv.DictReader(f)
+            else:
+                rows = csv.DictReader(f, fieldnames=DATA_FIELDS, delimiter='\t')
+
+            grouped = {}
+            for row in rows:
+                entry = grouped.setdefault(row['postal_code'], [row['state_name'], row['state_code'], [], [], []])
+                entry[2].append(row['place_name'])
+                lat, lon = _to_float(row['latitude']), _to_float(row['longitude'])
+                if lat is not None and lon is not None:
+                    entry[3].append(lat)
+                    entry[4].append(lon)
+
+        codes = {}
+        for postal_code, (state_name, state_code, places, lats, lons) in grouped.items():
+            codes[postal_code] = (
+                state_name or None,
+                state_code or None,
+                ', '.join(places),
+                sum(lats) / len(lats) if lats else None,
+                sum(lons) / len(lons) if lons else None,
+            )
+        return codes
+
+    def query(self, postalcode):
+        """
+        Look up a single postal code.
+
+        Args:
+            postalcode (int/str): The postal code, leading zeros may be missing.
+
+        Returns:
+            dict: `state_name`, `state_code`, `place_name`, `latitude` and `longitude`,
+                all None for unknown postal codes.
+        """
+        values = self.codes.get(str(int(postalcode)).zfill(5))
+        if values is None:
+            return dict.fromkeys(RESULT_FIELDS)
+        return dict(zip(RESULT_FIELDS, values))
+
+
+_postal_code_table = None
+_postal_code_table_lock = threading.Lock()
+
+def default_data_file():
+    """Return the pgeocode cache file for Germany, downloading it once if missing."""
+    import pgeocode
+    path = os.path.join(pgeocode.STORAGE_DIR, 'DE.txt')
+    if not os.path.exists(path):
+        pgeocode.Nominatim('de')
+    return path
+
+def postal_code_table():
+    """Return the postal code table of this process, loading it on first use."""
+    global _postal_code_table
+    with _postal_code_table_lock:
+        if _postal_code_table is None:
+            path = geocode_data_file or default_data_file()
+            print('[PYTHON][GEOCODE] Loading postal codes from {}'.format(path))
+            _postal_code_table = PostalCodeTable(path)
+        return _postal_code_table
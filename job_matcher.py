@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import numpy as np
+import pandas as pd
+from keyword_filter import KeywordAutomaton, split_keywords, offer_text
+
+# Position of the filter columns in a search_jobs row:
+# price_min, price_max, rooms_min, rooms_max, sqm_min, sqm_max, filter_include, filter_exclude
+FILTER_FIELDS = slice(4, 12)
+# Offer columns compared against the (min, max) pairs of a job, in the order of FILTER_FIELDS
+RANGE_COLUMNS = ('price', 'rooms', 'size')
+
+
+class JobMatcher:
+    """
+    Matches a batch of new offers against many search jobs in one vectorized pass.
+
+    The price, rooms and size ranges of all jobs are kept as a (jobs x 6) bound matrix
+    and all include / exclude keywords in one shared KeywordAutomaton. Jobs are added
+    or updated with `update`; the compiled structures are only rebuilt when a job's
+    filter columns actually changed.
+
+    Attributes:
+        filters (dict): Job id -> filter columns of the job.
+    """
+    def __init__(self):
+        self.filters = {}
+        self._compiled = None
+        self._lock = threading.Lock()
+
+    def update(self, jobs):
+        """
+        Add or update jobs from search_jobs rows.
+
+        Returns:
+            int: The number of jobs whose filters changed.
+        """
+        changed = 0
+        for entry in jobs:
+            job_id, filters = entry[0], tuple(entry[FILTER_FIELDS])
+            if self.filters.get(job_id) != filters:
+                self.filters[job_id] = filters
+                changed += 1
+        if changed:
+            self._compiled = None
+        return changed
+
+    def remove(self, job_ids):
+        """Drop jobs that are no longer active."""
+        with self._lock:
+            for job_id in job_ids:
+                if self.filters.pop(job_id, None) is not None:
+                    self._compiled = None
+
+    def __compile(self):
+        job_ids = list(self.filters)
+        bounds = np.array([[np.nan if x is None else float(x) for x in self.filters[job_id][:6]]
+                           for job_id in job_ids], dtype=float).reshape(-1, 6)
+
+        includes = [split_keywords(self.filters[job_id][6]) for job_id in job_ids]
+        excludes = [split_keywords(self.filters[job_id][7]) for job_id in job_ids]
+        keywords = sorted({x for words in includes + excludes for x in words})
+        automaton = KeywordAutomaton(keywords)
+
+        include = np.zeros((len(keywords), len(job_ids)), dtype=np.int32)
+        exclude = np.zeros((len(keywords), len(job_ids)), dtype=np.int32)
+        for col, (words_in, words_ex) in enumerate(zip(includes, excludes)):
+            include[[automaton.index[x] for x in words_in], col] = 1
+            exclude[[automaton.index[x] for x in words_ex], col] = 1
+        has_include = include.any(axis=0)
+
+        position = {job_id: i for i, job_id in enumerate(job_ids)}
+        self._compiled = (position, bounds, automaton, include, exclude, has_include)
+
+    def match(self, df, entries):
+        """
+        Match offers against jobs.
+
+        Parameters:
+        - df: DataFrame of offers from the results table.
+        - entries: search_jobs rows of the jobs to match, the last column being last_run.
+          Only offers added after a job's last_run are matched for that job.
+
+        Returns:
+        - List of (job_id, id_index) pairs.
+        """
+        if df is None or len(df) == 0 or not entries:
+            return []
+        # Runner threads match concurrently, the compiled structures are only replaced under the lock
+        with self._lock:
+            self.update(entries)
+            if self._compiled is None:
+                self.__compile()
+            position, bounds, automaton, include, exclude, has_include = self._compiled
+
+        cols = [position[entry[0]] for entry in entries]
+        bounds = bounds[cols]
+        mask = np.ones((len(df), len(cols)), dtype=bool)
+
+        # Range filters, unset bounds (NaN) always pass, missing offer values never pass a set bound
+        with np.errstate(invalid='ignore'):
+            for k, column in enumerate(RANGE_COLUMNS):
+                values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)[:, None]
+                low, high = bounds[:, 2 * k][None, :], bounds[:, 2 * k + 1][None, :]
+                mask &= np.isnan(low) | (values >= low)
+                mask &= np.isnan(high) | (values <= high)
+
+        # Keyword filters, title and description are scanned together once per offer
+        if automaton.keywords:
+            texts = [offer_text(title, description) for title, description in zip(df['title'], df['description'])]
+            hits = automaton.search_many(texts).astype(np.int32)
+            mask &= ~has_include[cols][None, :] | ((hits @ include[:, cols]) > 0)
+            mask &= (hits @ exclude[:, cols]) == 0
+
+        # Only offers added since the last run of each job, all offers for jobs that never ran
+        timestamps = pd.to_datetime(df['timestamp']).to_numpy(dtype='datetime64[ns]')[:, None]
+        last_runs = np.array([pd.Timestamp(entry[-1]).to_datetime64() for entry in entries], dtype='datetime64[ns]')[None, :]
+        mask &= np.isnat(last_runs) | (timestamps > last_runs)
+
+        id_index = df['id_index'].to_numpy()
+        rows, jobs = np.nonzero(mask)
+        return [(entries[j][0], int(id_index[r])) for r, j in zip(rows, jobs)]
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import random
+import datetime
+import itertools
+import threading
+import config
+from misc import local_now
+
+# Scheduling settings, optional in config.py
+mysql_search_jobs_table = getattr(config, 'mysql_search_jobs_table', 'search_jobs')
+# Change log of search_jobs filled by triggers, read for incremental syncs
+mysql_search_jobs_changes_table = getattr(config, 'mysql_search_jobs_changes_table', 'search_jobs_changes')
+# Default seconds between two runs of a job and per job overrides {job_id: seconds}
+search_job_interval = getattr(config, 'search_job_interval', 300)
+search_job_intervals = getattr(config, 'search_job_intervals', {})
+# Random deviation of every interval as fraction of the interval, spreads jobs over time
+search_job_jitter = getattr(config, 'search_job_jitter', 0.1)
+# Seconds between full reloads of all active jobs, catching changes the change log misses
+search_job_full_sync = getattr(config, 'search_job_full_sync', 600)
+
+CHANGES_COLUMNS = ['seq', 'job_id', 'changed_at']
+CHANGES_TYPES = ['BIGINT AUTO_INCREMENT PRIMARY KEY', 'INT', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP']
+
+
+class JobScheduler:
+    """
+    Priority queue of the active search jobs keyed by the time each job is due next.
+
+    Jobs are loaded once and then kept in sync from a change log table that triggers on
+    search_jobs fill. Updates that only move `last_run`, as written by the runner itself,
+    are not logged. Without the privileges for triggers, or as a safety net every
+    `full_sync_every` seconds, all active jobs are reloaded.
+
+    Job entries are search_jobs rows with `last_run` as the last column. A job is due
+    `interval` seconds (plus jitter) after its last run.
+
+    Args:
+        mysql_obj (MySQL): Database holding the search_jobs table.
+        interval (float): Default seconds between two runs of a job.
+        intervals (dict): Job id -> seconds between two runs, overriding `interval`.
+        jitter (float): Maximum random deviation of an interval, as fraction of it.
+        full_sync_every (float): Seconds between full reloads of all active jobs.
+
+    Attributes:
+        jobs (dict): Job id -> search_jobs row of every active job.
+    """
+    def __init__(self, mysql_obj, interval=search_job_interval, intervals=search_job_intervals,
+                 jitter=search_job_jitter, full_sync_every=search_job_full_sync):
+        self.mysql_obj = mysql_obj
+        self.interval = interval
+        self.intervals = intervals or {}
+        self.jitter = jitter
+        self.full_sync_every = full_sync_every
+        self.jobs = {}
+        self._heap = []
+        self._due = {}
+        self._running = set()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._last_change = None
+        self._last_full_sync = None
+        self._change_log = self.__ensure_change_log()
+
+    def __ensure_change_log(self):
+        """Create the change log table and its triggers, return whether the log is usable."""
+        table, log = mysql_search_jobs_table, mysql_search_jobs_changes_table
+        triggers = {
+            f'{log}_insert': f"AFTER INSERT ON {table} FOR EACH ROW INSERT INTO {log} (job_id) VALUES (NEW.id)",
+            f'{log}_update': f"AFTER UPDATE ON {table} FOR EACH ROW INSERT INTO {log} (job_id) "
+                             f"SELECT NEW.id FROM DUAL WHERE NEW.last_run <=> OLD.last_run",
+            f'{log}_delete': f"AFTER DELETE ON {table} FOR EACH ROW INSERT INTO {log} (job_id) VALUES (OLD.id)",
+        }
+        try:
+            self.mysql_obj.create_table(log, CHANGES_COLUMNS, CHANGES_TYPES)
+            with self.mysql_obj.transaction() as mycursor:
+                mycursor.execute(
+                    "SELECT TRIGGER_NAME FROM information_schema.TRIGGERS "
+                    "WHERE TRIGGER_SCHEMA = DATABASE() AND EVENT_OBJECT_TABLE = %s", (table,)
+                )
+                existing = {x[0] for x in mycursor.fetchall()}
+                for name, definition in triggers.items():
+                    if name not in existing:
+                        mycursor.execute(f"CREATE TRIGGER {name} {definition}")
+                        print(f'[SCHEDULER] Trigger {name} created')
+            return True
+        except Exception as e:
+            print(f'[SCHEDULER][WARNING] No change log for {table}, falling back to full syncs: {e}')
+            return False
+
+    def interval_of(self, job_id):
+        return self.intervals.get(job_id, self.interval)
+
+    def __next_due(self, job_id, last_run):
+        seconds = self.interval_of(job_id) * (1 + random.uniform(-self.jitter, self.jitter))
+        return (last_run or local_now()) + datetime.timedelta(seconds=seconds)
+
+    def __schedule(self, job_id, due):
+        # Earlier heap entries of the job become stale and are skipped when popped
+        self._due[job_id] = due
+        heapq.heappush(self._heap, (due, next(self._counter), job_id))
+
+    def __put(self, entry):
+        job_id = entry[0]
+        known = self.jobs.get(job_id)
+        if job_id in self._running:
+            # Keep the last_run set by the running crawl, it is rescheduled when done
+            entry = tuple(entry[:-1]) + (known[-1],)
+        self.jobs[job_id] = entry
+        if job_id not in self._running and (known is None or known[-1] != entry[-1]):
+            self.__schedule(job_id, self.__next_due(job_id, entry[-1]))
+
+    def __drop(self, job_id):
+        self.jobs.pop(job_id, None)
+        self._due.pop(job_id, None)
+
+    def sync(self):
+        """
+        Bring the jobs in line with the database.
+
+        Returns:
+            list: Ids of the jobs that were removed or deactivated.
+        """
+        full = (not self._change_log or self._last_change is None
+                or time.monotonic() - self._last_full_sync >= self.full_sync_every)
+        with self._lock:
+            return self.__full_sync() if full else self.__incremental_sync()
+
+    def __full_sync(self):
+        log = mysql_search_jobs_changes_table
+        with self.mysql_obj.transaction() as mycursor:
+            # Read the change log position in the same snapshot as the jobs
+            last_change = None
+            if self._change_log:
+                mycursor.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {log}")
+                last_change = mycursor.fetchone()[0]
+                mycursor.execute(f"DELETE FROM {log} WHERE changed_at < NOW() - INTERVAL 1 DAY")
+            mycursor.execute(f"SELECT * FROM {mysql_search_jobs_table} WHERE is_active = 1")
+            rows = mycursor.fetchall()
+        self._last_change = last_change
+        self._last_full_sync = time.monotonic()
+
+        active = {row[0] for row in rows}
+        removed = [x for x in self.jobs if x not in active]
+        for job_id in removed:
+            self.__drop(job_id)
+        for row in rows:
+            self.__put(row)
+        print(f'[SCHEDULER] Full sync: {len(rows)} active jobs, {len(removed)} removed')
+        return removed
+
+    def __incremental_sync(self):
+        log = mysql_search_jobs_changes_table
+        with self.mysql_obj.transaction() as mycursor:
+            mycursor.execute(f"SELECT seq, job_id FROM {log} WHERE seq > %s ORDER BY seq", (self._last_change,))
+            changes = mycursor.fetchall()
+            if not changes:
+                return []
+            job_ids = sorted({x[1] for x in changes})
+            mycursor.execute(
+                f"SELECT * FROM {mysql_search_jobs_table} WHERE is_active = 1 AND id IN ({','.join(['%s'] * len(job_ids))})",
+                job_ids
+            )
+            rows = mycursor.fetchall()
+        self._last_change = changes[-1][0]
+
+        active = {row[0] for row in rows}
+        removed = [x for x in job_ids if x not in active and x in self.jobs]
+        for job_id in removed:
+            self.__drop(job_id)
+        for row in rows:
+            self.__put(row)
+        print(f'[SCHEDULER] Synced changes of jobs {job_ids}')
+        return removed
+
+    def next_due(self):
+        """Return the time the next job is due, None without scheduled jobs."""
+        with self._lock:
+            while self._heap:
+                due, _, job_id = self._heap[0]
+                if self._due.get(job_id) == due and job_id not in self._running:
+                    return due
+                heapq.heappop(self._heap)
+            return None
+
+    def pop_due(self, now=None):
+        """
+        Take all jobs that are due.
+
+        The jobs are marked as running until `done` is called for them.
+
+        Returns:
+            list: search_jobs rows of the due jobs.
+        """
+        now = now or local_now()
+        entries = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, _, job_id = heapq.heappop(self._heap)
+                if self._due.get(job_id) != due or job_id in self._running:
+                    continue
+                self._running.add(job_id)
+                entries.append(self.jobs[job_id])
+        return entries
+
+    def due_time(self, job_id):
+        """Return the time a job was or is due, None for unknown jobs."""
+        return self._due.get(job_id)
+
+    def pending(self):
+        """Return the number of jobs waiting for their next run."""
+        with self._lock:
+            return len(self.jobs) - len(self._running)
+
+    def done(self, entries, last_run):
+        """Record the run of jobs taken with `pop_due` and schedule their next run."""
+        with self._lock:
+            for entry in entries:
+                job_id = entry[0]
+                self._running.discard(job_id)
+                if job_id not in self.jobs:
+                    continue
+                self.jobs[job_id] = tuple(self.jobs[job_id][:-1]) + (last_run,)
+                self.__schedule(job_id, self.__next_due(job_id, last_run))
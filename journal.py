@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import time
+import zlib
+import fcntl
+import pickle
+import struct
+import itertools
+import threading
+import config
+
+# Journal settings, optional in config.py
+journal_folder = getattr(config, 'journal_folder', getattr(config, 'tmp_folder', '.'))
+# Entries and seconds after which the journal is flushed to disk with fsync
+journal_fsync_every = getattr(config, 'journal_fsync_every', 8)
+journal_fsync_interval = getattr(config, 'journal_fsync_interval', 1.0)
+# Bytes of acknowledged records after which the journal moves to a new file holding only the open entries
+journal_max_bytes = getattr(config, 'journal_max_bytes', 64 * 1024 ** 2)
+
+ENTRY, ACK = 1, 2
+# Payload length, CRC32 of the payload and record kind
+HEADER = struct.Struct('>IIB')
+SEQ = struct.Struct('>Q')
+
+
+def read_records(f):
+    """Yield (kind, payload) of a journal file, stopping at a torn or corrupt tail."""
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        length, crc, kind = HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        yield kind, payload
+
+def pending_entries(f):
+    """Return the entries of a journal file that were never acknowledged, in write order."""
+    entries = {}
+    for kind, payload in read_records(f):
+        if kind == ENTRY:
+            entry = pickle.loads(payload)
+            entries[entry['seq']] = entry
+        elif kind == ACK:
+            entries.pop(SEQ.unpack(payload)[0], None)
+    return [entries[x] for x in sorted(entries)]
+
+
+class Journal:
+    """
+    Append-only write-ahead journal of rows on their way to the database.
+
+    Every batch of rows is appended as one pickled, CRC-checked record before it is
+    written and acknowledged with a small ack record once the database committed it.
+    Records are flushed to the OS right away and synced to disk every
+    `fsync_every` entries or `fsync_interval` seconds. Each process writes its own
+    file and holds an exclusive lock on it, so `replay` can tell the journals of
+    crashed processes from live ones. Once the acknowledged records outgrow
+    `journal_max_bytes` the journal moves on to a new file holding only the entries
+    still open, so neither a long run nor an entry that is never acknowledged lets it
+    grow without limit. Journaling fails soft: an entry that cannot be written is
+    logged and its rows are written to the database without it.
+
+    Args:
+        folder (str): Folder of the journal files.
+        fsync_every (int): Records after which the file is synced to disk.
+        fsync_interval (float): Seconds after which the file is synced to disk.
+    """
+    def __init__(self, folder=journal_folder, fsync_every=journal_fsync_every, fsync_interval=journal_fsync_interval):
+        self.folder = folder
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        # Records of the entries not acknowledged yet, by sequence number
+        self._open = {}
+        self._open_bytes = 0
+        self.__open_file()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def __open_file(self):
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f'offers-{self.pid}-{time.time_ns()}.journal')
+        f = open(path, 'ab')
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.path, self._file = path, f
+
+    def __write(self, kind, payload, sync=False):
+        record = HEADER.pack(len(payload), zlib.crc32(payload), kind) + payload
+        self._file.write(record)
+        self._file.flush()
+        self._unsynced += 1
+        if sync or self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.__sync()
+        return record
+
+    def __sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, database, table, columns, values):
+        """
+        Journal rows before they are written.
+
+        Returns:
+            int: Sequence number of the entry, to be passed to `ack`. None if it could not be journaled.
+        """
+        with self._lock:
+            seq = next(self._seq)
+            entry = {'seq': seq, 'database': database, 'table': table, 'columns': list(columns), 'values': list(values)}
+            try:
+                record = self.__write(ENTRY, pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+            except OSError as e:
+                print('[PYTHON][JOURNAL][ERROR] Could not journal {} rows: {}'.format(len(entry['values']), e))
+                return None
+            self._open[seq] = record
+            self._open_bytes += len(record)
+            return seq
+
+    def ack(self, seq):
+        """Mark an entry as committed to the database."""
+        if seq is None:
+            return
+        with self._lock:
+            record = self._open.pop(seq, None)
+            if record is not None:
+                self._open_bytes -= len(record)
+            try:
+                self.__write(ACK, SEQ.pack(seq))
+                # Everything before the oldest open entry is settled, start over without it
+                if self._file.tell() - self._open_bytes > journal_max_bytes:
+                    self.__rotate()
+            except OSError as e:
+                # At worst the committed entry is replayed once more, as an upsert
+                print('[PYTHON][JOURNAL][ERROR] Could not acknowledge entry {}: {}'.format(seq, e))
+
+    def __rotate(self):
+        # The new file is complete on disk before the old one goes, a crash in between
+        # leaves the open entries in both files and replaying them twice is harmless
+        old_file, old_path = self._file, self.path
+        self.__open_file()
+        for seq in sorted(self._open):
+            self._file.write(self._open[seq])
+        self._file.flush()
+        self.__sync()
+        os.remove(old_path)
+        old_file.close()
+
+    def sync(self):
+        """Sync all records written so far to disk."""
+        with self._lock:
+            if self._unsynced:
+                self.__sync()
+
+
+def replay(mysql_obj, folder=journal_folder):
+    """
+    Write the unacknowledged entries of crashed processes for the database of `mysql_obj`.
+
+    Journals of processes that are still running are skipped. Entries are written as
+    upserts, so an entry whose commit succeeded right before the crash is harmless.
+    Journal files without any pending entries left are removed.
+
+    Returns:
+        int: Number of rows replayed.
+    """
+    rows = 0
+    for path in sorted(glob.glob(os.path.join(folder, 'offers-*.journal'))):
+        with open(path, 'r+b') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            entries = pending_entries(f)
+            replayed = 0
+            for entry in entries:
+                if entry['database'] != mysql_obj.database:
+                    continue
+                print('[PYTHON][JOURNAL] Replaying {} rows into {} from {}'.format(len(entry['values']), entry['table'], path))
+                mysql_obj.bulk_write(entry['table'], entry['columns'], entry['values'])
+                payload = SEQ.pack(entry['seq'])
+                f.seek(0, os.SEEK_END)
+                f.write(HEADER.pack(len(payload), zlib.crc32(payload), ACK) + payload)
+                f.flush()
+                os.fsync(f.fileno())
+                rows += len(entry['values'])
+                replayed += 1
+            if replayed == len(entries):
+                os.remove(path)
+    return rows
+
+
+_journal = None
+_replayed = set()
+_journal_lock = threading.Lock()
+
+def offer_journal(mysql_obj):
+    """
+    Return the journal of this process.
+
+    The first call for a database replays what crashed processes left for it.
+    Returns None if the journal folder cannot be written, rows are then written
+    without a journal.
+    """
+    global _journal
+    with _journal_lock:
+        if _journal is None or _journal.pid != os.getpid():
+            try:
+                _journal = Journal()
+            except OSError as e:
+                print('[PYTHON][JOURNAL][ERROR] No journal in {}: {}'.format(journal_folder, e))
+                return None
+        key = (mysql_obj.host, mysql_obj.database)
+        if key not in _replayed:
+            _replayed.add(key)
+            rows = replay(mysql_obj)
+            if rows:
+                print('[PYTHON][JOURNAL] Replayed {} rows'.format(rows))
+        return _journal
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import unicodedata
+import numpy as np
+
+# German umlauts are folded so that "Küche" and "Kueche" match each other; casefold() maps ß to ss
+UMLAUTS = (('ä', 'ae'), ('ö', 'oe'), ('ü', 'ue'))
+
+
+def normalize_text(text):
+    """
+    Normalize German text for keyword matching: NFC, case folding, umlaut folding
+    and collapsed whitespace.
+    """
+    if not isinstance(text, str) or not text:
+        return ''
+    if not unicodedata.is_normalized('NFC', text):
+        text = unicodedata.normalize('NFC', text)
+    text = text.casefold()
+    for umlaut, replacement in UMLAUTS:
+        text = text.replace(umlaut, replacement)
+    return ' '.join(text.split())
+
+def split_keywords(keywords):
+    """
+    Split keywords into a list of normalized keywords.
+
+    Args:
+        keywords (str/list): Comma separated keyword string of a search job or a list of keywords.
+    """
+    if not keywords:
+        return []
+    if isinstance(keywords, str):
+        keywords = keywords.split(',')
+    return [x for x in (normalize_text(x).strip() for x in keywords) if x]
+
+def offer_text(title, description):
+    """Return the normalized text of an offer that keywords are matched against."""
+    # The separator keeps keywords from matching across title and description
+    return normalize_text(title) + '\x00' + normalize_text(description)
+
+
+class KeywordAutomaton:
+    """
+    Finds which of many keywords occur in a text with a single scan.
+
+    All keywords are combined into one alternation, longest first. The text is scanned
+    left to right and after every hit the scan resumes one character after its start,
+    so overlapping keywords are found too. A shorter keyword starting at the same
+    position as a longer hit is always a prefix of it, so prefixes are added to every hit.
+
+    Args:
+        keywords (list[str]): Normalized keywords, matched literally.
+    """
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self.index = {x: i for i, x in enumerate(self.keywords)}
+        self.prefixes = {x: [self.index[y] for y in self.keywords if x.startswith(y)] for x in self.keywords}
+        ordered = sorted(self.keywords, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(x) for x in ordered)) if ordered else None
+
+    def finditer(self, text):
+        """Yield the keyword indices of every hit in a normalized text, in text order."""
+        if self.pattern is None or not text:
+            return
+        search = self.pattern.search
+        match = search(text)
+        while match:
+            yield self.prefixes[match.group()]
+            match = search(text, match.start() + 1)
+
+    def search(self, text):
+        """Return the indices of all keywords found in a normalized text."""
+        found = set()
+        for hit in self.finditer(text):
+            found.update(hit)
+        return found
+
+    def search_many(self, texts):
+        """Return a (texts x keywords) boolean matrix of keyword occurrences."""
+        hits = np.zeros((len(texts), len(self.keywords)), dtype=bool)
+        for row, text in enumerate(texts):
+            for col in self.search(text):
+                hits[row, col] = True
+        return hits
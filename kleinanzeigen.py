@@ -1,26 +1,43 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import re
 import misc
-from misc import dprint, compressed_pickle, clean_html, divide_chunks
-import time
+from misc import dprint
 import pandas as pd
-from webscraper import WebScraper
-import dateutil.parser as dparser
-import pgeocode
+from webscraper import WebScraper, browser_pool, get_fetcher, wait_for_egress
 import datetime
 import numpy as np
-from config import tmp_folder, timeout, chunk_size, mysql_columns, mysql_columns_err, mysql_types, mysql_types_err
+import config
+from config import timeout, chunk_size, mysql_columns, mysql_columns_err, mysql_types, mysql_types_err
 from mysql_wrapper import MySQL
-import os
-from bs4 import BeautifulSoup
-from timeout import time_limit
+import threading
+from contextlib import ExitStack, nullcontext
+from pipeline import Pipeline
+from offer_frame import OfferColumns
+from timeout import deadline, stage
+import metrics
+from journal import offer_journal
+from offer_parser import parse_offer
+from geocode import postal_code_table
+from seen_ids import seen_ids
+from error_index import error_index
+from crawl_state import CrawlState
+from search_url_cache import search_url_cache
+from selenium.webdriver.common.by import By
+
+# Offer scraping settings, optional in config.py
+scrape_concurrency = getattr(config, 'scrape_concurrency', 1)
+# Seconds to wait for elements of the search form
+search_wait_timeout = getattr(config, 'search_wait_timeout', 10)
+# Search pages buffered between crawling and scraping the offers
+pipeline_queue_size = getattr(config, 'pipeline_queue_size', 2)
 
 class Kleinanzeigen:
     # SEARCH_TEMPLATE_URL = 'https://www.kleinanzeigen.de/s-wohnung-kaufen/c196' # Buy Apartments
     SEARCH_TEMPLATE_URL = 'https://www.kleinanzeigen.de/s-wohnung-mieten/c203' # Rent Apartments
     OFFER_TEMPLATE_URL = 'https://www.kleinanzeigen.de/s-anzeige/{index}'
+    # Columns of the values written to the results table, see `offer_values`
+    OFFER_COLUMNS = ('title', 'postalcode', 'description', 'state', 'state_code', 'place', 'price', 'size', 'rooms', 'floor', 'date', 'id', 'timestamp')
     OFFERS_PER_PAGE = 25
 
     def runner(MySQL_DB, postalcode, radius, tablename=None, exclude_ids=None):
@@ -34,126 +51,259 @@ class Kleinanzeigen:
         mysql_obj.create_table(mysql_table_err, mysql_columns_err, mysql_types_err)
         mysql_obj.create_table(mysql_table, mysql_columns, mysql_types)
         
-        offers_in_database = mysql_obj.get_table(mysql_table, ['id', 'date'], 
-                                                 sort_by='id', 
-                                                 max_entries=100, 
-                                                 descending=True)
-        
-        ids_in_database = [x[0] for x in offers_in_database]
-        new_offers = Kleinanzeigen.get_search_offers(postalcode=postalcode, 
-                               radius=radius, 
-                               max_number=100, 
-                               end_index=ids_in_database,
-                               exclude_ids=exclude_ids)
-
-
-
-        Kleinanzeigen.offers_to_mysql(offers= new_offers,
-                                      mysql_obj=mysql_obj, 
-                                      mysql_table=mysql_table,
-                                      mysql_table_err=mysql_table_err)
+        # The crawl stops at offers known from the crawl state, which only completed crawls advance.
+        # Offers are written newest page first, so the highest ids in the table may come from an
+        # interrupted crawl with older new offers still unwritten and must not end the next crawl.
+        crawl_state = CrawlState(mysql_obj, CrawlState.query_key(f"{Kleinanzeigen.SEARCH_TEMPLATE_URL}|{mysql_table}", postalcode, radius))
+        Kleinanzeigen.crawl_to_mysql(mysql_obj=mysql_obj,
+                                     mysql_table=mysql_table,
+                                     mysql_table_err=mysql_table_err,
+                                     postalcode=postalcode,
+                                     radius=radius,
+                                     max_number=100,
+                                     crawl_state=crawl_state,
+                                     exclude_ids=exclude_ids)
+        crawl_state.save()
 
     @classmethod
-    def create_df(cls, postalcode=None, radius=None, pages=None, end_index=None, max_number=None):
+    def create_df(cls, postalcode=None, radius=None, pages=None, end_index=None, max_number=None, parquet_path=None):
         """
         Args:
             postalcode (str): The postal code to search for properties.
             radius (int): The search radius in kilometers from the given postal code.
             pages (list[int]): List of page numbers to scrape.
             end_index (int): The end index to stop scraping.
+            parquet_path (str): Parquet file to stream the offers into instead of returning
+                a DataFrame, for crawls too large to hold in memory. Needs pyarrow.
             
         Returns:
-            pd.DataFrame: DataFrame containing the scraped property listings.
+            pd.DataFrame: DataFrame containing the scraped property listings, None if
+                written to `parquet_path`.
         """
-        webdriver = WebScraper()
-        offers = cls.SearchPage(webdriver= webdriver, 
-                                postalcode=postalcode, 
-                                radius=radius, 
-                                pages=pages, 
-                                end_index=end_index, 
-                                max_number=max_number)
-        df = pd.concat([cls.OfferPage(webdriver, i).to_df() for i in offers.offers_indices], ignore_index=True)
-        webdriver.shutdown()
-        return df
+        with browser_pool().session() as webdriver, OfferColumns(parquet_path) as columns:
+            fetcher = get_fetcher(webdriver)
+            offers = cls.SearchPage(webdriver= webdriver, 
+                                    postalcode=postalcode, 
+                                    radius=radius, 
+                                    pages=pages, 
+                                    end_index=end_index, 
+                                    max_number=max_number,
+                                    fetcher=fetcher,
+                                    lazy=True)
+            for offer_indices_i in offers.iter_pages():
+                for i in offer_indices_i:
+                    columns.append(cls.OfferPage(fetcher, i))
+            if parquet_path:
+                print('[PYTHON][KLEINANZ][CREATE_DF] Wrote {} offers to {}'.format(columns.rows, parquet_path))
+                return None
+            return columns.to_df()
         
     
     @classmethod
-    def get_search_offers(cls, postalcode=None, radius=None, pages=None, end_index=None, max_number=None):
-        webdriver = WebScraper()
-        offers = cls.SearchPage(webdriver, postalcode, radius, pages=pages, end_index=end_index, max_number=max_number)
+    def get_search_offers(cls, postalcode=None, radius=None, pages=None, end_index=None, max_number=None, crawl_state=None):
+        with browser_pool().session() as webdriver, metrics.timed('search'):
+            offers = cls.SearchPage(webdriver, postalcode, radius, pages=pages, end_index=end_index, max_number=max_number,
+                                    fetcher=get_fetcher(webdriver), crawl_state=crawl_state)
         print('[PYTHON][KLEINANZ][GET_OFFERS][PROGRESS] New offers: {}'.format(offers))
-        webdriver.shutdown()
         return offers
 
     @classmethod
-    def offers_to_mysql(cls, offers, mysql_obj, mysql_table, mysql_table_err, exclude_ids=None):
+    def offers_to_mysql(cls, offers, mysql_obj, mysql_table, mysql_table_err, exclude_ids=None, fetchers=None):
         """
         Args:
-            postalcode (str): The postal code to search for properties.
-            radius (int): The search radius in kilometers from the given postal code.
-            pages (list[int]): List of page numbers to scrape.
-            end_index (int): The end index to stop scraping.
-            max_number (int): Maximum number of entries to write.
+            offers (SearchPage): Crawled search pages holding the offers to scrape.
+            mysql_obj (MySQL): Database to write to.
+            mysql_table (str): Table of the scraped offers.
+            mysql_table_err (str): Table of the offers that failed to scrape.
+            exclude_ids (list[int]): Offers not to scrape.
+            fetchers (list): Fetchers to scrape the offers with, one per concurrent worker.
+                Taken from the free browsers of the pool if not given.
             
         Returns:
             None
         """
-        columns = ('title', 'postalcode', 'description', 'state', 'state_code', 'place', 'price', 'size', 'rooms', 'floor', 'date', 'id', 'timestamp')
-
-        error_offers = [int(x[0]) for x in mysql_obj.get_table(mysql_table_err, 'id')]
-        offers_in_database = [int(x[0]) for x in mysql_obj.get_table(mysql_table, 'id')]
-        dprint(f"[PYTHON][KLEINANZ][TO_MYSQL] Offers already in database: {[x for x in offers.offers_indices if x in (offers_in_database + error_offers)]}")
-        if not exclude_ids:
-            offers = [x for x in offers.offers_indices if x not in (offers_in_database + error_offers)]
-        elif exclude_ids:
-            offers = [x for x in offers.offers_indices if x not in (offers_in_database + error_offers + exclude_ids)]
-            
-        
-        offers = offers[::-1]
-
-        total_offers = len(offers)
-        chunked_offers = divide_chunks(offers, chunk_size)
-        print('[PYTHON][KLEINANZ][TO_MYSQL][PROGRESS] Scraping total {} offers divided with chunksize of {} '.format(total_offers, chunk_size))
-        if len(chunked_offers) > 0:
-            webdriver = WebScraper()
-            for offers_i in chunked_offers:
-                print('[PYTHON][KLEINANZ][TO_MYSQL][PROGRESS] Scraping offers: {}'.format(len(offers_i)))
-                print(offers_i)
-                values = []
-                offer_num = 0
-                for i in offers_i:
-                    try:
-                        with time_limit(timeout):
-                            offer = cls.OfferPage(webdriver, i)
-                            values_i = (
-                                offer.title, offer.postalcode, offer.description, offer.state, offer.state_code, offer.place, offer.price, offer.size,
-                                offer.rooms, offer.floor, offer.date.date(), offer.index, datetime.datetime.now()
-                            )
-                            values.append(values_i)
-                            print('[PYTHON][KLEINANZ][TO_MYSQL][Progress] Offer: {current}/{max}'.format(current=offer_num+1, max=len(offers_i)))
-                            offer_num += 1
-                            del offer
-                        # subprocess.run('kill $(pgrep -f chromium)')
-                    except Exception as e:
-                        mysql_obj.write_list(mysql_table_err, ('id'), [[i]])
-                        print('[PYTHON][KLEINANZ][TO_MYSQL][ERROR]', i, e)
-                
-                if len(values)>0:
-                    tmp_filename = "sql_data"+'-'+str(datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
-                    tmp_file = tmp_folder + '/' + tmp_filename
-                    print('[PYTHON][KLEINANZ] Writing tmp file: {}'.format(tmp_file+'.pbz2'))
+        # One browser (and fetcher) per concurrent worker, as many as the pool has free
+        with ExitStack() as stack:
+            if not fetchers:
+                workers = max(1, min(scrape_concurrency, browser_pool().size))
+                webdrivers = stack.enter_context(browser_pool().sessions(workers))
+                fetchers = [get_fetcher(x) for x in webdrivers]
+            # Oldest offers first, an interrupted run leaves the newest ones to be found again
+            cls.stream_to_mysql([offers.offers_indices[::-1]], mysql_obj, mysql_table, mysql_table_err, fetchers,
+                                exclude_ids=exclude_ids)
+
+    @classmethod
+    def crawl_to_mysql(cls, mysql_obj, mysql_table, mysql_table_err, postalcode=None, radius=None, pages=None,
+                       end_index=None, max_number=None, crawl_state=None, exclude_ids=None):
+        """
+        Crawl the search pages and scrape their new offers into the database while paging goes on.
+
+        The search pages are crawled on a browser of their own, the offers on up to
+        `scrape_concurrency` more, as many as the browser pool has free. With only one
+        browser free, search pages and offers take turns on the same browser.
+
+        Unlike `offers_to_mysql` the offers are written as they are scraped, newest page
+        first, so an interrupted crawl can leave older new offers unwritten behind written
+        newer ones. `end_index` must therefore only hold ids of completed crawls, never
+        the highest ids of the table; the crawl state only advances on a completed crawl.
+
+        Args:
+            mysql_obj (MySQL): Database to write to.
+            mysql_table (str): Table of the scraped offers.
+            mysql_table_err (str): Table of the offers that failed to scrape.
+            postalcode, radius, pages, end_index, max_number, crawl_state: See `SearchPage`.
+            exclude_ids (list[int]): Offers not to scrape.
+
+        Returns:
+            list[int]: Offer ids listed on the crawled search pages.
+        """
+        pool = browser_pool()
+        with ExitStack() as stack, metrics.timed('crawl'):
+            # All browsers are taken in one step, a crawl never waits for more while holding some
+            workers = max(1, min(scrape_concurrency, pool.size - 1))
+            webdriver, *webdrivers = stack.enter_context(pool.sessions(1 + workers))
+            fetcher = get_fetcher(webdriver)
+            if webdrivers:
+                fetchers, lock = [get_fetcher(x) for x in webdrivers], None
+            else:
+                fetchers, lock = [fetcher], threading.Lock()
+            offers = cls.SearchPage(webdriver, postalcode, radius, pages=pages, end_index=end_index, max_number=max_number,
+                                    fetcher=fetcher, crawl_state=crawl_state, lazy=True, lock=lock)
+            offer_ids = cls.stream_to_mysql(offers.iter_pages(), mysql_obj, mysql_table, mysql_table_err, fetchers,
+                                            exclude_ids=exclude_ids, lock=lock)
+        # Only a crawl whose offers were all handled moves the crawl state on, a retry crawls the same pages
+        offers.update_crawl_state()
+        return offer_ids
+
+    @classmethod
+    def stream_to_mysql(cls, pages, mysql_obj, mysql_table, mysql_table_err, fetchers, exclude_ids=None, lock=None):
+        """
+        Scrape the new offers of a stream of search pages into the database.
+
+        Runs as a pipeline of threads connected by bounded queues: the search pages are
+        consumed, deduplicated against the database, fetched and parsed with one worker
+        per fetcher and written in chunks of `chunk_size` from the calling thread. Failed
+        offers go to the error index, offers due for a retry are scraped after the last
+        page. Offers are fetched while later pages are still crawled and at most a few
+        pages and chunks are held in memory at any time.
+
+        Args:
+            pages (iterable): Offer ids of every search page, see `SearchPage.iter_pages`.
+            mysql_obj (MySQL): Database to write to.
+            mysql_table (str): Table of the scraped offers.
+            mysql_table_err (str): Table of the offers that failed to scrape.
+            fetchers (list): Fetchers to scrape the offers with, one per worker.
+            exclude_ids (list[int]): Offers not to scrape.
+            lock (threading.Lock): Held around every offer, when the fetchers share the browser of the search pages.
+
+        Returns:
+            list[int]: Offer ids listed on the search pages.
+        """
+        columns = cls.OFFER_COLUMNS
+        journal = offer_journal(mysql_obj)
+        seen_results = seen_ids(mysql_obj, mysql_table)
+        errors = error_index(mysql_obj, mysql_table_err)
+        exclude_ids = set(exclude_ids or ())
+        listed = []
+        retried = set()
+
+        def sources():
+            for offer_indices in pages:
+                yield offer_indices, False
+            # Failed offers due for a retry are scraped along, they may no longer be listed
+            due = errors.claim_due()
+            if due:
+                print('[PYTHON][KLEINANZ][TO_MYSQL][PROGRESS] Retrying offers: {}'.format(due))
+                yield due, True
+
+        def dedup(item):
+            candidates, retry = item
+            new_offers = seen_results.filter_new(candidates)
+            new_offers = [x for x in new_offers if x not in exclude_ids]
+            if retry:
+                # Claimed retries that are written already or excluded are settled, not left claimed
+                new_offers_set = set(new_offers)
+                errors.resolve(x for x in candidates if x not in new_offers_set)
+                retried.update(new_offers)
+            else:
+                listed.extend(candidates)
+                new_offers = errors.filter_new(new_offers)
+            new_offers_set = set(new_offers)
+            dprint(f"[PYTHON][KLEINANZ][TO_MYSQL] Offers already in database: {[x for x in candidates if x not in new_offers_set]}")
+            print('[PYTHON][KLEINANZ][TO_MYSQL][PROGRESS] New offers: {}'.format(len(new_offers)))
+            return new_offers
+
+        def scraper(fetcher):
+            def scrape(i):
+                with lock or nullcontext():
                     try:
-                        compressed_pickle(tmp_file, values)
+                        # The deadline starts once the fetcher is free and a block pause is over,
+                        # waiting for them does not count
+                        wait_for_egress(cls.OFFER_TEMPLATE_URL)
+                        with deadline(timeout):
+                            result = cls.scrape_offer(fetcher, i)
                     except Exception as e:
-                        print('[PYTHON][KLEINANZ][TO_MYSQL][ERROR]', e)        
-                    mysql_obj.write_list(mysql_table, columns, values)
-                    print('[PYTHON][KLEINANZ] Deleting tmp file: {}'.format(tmp_file+'.pbz2'))
-                    os.remove(tmp_file+'.pbz2')
-                else:
-                    print('[PYTHON][KLEINANZ] No offers scraped / to add')
-            webdriver.shutdown()
-        else:
+                        result = e
+                return [(i, result)]
+            return scrape
+
+        def write(values):
+            # Journaled first, a chunk lost by a crash before the commit is written on the next start
+            seq = journal.append(mysql_obj.database, mysql_table, columns, values) if journal else None
+            mysql_obj.bulk_write(mysql_table, columns, values)
+            # A chunk that failed to commit stays open in the journal and is replayed on the next start
+            if journal:
+                journal.ack(seq)
+            ids = [x[columns.index('id')] for x in values]
+            seen_results.add(ids)
+            errors.resolve(x for x in ids if x in retried)
+
+        pipeline = Pipeline(sources(), maxsize=pipeline_queue_size) \
+            .then(dedup, maxsize=len(fetchers)) \
+            .then([scraper(x) for x in fetchers], maxsize=chunk_size)
+        values = []
+        failures = []
+        offer_num = 0
+        for i, result in pipeline:
+            if isinstance(result, Exception):
+                metrics.inc('scraper_offers_total', result='error')
+                failures.append((i, result))
+                print('[PYTHON][KLEINANZ][TO_MYSQL][ERROR]', i, result)
+            else:
+                metrics.inc('scraper_offers_total', result='ok')
+                values.append(result)
+                offer_num += 1
+                print('[PYTHON][KLEINANZ][TO_MYSQL][Progress] Offer: {}'.format(offer_num))
+            if len(values) + len(failures) >= chunk_size:
+                if values:
+                    write(values)
+                errors.record(failures)
+                values, failures = [], []
+        errors.record(failures)
+        if values:
+            write(values)
+        elif offer_num == 0:
             print('[PYTHON][KLEINANZ][TO_MYSQL][PROGRESS] No new offers found')
+        return listed
+
+    @classmethod
+    def scrape_offer(cls, fetcher, offer_index):
+        """
+        Fetch and parse one offer page.
+
+        Returns:
+            tuple: The offer values in the column order written by `offers_to_mysql`.
+        """
+        offer = cls.OfferPage(fetcher, offer_index)
+        return cls.offer_values(offer)
+
+    @staticmethod
+    def offer_values(offer):
+        """Return the values of a parsed OfferPage in the order of OFFER_COLUMNS."""
+        return (
+            offer.title, offer.postalcode, offer.description, offer.state, offer.state_code, offer.place, offer.price, offer.size,
+            offer.rooms, offer.floor, offer.date.date(), offer.index, misc.local_now()
+        )
 
     class SearchPage():
         """
@@ -165,55 +315,93 @@ class Kleinanzeigen:
             pages (list[int]): List of page numbers to scrape.
             end_index (int/list): The end index to stop scraping.
             max_number (int): Maximum number of entries to scrape.
+            fetcher (WebScraper/HTTPFetcher/FallbackFetcher): Backend loading the result pages,
+                defaults to the webdriver.
+            crawl_state (CrawlState): Stored state of the previous crawl of this query. Paging
+                stops after the first page without new offers and the state is advanced in memory.
+            lazy (bool): Do not crawl on creation, the pages are crawled by iterating `iter_pages`.
+            lock (threading.Lock): Held while a page is loaded, when the fetcher is shared with other threads.
         
         Attributes:
-            end_index (int): The end index to stop scraping.
+            end_index (set[int]): Offer ids at which to stop scraping.
             postalcode (str): The postal code to search for properties.
             radius (int): The search radius in kilometers from the given postal code.
             url_search_page (str): The URL for the search page based on postal code and radius.
             pages (list[int]): List of page numbers to scrape.
             max_number (int): Maximum number of entries to scrape.
-            offers_indices (list[int]): List of indices of scraped property offers.
+            offers_indices (list[int]): List of indices of scraped property offers, empty if lazy.
         """
-        def __init__(self, webdriver , postalcode, radius=None, pages=None, end_index=None, max_number=None):
+        def __init__(self, webdriver , postalcode, radius=None, pages=None, end_index=None, max_number=None, fetcher=None, crawl_state=None,
+                     lazy=False, lock=None):
             self.driver = webdriver
-            self.end_index = end_index
+            self.fetcher = fetcher or webdriver
+            self.end_index = {end_index} if isinstance(end_index, int) else set(end_index or ())
+            self.crawl_state = crawl_state
+            self.lock = lock or nullcontext()
             self.postalcode = postalcode
             self.radius = radius
             self.url_search_page = self.__get_index_page_url()
             self.pages = pages
             self.max_number = max_number
             self.offers_indices = []
-            self.__init_search_pages()
+            self.first_page_indices = None
+            self.newest = None
+            if not lazy:
+                for offer_indices_i in self.iter_pages():
+                    self.offers_indices += offer_indices_i
+                self.update_crawl_state()
 
         def __get_index_page_url(self):
+            """Return the search URL template for the postal code, resolving it with the search form once."""
+            url = search_url_cache().get(Kleinanzeigen.SEARCH_TEMPLATE_URL, self.postalcode)
+            if url:
+                dprint(url)
+                return url
+
             # page = WebScraper(Kleinanzeigen.SEARCH_TEMPLATE_URL)
             self.driver.url(Kleinanzeigen.SEARCH_TEMPLATE_URL)
-            time.sleep(2)
-            try:
-                self.driver.click_button_id("gdpr-banner-accept")
-                time.sleep(2)
-            except:
+            # A reused browser has accepted the consent banner before, only a banner that is there is waited for
+            if self.driver.is_present(By.ID, "gdpr-banner-accept"):
+                try:
+                    self.driver.wait_for_clickable(By.ID, "gdpr-banner-accept", timeout=search_wait_timeout).click()
+                    self.driver.wait_for_invisible(By.ID, "gdpr-banner-accept", timeout=search_wait_timeout)
+                except Exception:
+                    print('[PYTHON][KLEINANZ][SEARCH_PAGE][WARNING] Consent banner not dismissed')
+            else:
                 print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] No Popup')
             try:
                 self.driver.click_button_xpath('//*[@id="site-signin"]/div/div/a')
             except:
                 print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] No Popup')
             if self.postalcode:
-                self.driver.fill_form_id("site-search-area", self.postalcode)
-            self.driver.click_button_xpath('//*[@id="site-search-submit"]')
+                self.driver.wait_for_clickable(By.ID, "site-search-area", timeout=search_wait_timeout).send_keys(self.postalcode)
+            category_url = self.driver.get_current_url()
+            self.driver.wait_for_clickable(By.XPATH, '//*[@id="site-search-submit"]', timeout=search_wait_timeout).click()
+            self.driver.wait_for_url_change(category_url, timeout=search_wait_timeout)
             url = self.driver.get_current_url()
             url = url.replace('//', '<<<<')
             url = url.split('/')
             url.insert(-1, "seite:{page}")
             url = '/'.join(url).replace('<<<<', '//')
             dprint(url)
+            search_url_cache().set(Kleinanzeigen.SEARCH_TEMPLATE_URL, self.postalcode, url)
             return url
 
-        def __init_search_pages(self):
+        def iter_pages(self):
+            """
+            Crawl the search pages one after another.
+
+            Stops at the same conditions as the eager crawl. The crawl state is not advanced,
+            see `update_crawl_state`.
+
+            Yields:
+                list[int]: Offer ids of every page in listing order, without top ads.
+            """
             i = 0
             page_i = 0
             max_page = None
+            previous_url = None
+            number = 0
             while True:
                 # Determine the current page number to scrape
                 if self.pages:
@@ -228,17 +416,26 @@ class Kleinanzeigen:
                 else:
                     url_i = self.url_search_page.format(page=page_i)
 
-                previous_url = self.driver.current_url()
+                # The URL of the previously crawled page, a redirect back to it ends the search
                 dprint(f"[PYTHON][KLEINANZ][SEARCH_PAGE] Previous URL: {previous_url}")
                 dprint(f"[PYTHON][KLEINANZ][SEARCH_PAGE] Constructed URL: {url_i}")
-                self.driver.url(url_i)
-                redirect_url = self.driver.current_url()
+                with self.lock:
+                    self.fetcher.url(url_i)
+                    redirect_url = self.fetcher.current_url()
+                    content = self.fetcher.content() if previous_url != redirect_url else None
                 dprint(f"[PYTHON][KLEINANZ][SEARCH_PAGE] Current URL: {redirect_url}")
-                if previous_url == redirect_url:
+                if content is None:
                     print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] End of search pages reached.')
                     break
-
-                offer_indices_i = self.__get_offer_index(self.driver.content().split('\n'))
+                previous_url = redirect_url
+
+                offer_indices_i = self.__get_offer_index(content.split('\n'))
+                del content
+                if page_i == 1 and not offer_indices_i:
+                    # A stale cached search URL is resolved again with the search form on the next run
+                    search_url_cache().invalidate(Kleinanzeigen.SEARCH_TEMPLATE_URL, self.postalcode)
+                if self.crawl_state and page_i == 1:
+                    self.first_page_indices = list(offer_indices_i)
                 # dprint('max_page: {}'.format(max_page))
                 # if not max_page:
                 #     max_page = self.__get_max_page(self.driver.content())
@@ -246,19 +443,28 @@ class Kleinanzeigen:
                 # print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] Page: {page_i}/{max_page}'.format(page_i=page_i, max_page = max_page))
                 print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] Page: {page_i}'.format(page_i=page_i))
                 # print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] Current max page:', )
-                self.offers_indices += offer_indices_i
+
+                # Offers beyond max_number are never handed out
+                page_offers = offer_indices_i
+                if self.max_number:
+                    page_offers = page_offers[:max(self.max_number - number, 0)]
+                number += len(page_offers)
+                if page_offers:
+                    self.newest = max(page_offers + ([self.newest] if self.newest else []))
+                yield page_offers
 
                 # Check if end_index condition is met
-                if self.end_index:
-                    if type(self.end_index) == int:
-                        self.end_index = [self.end_index]
-                    if any(x in self.end_index for x in offer_indices_i):
-                        print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] End index found')
-                        break
+                if self.end_index and not self.end_index.isdisjoint(offer_indices_i):
+                    print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] End index found')
+                    break
+
+                # Check if the page holds no offers newer than the previous crawl
+                if self.crawl_state and self.crawl_state.is_known_page(offer_indices_i, first_page=(page_i == 1)):
+                    print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] Known offers reached')
+                    break
 
                 # Check if max_number condition is met
-                if self.max_number and len(self.offers_indices) >= self.max_number:
-                    self.offers_indices = self.offers_indices[:self.max_number]
+                if self.max_number and number >= self.max_number:
                     print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] Max number of entries reached')
                     break
 
@@ -266,6 +472,11 @@ class Kleinanzeigen:
                 if page_i == max_page or (self.pages and i == len(self.pages)):
                     print('[PYTHON][KLEINANZ][SEARCH_PAGE][PROGRESS] Max page number reached')
                     break
+
+        def update_crawl_state(self):
+            """Advance the crawl state in memory with the crawled pages, once their offers are handled."""
+            if self.crawl_state:
+                self.crawl_state.update([self.newest] if self.newest else [], self.first_page_indices)
         
         # def __get_max_page(self, content):
         #     total_offers = misc.get_floats(misc.get_lines(content.split('\n'), "breadcrump-summary")[0][0])[-1] # -2 for buying. DEBUG - FIX NEEDED
@@ -275,54 +486,64 @@ class Kleinanzeigen:
         #     return int(max_page)
         
         def __get_offer_index(self, content, filter_out_top=True):
-            self.offer_lines = misc.get_lines(content, 'data-adid=')[1]
+            offer_lines = misc.get_lines(content, 'data-adid=')[1]
             if filter_out_top:
                 top_lines = misc.get_lines(content, 'badge-topad is-topad')[1]
-                self.offer_lines = [x for x in self.offer_lines if x-1 not in top_lines]
+                offer_lines = [x for x in offer_lines if x-1 not in top_lines]
             
-            return [int(misc.get_numbers(content[x].split()[2])[0]) for x in self.offer_lines]   
+            return [int(misc.get_numbers(content[x].split()[2])[0]) for x in offer_lines]   
 
     class OfferPage:
         """
         Represents the offer page of Kleinanzeigen.
 
+        The page is fetched and parsed on creation. Only the extracted fields are kept,
+        in slots, the page source and the raw details are dropped once parsed, so a
+        parsed offer takes a few hundred bytes instead of the size of its page.
+
         Args:
             offer_index (int): The index of the offer to retrieve details for.
-            webdriver (WebScraper object)
+            webdriver (WebScraper object or any fetcher providing `fetch(url)`)
 
         Attributes:
             index (int): The index of the offer.
             url (str): The URL of the offer page.
-            content (list[str]): The content of the offer page.
             title (str): The title of the offer.
+            description (str): The description of the offer.
             date (datetime): The date of the offer.
             price (float): The price of the offer.
             postalcode (int): The postal code of the property.
             state (str): The state of the property location.
             state_code (str): The state code of the property location.
             place (str): The city or place of the property.
+            latitude (float): Mean latitude of the postal code area.
+            longitude (float): Mean longitude of the postal code area.
             size (int): The size of the property in square meters.
             rooms (float): The number of rooms in the property.
             floor (int): The floor of the property.
             build_year (int): The year the property was built.
         """
+        __slots__ = ('index', 'title', 'description', 'date', 'day', 'month', 'year', 'price', 'postalcode',
+                     'state', 'state_code', 'place', 'latitude', 'longitude', 'size', 'rooms', 'floor', 'build_year')
+
         def __init__(self, webdriver, offer_index):
             # Initialize instance variables
             self.index = offer_index
-            self.url = Kleinanzeigen.OFFER_TEMPLATE_URL.format(index=self.index)
-            self.driver = webdriver
-            self.__get_offer_content()
+            with stage('fetch'), metrics.timed('fetch'):
+                content_raw = self.__get_offer_content(webdriver)
             self.__set_details_NULL()  # Set initial details to None
-            self.__get_title()
-            self.__get_description()
-            self.__get_date()
-            self.__get_price()
-            self.__get_postalcode()
-            self.__get_city()
-            self.__get_all_details()
-            self.__get_filtered_details()
+            with stage('parse'), metrics.timed('parse'):
+                details = self.__parse_content(content_raw)
+            del content_raw
+            with stage('geocode'), metrics.timed('geocode'):
+                self.__get_city()
+            self.__get_filtered_details(details)
             self.__print()
 
+        @property
+        def url(self):
+            return Kleinanzeigen.OFFER_TEMPLATE_URL.format(index=self.index)
+
         def __set_details_NULL(self):
             """Set initial values of details attributes to None."""
             self.size = None
@@ -330,97 +551,76 @@ class Kleinanzeigen:
             self.floor = None
             self.build_year = None
 
-        def __get_offer_content(self):
-            """Get the content of the offer page using a WebScraper instance."""
+        def __get_offer_content(self, webdriver):
+            """Return the content of the offer page using a WebScraper or fetcher instance."""
             # page = WebScraper(self.url)
-            self.driver.url(self.url)
-            self.content_raw = self.driver.content()
-            self.content = self.content_raw.split('\n')
-
-        def __get_title(self):
-            """Extract and store the title of the offer."""
-            self.title = misc.get_lines(self.content, '<title>')[0][0].split(sep='>')[1].split(sep='<')[0].split('|')[0]
+            return webdriver.fetch(self.url)
+
+        def __parse_content(self, content_raw):
+            """Extract title, date, price, postal code and description in one pass, return the raw details."""
+            parsed = parse_offer(content_raw)
+            if parsed['title'] is None:
+                raise ValueError('No title found: {}'.format(self.index))
+            self.title = parsed['title']
+
+            if parsed['description'] is not None:
+                self.description = parsed['description']
+            else:
+                print('[PYTHON][KLEINANZ][OFFER_PAGE][DESCRIPTION][WARNING] No description found')
 
-        def __get_date(self):
-            """Extract and store the date of the offer."""
-            self.date = dparser.parse(misc.get_lines(self.content, 'icon icon-small icon-calendar-gray-simple')[0][0], fuzzy=True, dayfirst=True)
+            if parsed['date'] is None:
+                raise ValueError('No date found: {}'.format(self.index))
+            self.date = parsed['date']
             self.day = self.date.day
             self.month = self.date.month
             self.year = self.date.year
 
-        def __get_price(self):
-            """Extract and store the price of the offer."""
-            try:
-                num1 = misc.get_numbers(misc.get_lines(self.content, 'adPrice:')[0][0])[0]
-                num2 = misc.get_numbers(misc.get_lines(self.content, 'adPrice:')[0][0])[1]
-                self.price = float(int(num1) + (int(num2) / 100))
-            except:
+            if parsed['price'] is not None:
+                self.price = parsed['price']
+            else:
                 print('[PYTHON][KLEINANZ][OFFER_PAGE][POSTALCODE][WARNING] No Price found: {}'.format(self.index))
 
-        def __get_postalcode(self):
-            """Extract and store the postal code of the property."""
-            adress_index = misc.get_lines(self.content, 'initMap')[1][0] + 1
-            self.adress_line = self.content[adress_index]
-            try:
-                number = (re.findall(r"\D(\d{5})\D", " " + self.adress_line + " "))[0]
-                self.postalcode = int(number)
-            except:
-                print('[PYTHON][KLEINANZ][OFFER_PAGE][POSTALCODE][WARNING] Not type(int): {}'.format(number))
-
-        def __get_description(self):
-            try:
-                parsed_html = BeautifulSoup(self.content_raw,"html.parser")
-                data = parsed_html.find('meta', attrs={'itemprop': 'description'})
-                description_raw = data['content'] if data else None
-                if not description_raw:
-                    data = parsed_html.find('p', class_='text-force-linebreak', id='viewad-description-text')
+            if parsed['address_line'] is None:
+                raise ValueError('No address found: {}'.format(self.index))
+            if parsed['postalcode'] is None:
+                raise ValueError('No postal code found: {}'.format(parsed['address_line']))
+            self.postalcode = parsed['postalcode']
 
-                    # Extract the text
-                    description_raw = data.get_text(strip=True)
-                description = clean_html(description_raw)
-                self.description = description
-
-            except:
-                print('[PYTHON][KLEINANZ][OFFER_PAGE][DESCRIPTION][WARNING] No description found')
+            return parsed['details']
 
         def __get_city(self):
-            """Query and store the state, state code, and city of the property location."""
-            data = pgeocode.Nominatim('de').query_postal_code(str(self.postalcode))
+            """Look up and store the state, state code, city and coordinates of the property location."""
+            data = postal_code_table().query(self.postalcode)
             self.state = data['state_name']
             self.place = data['place_name']
             self.state_code = data['state_code']
+            self.latitude = data['latitude']
+            self.longitude = data['longitude']
 
-        def __get_all_details(self):
-            """Extract and store all details of the property."""
-            details = [x.split(sep='<')[0].split()[0] for x in misc.get_lines(self.content, '<span class="addetailslist--detail--value">')[0]]
-            value_lines = [x + 1 for x in misc.get_lines(self.content, '<span class="addetailslist--detail--value">')[1]]
-            values = [' '.join(self.content[x].split(sep='<')[0].split()) for x in value_lines]
-            self.details = dict(zip(details, values))
-
-        def __get_filtered_details(self):
+        def __get_filtered_details(self, details):
             """Extract and store specific details of the property with data type conversion."""
-            keys = list(self.details.keys())
+            keys = list(details.keys())
 
             if 'Wohnfläche' in keys:
                 try:
-                    self.size = int(misc.get_numbers(self.details['Wohnfläche'])[0])
+                    self.size = int(misc.get_numbers(details['Wohnfläche'])[0])
                 except:
-                    print('[PYTHON][KLEINANZ][OFFER_PAGE][ROOMS][WARNING] Not type(int): {}'.format(misc.get_numbers(self.details['Wohnfläche'])[0]))
+                    print('[PYTHON][KLEINANZ][OFFER_PAGE][ROOMS][WARNING] Not type(int): {}'.format(misc.get_numbers(details['Wohnfläche'])[0]))
             if 'Zimmer' in keys:
                 try:
-                    self.rooms = float(self.details['Zimmer'].replace(',', '.'))
+                    self.rooms = float(details['Zimmer'].replace(',', '.'))
                 except:
-                    print('[PYTHON][KLEINANZ][OFFER_PAGE][ROOMS][WARNING] Not type(float): {}'.format(self.details['Zimmer']))
+                    print('[PYTHON][KLEINANZ][OFFER_PAGE][ROOMS][WARNING] Not type(float): {}'.format(details['Zimmer']))
             if 'Etage' in keys:
                 try:
-                    self.floor = int(self.details['Etage'])
+                    self.floor = int(details['Etage'])
                 except:
-                    print('[PYTHON][KLEINANZ][OFFER_PAGE][FLOOR][WARNING] Not type(int): {}'.format(self.details['Etage']))
+                    print('[PYTHON][KLEINANZ][OFFER_PAGE][FLOOR][WARNING] Not type(int): {}'.format(details['Etage']))
             if 'Baujahr' in keys:
                 try:
-                    self.build_year = int(self.details['Baujahr'])
+                    self.build_year = int(details['Baujahr'])
                 except:
-                    print('[PYTHON][KLEINANZ][OFFER_PAGE][BUILD_YEAR][WARNING] Not type(int): {}'.format(self.details['Baujahr']))
+                    print('[PYTHON][KLEINANZ][OFFER_PAGE][BUILD_YEAR][WARNING] Not type(int): {}'.format(details['Baujahr']))
 
         def __print(self):
             """Print a completion message with the offer index."""
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import bisect
+import datetime
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import config
+
+# Metrics settings, optional in config.py. The HTTP endpoint is only started with a port
+# and JSON logs are only written with a log file.
+metrics_port = getattr(config, 'metrics_port', None)
+metrics_host = getattr(config, 'metrics_host', '127.0.0.1')
+metrics_log_file = getattr(config, 'metrics_log_file', None)
+
+# Upper bounds of the latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+HELP = {
+    'scraper_stage_seconds': 'Duration of pipeline stages',
+    'scraper_stage_errors_total': 'Pipeline stages that raised',
+    'scraper_pages_total': 'Pages loaded',
+    'scraper_challenges_total': 'Bot-challenge pages answered by the HTTP backend',
+    'scraper_responses_total': 'Responses by outcome of the rate control',
+    'scraper_request_rate': 'Requests per second currently allowed per host',
+    'scraper_offers_total': 'Offers scraped',
+    'scraper_offer_failures_total': 'Failed offers by failure class',
+    'scraper_db_rows_total': 'Rows written to the database',
+    'scraper_jobs_total': 'Jobs run',
+    'scraper_jobs_scheduled': 'Jobs waiting for their next run',
+    'scraper_jobs_due': 'Jobs due but not started yet',
+    'scraper_job_lag_seconds': 'Delay between the due time of a job and its start',
+}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Registry:
+    """
+    Thread-safe store of counters, gauges and histograms with labels.
+
+    Snapshots of other processes, such as the workers of a WorkerPool, are added
+    with `add_snapshot` and exposed with extra labels next to the local metrics.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._external = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, _key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        """Return all local metrics as plain, picklable data."""
+        with self._lock:
+            return {
+                'counters': [(name, labels, value) for (name, labels), value in self._counters.items()],
+                'gauges': [(name, labels, value) for (name, labels), value in self._gauges.items()],
+                'histograms': [(name, labels, list(h[0]), h[1], h[2]) for (name, labels), h in self._histograms.items()],
+            }
+
+    def add_snapshot(self, source, snapshot, **labels):
+        """Expose the snapshot of another process, replacing its previous one."""
+        with self._lock:
+            self._external[source] = (_key(labels), snapshot)
+
+    def __snapshots(self):
+        snapshots = [((), self.snapshot())]
+        with self._lock:
+            snapshots += list(self._external.values())
+        return snapshots
+
+    def to_dict(self):
+        """Return local and added metrics with histograms summarized, for JSON output."""
+        result = {'counters': [], 'gauges': [], 'histograms': []}
+        for extra, snapshot in self.__snapshots():
+            for kind in ('counters', 'gauges'):
+                for name, labels, value in snapshot[kind]:
+                    result[kind].append({'name': name, 'labels': dict(labels + extra), 'value': value})
+            for name, labels, counts, total, count in snapshot['histograms']:
+                result['histograms'].append({'name': name, 'labels': dict(labels + extra), 'count': count,
+                                             'sum': round(total, 6), 'mean': round(total / count, 6) if count else None})
+        return result
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = {}
+        types = {}
+
+        def label_text(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+        for extra, snapshot in self.__snapshots():
+            for kind, type_name in (('counters', 'counter'), ('gauges', 'gauge')):
+                for name, labels, value in snapshot[kind]:
+                    types[name] = type_name
+                    lines.setdefault(name, []).append(f'{name}{label_text(labels + extra)} {value}')
+            for name, labels, counts, total, count in snapshot['histograms']:
+                types[name] = 'histogram'
+                labels = labels + extra
+                cumulative = 0
+                for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.setdefault(name, []).append(f'{name}_bucket{label_text(labels + (("le", bound),))} {cumulative}')
+                lines[name].append(f'{name}_sum{label_text(labels)} {total}')
+                lines[name].append(f'{name}_count{label_text(labels)} {count}')
+
+        output = []
+        for name in sorted(lines):
+            if name in HELP:
+                output.append(f'# HELP {name} {HELP[name]}')
+            output.append(f'# TYPE {name} {types[name]}')
+            output += lines[name]
+        return '\n'.join(output) + '\n'
+
+
+registry = Registry()
+_log_lock = threading.Lock()
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+def set_gauge(name, value, **labels):
+    registry.set(name, value, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+def log_event(event, **fields):
+    """Append one JSON line to the metrics log, if one is configured."""
+    if metrics_log_file is None:
+        return
+    entry = {'ts': datetime.datetime.now().isoformat(timespec='milliseconds'), 'pid': os.getpid(), 'event': event}
+    entry.update(fields)
+    line = json.dumps(entry, default=str)
+    with _log_lock, open(metrics_log_file, 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+
+@contextmanager
+def timed(stage, **labels):
+    """Record the duration of a stage, and whether it raised, under the given stage name."""
+    start = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        registry.inc('scraper_stage_errors_total', stage=stage, **labels)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        registry.observe('scraper_stage_seconds', seconds, stage=stage, **labels)
+        log_event('stage', stage=stage, seconds=round(seconds, 6), ok=ok, **labels)
+
+def log_snapshot():
+    """Write the current metrics to the JSON log."""
+    log_event('metrics', **registry.to_dict())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = registry.render().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(registry.to_dict(), default=str).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+def start_http_server(port=metrics_port, host=metrics_host):
+    """
+    Serve /metrics (Prometheus text) and /metrics.json from a background thread.
+
+    Does nothing without a port or when the server is already running.
+    """
+    global _server
+    if port is None or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    print(f'[METRICS] Serving metrics on http://{host}:{port}/metrics')
+    return _server
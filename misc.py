@@ -2,22 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import re
+import html
+import datetime
+from zoneinfo import ZoneInfo
+import config
 from config import debug
 import pandas as pd
 import pickle
 import bz2
-from bs4 import BeautifulSoup
+
+# Time zone of all timestamps written to the database (results, last_run of search jobs),
+# optional in config.py
+time_zone = getattr(config, 'time_zone', 'Europe/Berlin')
+
+TAG_RE = re.compile(r'<[^>]*>')
+
+def local_now():
+    """Return the current wall time in `time_zone` as naive datetime, as stored in the database."""
+    return datetime.datetime.now(ZoneInfo(time_zone)).replace(tzinfo=None)
 
 def clean_html(content):
+    """
+    Returns the text of an HTML fragment with tags removed and text pieces joined by spaces.
+
+    Args:
+        content (str): HTML fragment, possibly with escaped tags.
+
+    Returns:
+        str: Plain text content.
+    """
     # Decode HTML entities like &lt; to < and &gt; to >
     content = content.replace('&lt;', '<').replace('&gt;', '>')
 
-    # Use BeautifulSoup again to parse the content and extract text
-    content_soup = BeautifulSoup(content, 'html.parser')
-
-    # Get only the text and remove any HTML leftovers
-    text_content = content_soup.get_text(separator=' ', strip=True)
-    return text_content
+    # Drop the tags and decode the remaining entities of every text piece
+    pieces = (html.unescape(x).strip() for x in TAG_RE.split(content))
+    return ' '.join(x for x in pieces if x)
 
 def get_numbers(string_input):
     """
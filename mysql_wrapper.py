@@ -1,26 +1,49 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
 import mysql.connector
+import mysql.connector.pooling
 import pandas as pd
+import config
+from timeout import current_deadline
+import metrics
+
+# Connections kept open per process and MySQL object, optional in config.py
+mysql_pool_size = getattr(config, 'mysql_pool_size', 4)
+# Rows per multi-row INSERT of bulk_write, optional in config.py
+mysql_batch_size = getattr(config, 'mysql_batch_size', 500)
 
 
 class MySQL:
     """
     Represents a MySQL database interaction utility.
 
+    Connections are taken from a pool that is created lazily in every process,
+    so an object created before a fork never shares sockets with its children.
+
     Methods:
-        connect(): Establishes a connection to the MySQL database.
+        connect(): Returns a healthy connection from the pool of the current process.
+        transaction(): Context manager yielding a cursor, committing on success and rolling back on errors.
         write_list(table, columns, values): Writes a list of values into the specified table.
         get_table(table, column, sort_by=None, max_entries=None, descending=False): 
             Retrieves data from a table in the specified database with optional sorting and limiting.
+        bulk_write(table, columns, values, batch_size, upsert=True): Writes rows in multi-row batches.
+        get_existing_ids(table, ids, column='id'): Returns the subset of ids present in a table.
         get_dataframe(table, column): Returns a DataFrame of specified columns from a table.
     """
-    def __init__(self, mysql_host, mysql_user, mysql_password, mysql_database):
+    def __init__(self, mysql_host, mysql_user, mysql_password, mysql_database, pool_size=mysql_pool_size):
         self.host = mysql_host
         self.user = mysql_user
         self.password = mysql_password
         self.database = mysql_database
-    
-    def connect(self):
-        return mysql.connector.connect(
+        self.pool_size = pool_size
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def __connection_args(self):
+        return dict(
             host=self.host,
             user=self.user,
             password=self.password,
@@ -28,6 +51,58 @@ class MySQL:
             charset='utf8mb4'
         )
 
+    def __get_pool(self):
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name=f"pool_{os.getpid()}_{id(self)}",
+                    pool_size=self.pool_size,
+                    **self.__connection_args()
+                )
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def connect(self):
+        """
+        Returns a connection from the pool, reconnecting it if the server dropped it.
+
+        Falls back to a new unpooled connection if all pooled connections are in use.
+        Closing the returned connection hands it back to the pool.
+        """
+        try:
+            mydb = self.__get_pool().get_connection()
+        except mysql.connector.errors.PoolError:
+            return mysql.connector.connect(**self.__connection_args())
+        mydb.ping(reconnect=True, attempts=3, delay=1)
+        return mydb
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager yielding a cursor on a pooled connection.
+
+        All statements executed in the block are committed together when it
+        ends and rolled back if it raises. Inside a `timeout.deadline` block the
+        transaction is refused or rolled back once the deadline has passed.
+        """
+        current = current_deadline()
+        if current is not None:
+            current.check('db')
+        mydb = self.connect()
+        mycursor = mydb.cursor()
+        try:
+            yield mycursor
+            # A transaction overrunning the deadline of the task is rolled back
+            if current is not None:
+                current.check('db')
+            mydb.commit()
+        except Exception:
+            mydb.rollback()
+            raise
+        finally:
+            mycursor.close()
+            mydb.close()
+
     def create_table(self, table, columns, types):
         """
         Creates a table if it doesn't exist.
@@ -37,30 +112,22 @@ class MySQL:
             columns (list): A list of column names.
             types (list): A list of column types corresponding to the column names.
         """
-        mydb = self.connect()
-        mycursor = mydb.cursor()
+        with self.transaction() as mycursor:
+            # Check if the table exists
+            mycursor.execute(f"SHOW TABLES LIKE '{table}'")
+            result = mycursor.fetchone()
 
-        # Check if the table exists
-        mycursor.execute(f"SHOW TABLES LIKE '{table}'")
-        result = mycursor.fetchone()
-
-        if not result:
-            # Create the table if it doesn't exist
-            column_definitions = ', '.join([f"{col} {typ}" for col, typ in zip(columns, types)])
-            create_table_sql = f"CREATE TABLE {table} ({column_definitions})"
-            print(create_table_sql)
-            mycursor.execute(create_table_sql)
-            print(f'[MYSQL] Table {table} created')
-        else:
-            print(f'[MYSQL] Table {table} already exists')
-
-        mycursor.close()
-        mydb.close()
+            if not result:
+                # Create the table if it doesn't exist
+                column_definitions = ', '.join([f"{col} {typ}" for col, typ in zip(columns, types)])
+                create_table_sql = f"CREATE TABLE {table} ({column_definitions})"
+                print(create_table_sql)
+                mycursor.execute(create_table_sql)
+                print(f'[MYSQL] Table {table} created')
+            else:
+                print(f'[MYSQL] Table {table} already exists')
 
     def write_list(self, table, columns, values):
-        mydb = self.connect()
-        mycursor = mydb.cursor()
-
         if isinstance(columns, str):
             column_names = f"({columns})"
             placeholders = '%s'
@@ -69,20 +136,53 @@ class MySQL:
             placeholders = ', '.join(['%s'] * len(columns))
             
         sql = f"INSERT INTO {table} {column_names} VALUES ({placeholders})"
-        if len(values) > 1:
-            mycursor.executemany(sql, values)
-        else:
-            mycursor.execute(sql, values[0])
+        with metrics.timed('db_write'), self.transaction() as mycursor:
+            if len(values) > 1:
+                mycursor.executemany(sql, values)
+            else:
+                mycursor.execute(sql, values[0])
+            rowcount = mycursor.rowcount
+        metrics.inc('scraper_db_rows_total', len(values), table=table)
+        print('[MYSQL]', rowcount, "records added to database")
 
-        mydb.commit()
-        print('[MYSQL]', mycursor.rowcount, "records added to database")
-        mycursor.close()
-        mydb.close()
+    def bulk_write(self, table, columns, values, batch_size=mysql_batch_size, upsert=True, update_columns=None):
+        """
+        Writes rows with multi-row INSERT statements, one transaction per batch.
 
-    def get_table(self, table, column, sort_by=None, max_entries=None, descending=False, add_query=None):
-        mydb = self.connect()
-        mycursor = mydb.cursor()
+        Args:
+            table (str): The name of the table to write to.
+            columns (list): Column names of the values.
+            values (list): Rows to write.
+            batch_size (int): Rows per INSERT statement.
+            upsert (bool): Update existing rows on duplicate keys instead of failing.
+            update_columns (list): Columns updated on duplicate keys, defaults to all columns.
 
+        Returns:
+            list[dict]: Per batch the number of `rows` sent, the `affected` row count
+                reported by MySQL and the `seconds` it took.
+        """
+        column_names = ', '.join(columns)
+        row_placeholder = '(' + ', '.join(['%s'] * len(columns)) + ')'
+        update_sql = ''
+        if upsert:
+            update_sql = ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                f"{col} = VALUES({col})" for col in (update_columns or columns))
+
+        stats = []
+        for i in range(0, len(values), batch_size):
+            batch = values[i:i + batch_size]
+            sql = (f"INSERT INTO {table} ({column_names}) VALUES "
+                   + ', '.join([row_placeholder] * len(batch)) + update_sql)
+            start = time.perf_counter()
+            with metrics.timed('db_write'), self.transaction() as mycursor:
+                mycursor.execute(sql, [x for row in batch for x in row])
+                affected = mycursor.rowcount
+            metrics.inc('scraper_db_rows_total', len(batch), table=table)
+            stats.append({'rows': len(batch), 'affected': affected, 'seconds': time.perf_counter() - start})
+        print('[MYSQL]', sum(x['rows'] for x in stats), f"records written to {table} in {len(stats)} batches")
+        return stats
+
+    def get_table(self, table, column, sort_by=None, max_entries=None, descending=False, add_query=None):
         column_str = ', '.join(column) if isinstance(column, list) else column
         query = f"SELECT {column_str} FROM {table}"
         if sort_by:
@@ -94,29 +194,44 @@ class MySQL:
         if add_query:
             query += " " + add_query
         query += ";"
-        mycursor.execute(query)
-        table_values = mycursor.fetchall()
-        mycursor.close()
-        mydb.close()
+        with metrics.timed('db_read'), self.transaction() as mycursor:
+            mycursor.execute(query)
+            table_values = mycursor.fetchall()
         return table_values
     
+    def get_existing_ids(self, table, ids, column='id', batch_size=1000):
+        """
+        Returns the subset of ids that exist in a table.
+
+        Args:
+            table (str): The name of the table to check.
+            ids (list): Candidate ids.
+            column (str): The id column, should be indexed.
+            batch_size (int): Maximum number of ids per query.
+
+        Returns:
+            set: The ids found in the table.
+        """
+        existing = set()
+        ids = list(ids)
+        if not ids:
+            return existing
+        with metrics.timed('db_read'), self.transaction() as mycursor:
+            for i in range(0, len(ids), batch_size):
+                batch = ids[i:i + batch_size]
+                placeholders = ', '.join(['%s'] * len(batch))
+                mycursor.execute(f"SELECT {column} FROM {table} WHERE {column} IN ({placeholders})", batch)
+                existing.update(x[0] for x in mycursor.fetchall())
+        return existing
+
     def execute(self, query, fetch=False):
-        mydb = self.connect()
-        mycursor = mydb.cursor()
-        mycursor.execute(query)
-        
-        if fetch:
-            fetch = mycursor.fetchall()
-            mydb.commit()
-            mycursor.close()
-            mydb.close()
-            return fetch
-        else:
-            mydb.commit()
-            mycursor.close()
-            mydb.close()
+        with metrics.timed('db_read' if fetch else 'db_write'), self.transaction() as mycursor:
+            mycursor.execute(query)
+            if fetch:
+                return mycursor.fetchall()
 
     def get_dataframe(self, table, column, add_query=None):
+        mydb = None
         try:
             mydb = self.connect()
             query = f"SELECT {column} FROM {table}"
@@ -124,9 +239,11 @@ class MySQL:
                 query += " " + add_query
             query += ";"
             print(query)
-            result_df = pd.read_sql(query, mydb)
-            mydb.close()
+            with metrics.timed('db_read'):
+                result_df = pd.read_sql(query, mydb)
             return result_df
         except Exception as e:
             print(str(e))
-            mydb.close()
\ No newline at end of file
+        finally:
+            if mydb is not None:
+                mydb.close()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+from array import array
+import numpy as np
+import pandas as pd
+
+# Column name, offer attribute and kind of every column of an offer frame. Numeric kinds
+# are array typecodes, 'category' columns are dictionary encoded while appending.
+OFFER_FRAME_COLUMNS = (
+    ('title', 'title', 'string'),
+    ('postalcode', 'postalcode', 'q'),
+    ('state', 'state', 'category'),
+    ('state_code', 'state_code', 'category'),
+    ('place', 'place', 'category'),
+    ('price', 'price', 'd'),
+    ('size', 'size', 'q'),
+    ('rooms', 'rooms', 'd'),
+    ('floor', 'floor', 'q'),
+    ('year', 'year', 'q'),
+    ('month', 'month', 'q'),
+    ('day', 'day', 'q'),
+    ('kleinanz-index', 'index', 'q'),
+    ('latitude', 'latitude', 'd'),
+    ('longitude', 'longitude', 'd'),
+)
+
+# Narrowest nullable dtypes of the integer columns
+INT_DTYPES = {'postalcode': 'Int32', 'size': 'Int32', 'floor': 'Int16', 'year': 'Int16',
+              'month': 'Int8', 'day': 'Int8', 'kleinanz-index': 'Int64'}
+
+
+def _missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+class OfferColumns:
+    """
+    Columnar accumulator of parsed offers.
+
+    Fields are appended to typed buffers, one per column, and a single DataFrame
+    is built at the end: integers as nullable integer dtypes, floats as float64
+    with NaN, state and place as categoricals and the title as string dtype.
+    With `parquet_path` the buffers are written out as a Parquet row group every
+    `row_group_size` offers and cleared, so a crawl of any size holds at most one
+    row group in memory. Arrow and Parquet output need pyarrow.
+
+    Args:
+        parquet_path (str): Parquet file to stream the offers into.
+        row_group_size (int): Offers per Parquet row group.
+    """
+    def __init__(self, parquet_path=None, row_group_size=10000):
+        self.parquet_path = parquet_path
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self._writer = None
+        self.__reset()
+
+    def __reset(self):
+        self._values = {}
+        self._masks = {}
+        self._categories = {}
+        for name, _, kind in OFFER_FRAME_COLUMNS:
+            if kind == 'string':
+                self._values[name] = []
+            elif kind == 'category':
+                self._values[name] = array('i')
+                self._categories[name] = {}
+            else:
+                self._values[name] = array(kind)
+                self._masks[name] = bytearray()
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, offer):
+        """Append the fields of a parsed OfferPage, fields it lacks are missing values."""
+        for name, attribute, kind in OFFER_FRAME_COLUMNS:
+            value = getattr(offer, attribute, None)
+            if kind == 'string':
+                self._values[name].append(value)
+            elif kind == 'category':
+                codes = self._categories[name]
+                self._values[name].append(-1 if _missing(value) else codes.setdefault(value, len(codes)))
+            else:
+                missing = _missing(value)
+                self._values[name].append(0 if missing else value)
+                self._masks[name].append(missing)
+        self._length += 1
+        self.rows += 1
+        if self.parquet_path and self._length >= self.row_group_size:
+            self.flush()
+
+    def __series(self, name, kind):
+        values = self._values[name]
+        if kind == 'string':
+            return pd.array(values, dtype='string')
+        if kind == 'category':
+            return pd.Categorical.from_codes(np.frombuffer(values, dtype=np.int32), categories=list(self._categories[name]))
+        mask = np.frombuffer(self._masks[name], dtype=np.bool_)
+        if kind == 'd':
+            data = np.frombuffer(values, dtype=np.float64).copy()
+            data[mask] = np.nan
+            return data
+        data = np.frombuffer(values, dtype=np.int64).astype(INT_DTYPES[name].lower())
+        return pd.arrays.IntegerArray(data, mask.copy())
+
+    def to_df(self):
+        """Return the buffered offers as one DataFrame."""
+        return pd.DataFrame({name: self.__series(name, kind) for name, _, kind in OFFER_FRAME_COLUMNS})
+
+    def to_arrow(self):
+        """Return the buffered offers as a pyarrow Table."""
+        import pyarrow as pa
+        arrays = []
+        for name, _, kind in OFFER_FRAME_COLUMNS:
+            values = self._values[name]
+            if kind == 'string':
+                arrays.append(pa.array(values, type=pa.string()))
+            elif kind == 'category':
+                indices = np.frombuffer(values, dtype=np.int32)
+                arrays.append(pa.DictionaryArray.from_arrays(
+                    pa.array(indices, mask=indices < 0), pa.array(list(self._categories[name]), type=pa.string())))
+            else:
+                mask = np.frombuffer(self._masks[name], dtype=np.bool_)
+                if kind == 'd':
+                    arrays.append(pa.array(np.frombuffer(values, dtype=np.float64), mask=mask))
+                else:
+                    dtype = INT_DTYPES[name].lower()
+                    arrays.append(pa.array(np.frombuffer(values, dtype=np.int64).astype(dtype), mask=mask))
+        return pa.Table.from_arrays(arrays, names=[name for name, _, _ in OFFER_FRAME_COLUMNS])
+
+    def flush(self):
+        """Write the buffered offers to the Parquet file as one row group and clear the buffers."""
+        if not self._length:
+            return
+        import pyarrow.parquet as pq
+        table = self.to_arrow()
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.parquet_path, table.schema)
+        self._writer.write_table(table)
+        self.__reset()
+
+    def close(self):
+        """Write the remaining offers and finish the Parquet file."""
+        if self.parquet_path:
+            self.flush()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import html
+import datetime
+import dateutil.parser as dparser
+from misc import get_numbers, clean_html, TAG_RE
+
+TITLE_MARKER = '<title>'
+DATE_MARKER = 'icon icon-small icon-calendar-gray-simple'
+PRICE_MARKER = 'adPrice:'
+ADDRESS_MARKER = 'initMap'
+DETAIL_MARKER = '<span class="addetailslist--detail--value">'
+DESCRIPTION_META_MARKER = 'itemprop="description"'
+DESCRIPTION_TEXT_MARKER = 'id="viewad-description-text"'
+
+# All markers are found in one scan over the document
+MARKER_RE = re.compile('|'.join(re.escape(x) for x in (
+    TITLE_MARKER, DATE_MARKER, PRICE_MARKER, ADDRESS_MARKER, DETAIL_MARKER,
+    DESCRIPTION_META_MARKER, DESCRIPTION_TEXT_MARKER,
+)))
+
+DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})')
+POSTALCODE_RE = re.compile(r"\D(\d{5})\D")
+CONTENT_ATTR_RE = re.compile(r'content\s*=\s*"([^"]*)"')
+
+
+def _line_at(content, start, end):
+    """Return the line containing content[start:end] and the offset after its newline."""
+    line_start = content.rfind('\n', 0, start) + 1
+    line_end = content.find('\n', end)
+    if line_end == -1:
+        line_end = len(content)
+    return content[line_start:line_end], line_end + 1
+
+def _next_line(content, offset):
+    """Return the line starting at `offset`."""
+    line_end = content.find('\n', offset)
+    if line_end == -1:
+        line_end = len(content)
+    return content[offset:line_end]
+
+def parse_title(line):
+    return line.split(sep='>')[1].split(sep='<')[0].split('|')[0]
+
+def parse_date(line):
+    match = DATE_RE.search(line)
+    if match:
+        day, month, year = (int(x) for x in match.groups())
+        return datetime.datetime(year, month, day)
+    return dparser.parse(line, fuzzy=True, dayfirst=True)
+
+def parse_price(line):
+    numbers = get_numbers(line)
+    return float(int(numbers[0]) + (int(numbers[1]) / 100))
+
+def parse_postalcode(line):
+    return int(POSTALCODE_RE.findall(" " + line + " ")[0])
+
+def parse_description_meta(content, start):
+    """Return the unescaped content attribute of the tag around `start`."""
+    tag_start = content.rfind('<', 0, start)
+    tag_end = content.find('>', start)
+    match = CONTENT_ATTR_RE.search(content, tag_start, tag_end)
+    return html.unescape(match.group(1)) if match else None
+
+def parse_description_text(content, start):
+    """Return the stripped text of the element opened around `start`."""
+    text_start = content.find('>', start) + 1
+    text_end = content.find('</p>', text_start)
+    pieces = (html.unescape(x).strip() for x in TAG_RE.split(content[text_start:text_end]))
+    return ''.join(pieces)
+
+def parse_offer(content):
+    """
+    Extract all fields of an offer page in a single pass over its HTML.
+
+    Args:
+        content (str): Page source of the offer page.
+
+    Returns:
+        dict: Parsed fields `title`, `date`, `price`, `postalcode`, `address_line`,
+            `details` and `description`. Fields not found on the page are None.
+    """
+    found = {}
+    details = {}
+    detail_lines = set()
+    for match in MARKER_RE.finditer(content):
+        # Apart from the details only the first occurrence of a marker is used
+        marker = match.group()
+        if marker in found:
+            continue
+        if marker == DETAIL_MARKER:
+            line, next_offset = _line_at(content, match.start(), match.end())
+            if next_offset in detail_lines:
+                continue
+            detail_lines.add(next_offset)
+            value = ' '.join(_next_line(content, next_offset).split(sep='<')[0].split())
+            details[line.split(sep='<')[0].split()[0]] = value
+        elif marker == DESCRIPTION_META_MARKER:
+            # Only the meta tag carries the description as attribute
+            if content.startswith('<meta', content.rfind('<', 0, match.start())):
+                found[marker] = match.start()
+        elif marker == DESCRIPTION_TEXT_MARKER:
+            found[marker] = match.start()
+        else:
+            found[marker] = _line_at(content, match.start(), match.end())
+
+    result = dict.fromkeys(('title', 'date', 'price', 'postalcode', 'address_line', 'description'))
+    result['details'] = details
+    if TITLE_MARKER in found:
+        result['title'] = parse_title(found[TITLE_MARKER][0])
+    if DATE_MARKER in found:
+        result['date'] = parse_date(found[DATE_MARKER][0])
+    if PRICE_MARKER in found:
+        try:
+            result['price'] = parse_price(found[PRICE_MARKER][0])
+        except IndexError:
+            pass
+    if ADDRESS_MARKER in found:
+        result['address_line'] = _next_line(content, found[ADDRESS_MARKER][1])
+        try:
+            result['postalcode'] = parse_postalcode(result['address_line'])
+        except IndexError:
+            pass
+
+    description_raw = None
+    if DESCRIPTION_META_MARKER in found:
+        description_raw = parse_description_meta(content, found[DESCRIPTION_META_MARKER])
+    if not description_raw and DESCRIPTION_TEXT_MARKER in found:
+        description_raw = parse_description_text(content, found[DESCRIPTION_TEXT_MARKER])
+    if description_raw:
+        result['description'] = clean_html(description_raw)
+    return result
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of raw search and offer pages.
+
+Usage:
+    python page_cache.py stats
+    python page_cache.py evict
+    python page_cache.py reparse [--write]
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import fcntl
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+import config
+
+# Page cache settings, optional in config.py. The cache is disabled without a folder.
+page_cache_folder = getattr(config, 'page_cache_folder', None)
+# Seconds a cached page is served and kept, and the maximum size of all segments in bytes
+page_cache_ttl = getattr(config, 'page_cache_ttl', 24 * 3600)
+page_cache_max_bytes = getattr(config, 'page_cache_max_bytes', 2 * 1024 ** 3)
+# Size after which a new segment file is started
+page_cache_segment_bytes = getattr(config, 'page_cache_segment_bytes', 64 * 1024 ** 2)
+
+INDEX_FILE = 'index.jsonl'
+LOCK_FILE = 'lock'
+SEGMENT_RE = re.compile(r'^seg-(\d+)\.dat$')
+
+
+class PageCache:
+    """
+    Content-addressed cache of raw pages in append-only segment files.
+
+    Every distinct page body is stored once, zlib compressed, in the current segment
+    file and addressed by its SHA-1. An append-only index file maps each URL to the
+    fetch time and digest of its latest version. Pages older than `ttl` are not served
+    and whole segments are dropped once all their pages expired or when the cache
+    grows beyond `max_bytes`. Writes are serialized with a file lock, so the processes
+    of a worker pool can share one cache folder.
+
+    Args:
+        folder (str): Folder holding the segments and the index.
+        ttl (float): Seconds a page is served after it was fetched.
+        max_bytes (int): Maximum size of all segment files.
+        segment_bytes (int): Size after which a new segment file is started.
+
+    Attributes:
+        urls (dict): URL -> (fetched_at, digest) of the latest cached version.
+        blobs (dict): Digest -> (segment, offset, length) of the compressed page body.
+    """
+    def __init__(self, folder, ttl=page_cache_ttl, max_bytes=page_cache_max_bytes,
+                 segment_bytes=page_cache_segment_bytes):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        os.makedirs(folder, exist_ok=True)
+        self.urls = {}
+        self.blobs = {}
+        self._index_offset = 0
+        self._index_inode = None
+        self._lock = threading.Lock()
+        with self.__locked():
+            self.__refresh()
+
+    def __path(self, name):
+        return os.path.join(self.folder, name)
+
+    @contextmanager
+    def __locked(self):
+        with self._lock, open(self.__path(LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def __refresh(self):
+        """Read index entries appended by other processes, reload after a compaction."""
+        path = self.__path(INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        inode = os.stat(path).st_ino
+        if inode != self._index_inode:
+            self.urls, self.blobs = {}, {}
+            self._index_offset, self._index_inode = 0, inode
+        with open(path, 'rb') as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self._index_offset += len(line)
+                self.__apply(json.loads(line))
+
+    def __apply(self, entry):
+        self.blobs[entry['digest']] = (entry['segment'], entry['offset'], entry['length'])
+        known = self.urls.get(entry['url'])
+        if known is None or known[0] <= entry['fetched_at']:
+            self.urls[entry['url']] = (entry['fetched_at'], entry['digest'])
+
+    def __segments(self):
+        segments = {}
+        for name in os.listdir(self.folder):
+            match = SEGMENT_RE.match(name)
+            if match:
+                segments[int(match.group(1))] = os.path.getsize(self.__path(name))
+        return segments
+
+    def __read(self, digest):
+        segment, offset, length = self.blobs[digest]
+        with open(self.__path(f'seg-{segment:06d}.dat'), 'rb') as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length)).decode('utf-8')
+
+    def get(self, url, max_age=None):
+        """
+        Return the cached page of a URL.
+
+        Args:
+            url (str): The URL as it was fetched.
+            max_age (float): Seconds the page may be old, the TTL of the cache by default.
+
+        Returns:
+            str: The page source, None if the URL is not cached or expired.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            if url not in self.urls:
+                with open(self.__path(LOCK_FILE), 'a') as f:
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                    self.__refresh()
+            cached = self.urls.get(url)
+            if cached is None or time.time() - cached[0] > max_age:
+                return None
+            try:
+                return self.__read(cached[1])
+            except (OSError, KeyError, zlib.error):
+                return None
+
+    def put(self, url, content, fetched_at=None):
+        """Store the page of a URL, the body is only written if it is not cached yet."""
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        new_segment = False
+        with self.__locked():
+            self.__refresh()
+            if digest in self.blobs:
+                segment, offset, length = self.blobs[digest]
+            else:
+                data = zlib.compress(content.encode('utf-8'), 6)
+                segments = self.__segments()
+                segment = max(segments, default=0)
+                new_segment = not segments or segments[segment] >= self.segment_bytes
+                if new_segment:
+                    segment += 1
+                with open(self.__path(f'seg-{segment:06d}.dat'), 'ab') as f:
+                    offset = f.tell()
+                    f.write(data)
+                length = len(data)
+            entry = {'url': url, 'fetched_at': fetched_at, 'digest': digest,
+                     'segment': segment, 'offset': offset, 'length': length}
+            with open(self.__path(INDEX_FILE), 'ab') as f:
+                f.write(json.dumps(entry).encode('utf-8') + b'\n')
+            self.__refresh()
+        # Eviction runs whenever a segment is full
+        if new_segment and segments:
+            self.evict()
+
+    def fetch(self, url):
+        """Return the cached page of a URL regardless of its age, lets the cache stand in for a fetcher."""
+        content = self.get(url, max_age=float('inf'))
+        if content is None:
+            raise KeyError(f'Not cached: {url}')
+        return content
+
+    def items(self, prefix=''):
+        """Yield (url, fetched_at, content) of every cached URL starting with `prefix`."""
+        with self._lock:
+            urls = sorted((url, cached) for url, cached in self.urls.items() if url.startswith(prefix))
+        for url, (fetched_at, digest) in urls:
+            try:
+                yield url, fetched_at, self.__read(digest)
+            except (OSError, KeyError, zlib.error) as e:
+                print('[PYTHON][PAGE_CACHE][WARNING] Could not read {}: {}'.format(url, e))
+
+    def evict(self):
+        """
+        Drop expired pages and the oldest segments above the size cap, then compact the index.
+
+        Returns:
+            int: Number of segment files removed.
+        """
+        with self.__locked():
+            self.__refresh()
+            now = time.time()
+            live = {url: cached for url, cached in self.urls.items() if now - cached[0] <= self.ttl}
+            used = {self.blobs[digest][0] for _, digest in live.values()}
+            segments = self.__segments()
+
+            # Segments are filled in order, so the lowest numbers hold the oldest pages.
+            # The current segment is still appended to and always kept.
+            current = max(segments, default=None)
+            keep = {x for x in used if x in segments} | ({current} if current is not None else set())
+            total = sum(segments[x] for x in keep)
+            for segment in sorted(keep):
+                if total <= self.max_bytes or segment == current:
+                    break
+                keep.discard(segment)
+                total -= segments[segment]
+            removed = [x for x in segments if x not in keep]
+            live = {url: cached for url, cached in live.items() if self.blobs[cached[1]][0] in keep}
+
+            tmp_path = self.__path(INDEX_FILE + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                for url, (fetched_at, digest) in live.items():
+                    segment, offset, length = self.blobs[digest]
+                    entry = {'url': url, 'fetched_at': fetched_at, 'digest': digest,
+                             'segment': segment, 'offset': offset, 'length': length}
+                    f.write(json.dumps(entry).encode('utf-8') + b'\n')
+            os.replace(tmp_path, self.__path(INDEX_FILE))
+            for segment in removed:
+                os.remove(self.__path(f'seg-{segment:06d}.dat'))
+            self._index_inode = None
+            self.__refresh()
+            print('[PYTHON][PAGE_CACHE] Evicted {} segments, {} pages cached'.format(len(removed), len(self.urls)))
+            return len(removed)
+
+    def stats(self):
+        with self._lock:
+            segments = self.__segments()
+            return {'urls': len(self.urls), 'blobs': len(self.blobs),
+                    'segments': len(segments), 'bytes': sum(segments.values())}
+
+
+class CachedFetcher:
+    """
+    Fetcher serving pages from a PageCache and storing every fetched page in it.
+
+    `fetch` serves cached pages within the TTL, as used for offer pages. `url` always
+    loads the live page, so search results stay fresh, and only records it. Only
+    pages `classify_response` takes for regular content are stored, so an empty,
+    challenge or error page is fetched again next time instead of served for the TTL.
+
+    Args:
+        fetcher: The fetcher used for live pages.
+        cache (PageCache): The page cache.
+    """
+    def __init__(self, fetcher, cache):
+        self.fetcher = fetcher
+        self.cache = cache
+        self.last_url = None
+        self.last_content = None
+
+    def fetch(self, url):
+        content = self.cache.get(url)
+        if content is None:
+            content = self.fetcher.fetch(url)
+            self.__store(url, content)
+        self.last_url, self.last_content = url, content
+        return content
+
+    def url(self, url):
+        self.fetcher.url(url)
+        self.last_url, self.last_content = None, None
+        self.__store(url, self.fetcher.content())
+
+    def __store(self, url, content):
+        from webscraper import classify_response
+        from ratelimit import OK
+        if classify_response(content) == OK:
+            self.cache.put(url, content)
+
+    def current_url(self):
+        return self.last_url or self.fetcher.current_url()
+
+    def content(self):
+        return self.last_content if self.last_url else self.fetcher.content()
+
+    def close(self):
+        if hasattr(self.fetcher, 'close'):
+            self.fetcher.close()
+
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def page_cache():
+    """Return the page cache of this process, None if no cache folder is configured."""
+    global _page_cache
+    if page_cache_folder is None:
+        return None
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageCache(page_cache_folder)
+        return _page_cache
+
+
+def reparse(cache, write=False):
+    """
+    Parse all cached offer pages again.
+
+    Args:
+        cache (PageCache): The page cache.
+        write (bool): Upsert the parsed rows into the results table and drop them from the error table.
+
+    Returns:
+        dict: Number of parsed and failed offers.
+    """
+    from kleinanzeigen import Kleinanzeigen
+    prefix = Kleinanzeigen.OFFER_TEMPLATE_URL.split('{')[0]
+    values, failed = [], []
+    for url, fetched_at, content in cache.items(prefix):
+        index = url[len(prefix):]
+        if not index.isdigit():
+            continue
+        try:
+            values.append(Kleinanzeigen.offer_values(Kleinanzeigen.OfferPage(cache, int(index))))
+        except Exception as e:
+            failed.append(int(index))
+            print('[PYTHON][PAGE_CACHE][REPARSE][ERROR]', index, e)
+
+    if write and values:
+        from mysql_wrapper import MySQL
+        mysql_obj = MySQL(mysql_host=config.mysql_host, mysql_user=config.mysql_user,
+                          mysql_password=config.mysql_password, mysql_database=config.mysql_restweb_db)
+        mysql_obj.bulk_write(config.mysql_results_table, Kleinanzeigen.OFFER_COLUMNS, values)
+        ids = [x[Kleinanzeigen.OFFER_COLUMNS.index('id')] for x in values]
+        mysql_obj.execute(f"DELETE FROM {config.mysql_error_table} WHERE id IN ({','.join(map(str, ids))})")
+    return {'parsed': len(values), 'failed': len(failed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help='Print the size of the cache')
+    subparsers.add_parser('evict', help='Drop expired pages and enforce the size cap')
+    reparse_parser = subparsers.add_parser('reparse', help='Parse all cached offer pages again')
+    reparse_parser.add_argument('--write', action='store_true', help='Upsert the parsed rows into the results table')
+    args = parser.parse_args()
+
+    cache = page_cache()
+    if cache is None:
+        raise SystemExit('No page_cache_folder configured in config.py')
+    if args.command == 'stats':
+        result = cache.stats()
+    elif args.command == 'evict':
+        result = {'removed_segments': cache.evict(), **cache.stats()}
+    else:
+        result = reparse(cache, write=args.write)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
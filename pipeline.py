@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Producer/consumer stages on threads, connected by bounded queues.
+
+    The source iterable is consumed on a thread of its own and every stage runs on one
+    or more threads, so stages overlap and a slow stage only holds up the stages in front
+    of it once the queue between them is full. Memory stays bounded by the queue sizes,
+    however many items the source produces.
+
+    A stage function takes one item and returns an iterable of items for the next stage,
+    so stages can filter and split items. Iterating the pipeline yields the items of the
+    last stage on the calling thread. An exception in any stage stops all stages and is
+    raised from the iteration; leaving the iteration early stops them as well.
+
+    Args:
+        source (iterable): Items fed into the first stage.
+        maxsize (int): Items buffered between the source and the first stage.
+    """
+    def __init__(self, source, maxsize=1):
+        self.source = source
+        self.maxsize = maxsize
+        self.stages = []
+
+    def then(self, func, workers=1, maxsize=1):
+        """
+        Append a stage.
+
+        Args:
+            func (callable or list): Function of the stage, or a list of functions with
+                one worker thread each, e.g. to give every worker its own connection.
+            workers (int): Number of worker threads running `func`.
+            maxsize (int): Items buffered behind the stage.
+
+        Returns:
+            Pipeline: The pipeline itself, for chaining.
+        """
+        funcs = list(func) if isinstance(func, (list, tuple)) else [func] * workers
+        self.stages.append((funcs, maxsize))
+        return self
+
+    def __iter__(self):
+        stop = threading.Event()
+        errors = []
+        lock = threading.Lock()
+        # Queue i is written by group i (0 is the source) and read by group i+1 (or the caller)
+        queues = [queue.Queue(self.maxsize)] + [queue.Queue(maxsize) for _, maxsize in self.stages]
+        running = [1] + [len(funcs) for funcs, _ in self.stages]
+        readers = running[1:] + [1]
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return _DONE
+
+        def consume(q, func):
+            while True:
+                item = get(q)
+                if item is _DONE:
+                    return
+                yield from func(item)
+
+        def run(group, items):
+            try:
+                for item in items:
+                    if not put(queues[group], item):
+                        break
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                if hasattr(items, 'close'):
+                    items.close()
+                with lock:
+                    running[group] -= 1
+                    last = running[group] == 0
+                # The last worker of a group tells every reader of its queue that it is done
+                if last:
+                    for _ in range(readers[group]):
+                        put(queues[group], _DONE)
+
+        threads = [threading.Thread(target=run, args=(0, iter(self.source)), name='pipeline-source', daemon=True)]
+        for group, (funcs, _) in enumerate(self.stages, 1):
+            for worker, func in enumerate(funcs):
+                threads.append(threading.Thread(target=run, args=(group, consume(queues[group - 1], func)),
+                                                name=f'pipeline-{group}-{worker}', daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = get(queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from urllib.parse import urlparse
+import config
+
+# Request pacing per host and egress, optional in config.py. The rate adapts to the responses
+# between the minimum and the maximum (scrape_rate_per_host if set), starting at scrape_rate_start.
+scrape_adaptive_rate = getattr(config, 'scrape_adaptive_rate', True)
+scrape_rate_per_host = getattr(config, 'scrape_rate_per_host', None)
+scrape_burst = getattr(config, 'scrape_burst', 1)
+scrape_rate_start = getattr(config, 'scrape_rate_start', 1.0)
+scrape_rate_min = getattr(config, 'scrape_rate_min', 0.1)
+scrape_rate_max = getattr(config, 'scrape_rate_max', 10.0)
+# Requests per second gained per second of healthy responses and factor applied on trouble
+scrape_rate_increase = getattr(config, 'scrape_rate_increase', 0.1)
+scrape_rate_decrease = getattr(config, 'scrape_rate_decrease', 0.5)
+# Seconds all requests pause after a block, doubled for every further block in a row
+scrape_block_cooldown = getattr(config, 'scrape_block_cooldown', 60)
+scrape_block_max_cooldown = getattr(config, 'scrape_block_max_cooldown', 900)
+
+# Outcomes of a request as reported to AdaptiveRate.record
+OK, BLOCKED, EMPTY, ERROR = 'ok', 'blocked', 'empty', 'error'
+
+class TokenBucket:
+    """
+    A thread-safe token bucket limiting the rate of requests.
+
+    Args:
+        rate (float): Tokens added per second. None disables the limit.
+        burst (int): Maximum number of tokens that can be saved up.
+    """
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate, drain=False):
+        """Change the rate, tokens saved up so far are kept unless `drain` is set."""
+        with self._lock:
+            if self.rate:
+                self.__refill(time.monotonic())
+            else:
+                self.updated = time.monotonic()
+            self.rate = rate
+            if drain:
+                self.tokens = 0.0
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                self.__refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveRate:
+    """
+    Token bucket whose rate follows the health of the responses, additive increase and
+    multiplicative decrease (AIMD) as in TCP congestion control.
+
+    Every healthy response raises the rate by `increase / rate`, about `increase`
+    requests per second for every second of healthy traffic, up to `max_rate`. Errors
+    and empty pages multiply it by `decrease`, at most once per request interval so a
+    burst of failures of concurrent requests counts once. Blocks (captcha or consent
+    walls, HTTP 403/429) decrease the rate as well and pause all requests for `cooldown`
+    seconds, doubled for every further block in a row up to `max_cooldown`.
+
+    Args:
+        rate (float): Requests per second to start with.
+        min_rate (float): Lowest rate.
+        max_rate (float): Highest rate.
+        increase (float): Requests per second gained per second of healthy responses.
+        decrease (float): Factor applied to the rate on trouble.
+        cooldown (float): Seconds of the pause after a block.
+        max_cooldown (float): Longest pause after blocks in a row.
+        burst (int): Requests that can be sent at once after an idle time.
+
+    Attributes:
+        blocks (int): Blocks in a row, reset by the next healthy response.
+    """
+    def __init__(self, rate=scrape_rate_start, min_rate=scrape_rate_min, max_rate=scrape_rate_max,
+                 increase=scrape_rate_increase, decrease=scrape_rate_decrease, cooldown=scrape_block_cooldown,
+                 max_cooldown=scrape_block_max_cooldown, burst=1):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.bucket = TokenBucket(min(max(rate, min_rate), max_rate), burst)
+        self.blocks = 0
+        self.paused_until = 0.0
+        self._decreased = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def wait_paused(self):
+        """Block until the pause after a block is over."""
+        while True:
+            wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def acquire(self):
+        """Block until a request may be sent, waiting out a pause after a block."""
+        self.wait_paused()
+        self.bucket.acquire()
+
+    def record(self, outcome):
+        """
+        Adapt the rate to the outcome of a request.
+
+        Args:
+            outcome (str): OK, BLOCKED, EMPTY or ERROR.
+
+        Returns:
+            float: The new rate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate = self.bucket.rate
+            if outcome == OK:
+                self.blocks = 0
+                rate = min(self.max_rate, rate + self.increase / rate)
+            elif outcome == BLOCKED or now - self._decreased >= 1 / rate:
+                rate = max(self.min_rate, rate * self.decrease)
+                self._decreased = now
+            if outcome == BLOCKED:
+                self.blocks += 1
+                pause = min(self.cooldown * 2 ** (self.blocks - 1), self.max_cooldown)
+                self.paused_until = max(self.paused_until, now + pause)
+            self.bucket.set_rate(rate, drain=(outcome == BLOCKED))
+            return rate
+
+
+_egress_limiters = {}
+_egress_limiters_lock = threading.Lock()
+
+def egress_limiter(url, egress=None):
+    """
+    Return the limiter shared by all requests to the host of `url` through one egress.
+
+    Limiters are kept per process: every worker process of restweb-runner_multi paces
+    its requests on its own, so a host sees up to `runner_pool_size` times the rate.
+
+    Args:
+        url (str): URL of the request.
+        egress (str): Proxy the request is sent through, None for direct requests.
+
+    Returns:
+        AdaptiveRate or TokenBucket: The AIMD limiter, or with `scrape_adaptive_rate`
+            off a fixed bucket of `scrape_rate_per_host` (None = unlimited).
+    """
+    key = (egress, urlparse(url).netloc)
+    with _egress_limiters_lock:
+        if key not in _egress_limiters:
+            if scrape_adaptive_rate:
+                _egress_limiters[key] = AdaptiveRate(max_rate=scrape_rate_per_host or scrape_rate_max, burst=scrape_burst)
+            else:
+                _egress_limiters[key] = TokenBucket(scrape_rate_per_host, scrape_burst)
+        return _egress_limiters[key]
@@ -4,7 +4,13 @@ import requests
 from itsdangerous import URLSafeTimedSerializer
 from mysql_wrapper import MySQL
 from kleinanzeigen import Kleinanzeigen
-from datetime import datetime
+from job_matcher import JobMatcher
+from crawl_state import CrawlState
+from job_scheduler import JobScheduler
+from misc import local_now
+from webscraper import browser_pool
+import metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv, find_dotenv
 import os
 import config
@@ -28,73 +34,35 @@ restweb_matching_ids = MySQL(
     mysql_password=config.mysql_password
 )
 
+# Search areas crawled at the same time and seconds between job syncs, optional in config.py.
+# Every crawl needs at least one browser of the pool and takes up to 1 + scrape_concurrency
+# if free, so more parallel crawls than browsers would only wait for the pool.
+search_job_workers = getattr(config, 'search_job_workers', 1)
+search_job_sync_interval = getattr(config, 'search_job_sync_interval', 10)
+
+# Compiled filters of all jobs seen so far, rebuilt only when a job's filters change
+job_matcher = JobMatcher()
+
 def generate_token(data, expiration=3600):
     """Generate a token with an expiration time."""
     serializer = URLSafeTimedSerializer(SECRET_KEY)
     return serializer.dumps(data)
 
-def filter_dataframe(df, price_min=None, price_max=None, rooms_min=None, rooms_max=None, sqm_min=None, sqm_max=None, filter_include=None, filter_exclude=None):
+def group_jobs(jobs):
     """
-    Filters a pandas DataFrame based on the given criteria.
-
-    Parameters:
-    - df: pandas DataFrame to filter.
-    - price_min: Minimum price.
-    - price_max: Maximum price.
-    - rooms_min: Minimum number of rooms.
-    - rooms_max: Maximum number of rooms.
-    - sqm_min: Minimum size in square meters.
-    - sqm_max: Maximum size in square meters.
-    - filter_include: List of keywords to include in the title or description.
-    - filter_exclude: List of keywords to exclude from the title or description.
+    Group due jobs by search area so that every area is crawled once for all of them.
 
     Returns:
-    - Filtered pandas DataFrame.
+    - Dict mapping (zipcode, radius) to the list of job entries watching that area.
     """
-    # Apply price filter
-    if price_min is not None:
-        df = df[df['price'] >= price_min]
-    if price_max is not None:
-        df = df[df['price'] <= price_max]
-
-    # Apply rooms filter
-    if rooms_min is not None:
-        df = df[df['rooms'] >= rooms_min]
-    if rooms_max is not None:
-        df = df[df['rooms'] <= rooms_max]
-
-    # Apply size (sqm) filter
-    if sqm_min is not None:
-        df = df[df['size'] >= sqm_min]
-    if sqm_max is not None:
-        df = df[df['size'] <= sqm_max]
-
-    # Apply include filter
-    if filter_include is not None:
-        include_mask = df['title'].str.contains('|'.join(filter_include), case=False, na=False) | \
-                       df['description'].str.contains('|'.join(filter_include), case=False, na=False)
-        df = df[include_mask]
-
-    # Apply exclude filter
-    if filter_exclude is not None:
-        exclude_mask = ~(df['title'].str.contains('|'.join(filter_exclude), case=False, na=False) | \
-                         df['description'].str.contains('|'.join(filter_exclude), case=False, na=False))
-        df = df[exclude_mask]
-
-    return df
-
-def worker(entry):
-    """Process a job from the queue."""
-    job_start_time = datetime.now()
-
-    # Extract job details from the entry
-    job_id, user_id, zipcode, radius, price_min, price_max, rooms_min, rooms_max, sqm_min, sqm_max, filter_include, filter_exclude, is_active, last_run = entry
-
-    # Process filter_include and filter_exclude
-    filter_include = filter_include.split(",") if filter_include else None
-    filter_exclude = filter_exclude.split(",") if filter_exclude else None
-
-    # Define table name based on job details
+    groups = {}
+    for entry in jobs:
+        zipcode, radius = entry[2], entry[3]
+        groups.setdefault((zipcode, radius), []).append(entry)
+    return groups
+
+def get_job_end_index(job_id):
+    """Return the result ids of the last 100 offers matched by a job."""
     tablename = f"job_{job_id}"
 
     # Create a table for matching IDs if it doesn't exist
@@ -104,126 +72,185 @@ def worker(entry):
         types=config.mysql_types_matching_ids
     )
 
-    restweb_main.create_table(
-        table=config.mysql_results_table,
-        columns=config.mysql_columns,
-        types=config.mysql_types
-    )
-
-    restweb_main.create_table(
-        table=config.mysql_error_table,
-        columns=config.mysql_columns_err,
-        types=config.mysql_types_err
-    )
-
     job_matching_ids = [x[0] for x in restweb_matching_ids.get_table(tablename, ['id'], 
                                                  sort_by='created_at', 
                                                  max_entries=100, 
                                                  descending=True)]
-
-    print(job_matching_ids)
-    job_ids = [x[0] for x in restweb_main.get_table(config.mysql_results_table, ["id"], add_query=f"WHERE id_index in ({','.join(map(str, job_matching_ids))})")]
- 
-    print(job_ids)
+    if not job_matching_ids:
+        return []
+    return [x[0] for x in restweb_main.get_table(config.mysql_results_table, ["id"], add_query=f"WHERE id_index in ({','.join(map(str, job_matching_ids))})")]
+
+def crawl_area(zipcode, radius, end_index):
+    """Crawl the search pages of one area and scrape its new offers into the results table."""
+    crawl_state = CrawlState(restweb_main, CrawlState.query_key(
+        f"{Kleinanzeigen.SEARCH_TEMPLATE_URL}|{config.mysql_results_table}", zipcode, radius))
+    # Offers are scraped while the search pages are crawled, a retry skips the offers already written
     attempts = 0
     while attempts <= 5:
         attempts += 1
         try:
-            new_offers = Kleinanzeigen.get_search_offers(postalcode=zipcode, 
-                                radius=radius, 
-                                max_number=100,  
-                                end_index=job_ids)
-            break
+            offer_ids = Kleinanzeigen.crawl_to_mysql(mysql_obj=restweb_main,
+                                                     mysql_table=config.mysql_results_table,
+                                                     mysql_table_err=config.mysql_error_table,
+                                                     postalcode=zipcode,
+                                                     radius=radius,
+                                                     max_number=100,
+                                                     end_index=end_index,
+                                                     crawl_state=crawl_state)
+            crawl_state.save()
+            return offer_ids
         except Exception as e:
-            print(f"[REST][RESTWEB-RUNNER] Failed calling get_offer_indicies: {e}")
+            print(f"[REST][RESTWEB-RUNNER] Failed calling crawl_to_mysql: {e}")
+    return []
 
-    # existing_result_ids = restweb_main.get_table("results", ['id'])
-    # existing_result_ids = [x[0] for x in existing_result_ids]  
+def notify_job(entry, id_indices, job_start_time):
+    """Store the matched offers of one job and notify the API."""
+    job_id = entry[0]
 
-    # Sraping new offers and add to results table
-    attempts = 0
-    while attempts <= 5:
-        attempts += 1
-        try:
-            Kleinanzeigen.offers_to_mysql(offers = new_offers,
-                                          mysql_obj=restweb_main,
-                                          mysql_table=config.mysql_results_table,
-                                          mysql_table_err=config.mysql_error_table)
-            break
-        except Exception as e:
-            print(f"[REST][RESTWEB-RUNNER] Failed calling get_offer_indicies: {e}")
+    # Define table name based on job details
+    tablename = f"job_{job_id}"
 
+    restweb_matching_ids.write_list(
+        tablename,
+        config.mysql_columns_matching_ids[:-1],
+        [[int(x), job_start_time] for x in id_indices]
+    )
 
-    new_offers_ids = [x for x in new_offers.offers_indices]
-    # Fetch new entries from the database
-    df_entry = restweb_main.get_dataframe(
+    # Generate a token for API authorization
+    token = generate_token(job_id)
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
+    }
+    payload = {
+        'indicies': [int(x) for x in id_indices],
+        'tablename': tablename
+    }
+
+    # Send the request to the API
+    response = requests.post(config.api_url+"/notify", json=payload, headers=headers)
+    print(f"[REST][RESWEB-RUNNER] Send {len(id_indices)} offers to api for Job {job_id}")
+
+def worker(zipcode, radius, entries):
+    """Crawl one search area once and fan its new offers out to all jobs watching it."""
+    job_start_time = local_now()
+    print(f"[REST][RESWEB-RUNNER] Crawling {zipcode} r{radius} for jobs {[x[0] for x in entries]}")
+
+    # Crawling stops at the first offer already matched by any of the jobs
+    end_index = sorted({x for entry in entries for x in get_job_end_index(entry[0])})
+    new_offers_ids = crawl_area(zipcode, radius, end_index)
+    if not new_offers_ids:
+        return
+
+    # Fetch new entries from the database, once for all jobs of the area. Jobs that never ran match all of them.
+    last_runs = [entry[-1] for entry in entries]
+    since = f"timestamp > '{min(last_runs)}' AND " if None not in last_runs else ""
+    df_new = restweb_main.get_dataframe(
         table='results',
         column="*",
-        add_query=f"WHERE timestamp > '{last_run}' AND id in ({','.join(map(str, new_offers_ids))})"
+        add_query=f"WHERE {since}id in ({','.join(map(str, new_offers_ids))})"
     )
+    if df_new is None:
+        return
+
+    # Match all jobs of the area in one pass
+    matches = {}
+    with metrics.timed('match'):
+        matched = job_matcher.match(df_new, entries)
+    for job_id, id_index in matched:
+        matches.setdefault(job_id, []).append(id_index)
+
+    for entry in entries:
+        if entry[0] not in matches:
+            continue
+        try:
+            with metrics.timed('notify'):
+                notify_job(entry, matches[entry[0]], job_start_time)
+        except Exception as e:
+            print(f"[REST][RESTWEB-RUNNER] Failed notifying job {entry[0]}: {e}")
 
+def prepare_tables():
+    """Create the shared results and error tables if they don't exist."""
+    restweb_main.create_table(
+        table=config.mysql_results_table,
+        columns=config.mysql_columns,
+        types=config.mysql_types
+    )
 
-    # Filter the DataFrame based on job criteria
-    df_entry_filtered = filter_dataframe(
-        df_entry,
-        price_min,
-        price_max,
-        rooms_min,
-        rooms_max,
-        sqm_min,
-        sqm_max,
-        filter_include,
-        filter_exclude
+    restweb_main.create_table(
+        table=config.mysql_error_table,
+        columns=config.mysql_columns_err,
+        types=config.mysql_types_err
     )
 
-    # If there are matching results, write them to the database and notify via API
-    if len(df_entry_filtered) > 0:
-        restweb_matching_ids.write_list(
-            tablename,
-            config.mysql_columns_matching_ids[:-1],
-            [[int(x), job_start_time] for x in df_entry_filtered.id_index.values]
+def finish_jobs(scheduler, entries):
+    """Store the run of jobs and schedule their next run."""
+    # Same clock as the result timestamps, which offers are matched against last_run
+    last_run = local_now()
+    job_ids = ','.join(str(x[0]) for x in entries)
+    try:
+        # The change log trigger skips updates that only move last_run
+        restweb_main.execute(
+            f"UPDATE search_jobs SET last_run = '{last_run}' WHERE id IN ({job_ids});"
         )
-
-        # Generate a token for API authorization
-        token = generate_token(job_id)
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            'indicies': df_entry_filtered.id_index.values.tolist(),
-            'tablename': tablename
-        }
-
-        # Send the request to the API
-        response = requests.post(config.api_url+"/notify", json=payload, headers=headers)
-        print(f"[REST][RESWEB-RUNNER] Send {len(df_entry_filtered)} offers to api for Job {job_id}")
+    except Exception as e:
+        print(f"[REST][RESTWEB-RUNNER] Failed updating last_run of jobs {job_ids}: {e}")
+    scheduler.done(entries, last_run)
 
 def outer_loop():
-    """Continuously check for new jobs and process them."""
-    while True:
-        print("[REST][RESWEB-RUNNER] Checking for jobs to run")
-
-        # Fetch new jobs that are active and haven't been run in the last 5 minutes
-        jobs_to_execute = restweb_main.execute(
-            query="SELECT * FROM search_jobs WHERE is_active = 1 AND last_run < (CONVERT_TZ(NOW(), @@session.time_zone, 'Europe/Berlin') - INTERVAL 5 MINUTE);",
-            fetch=True
-        )
-        print(jobs_to_execute)
-
-        # Process each new job
-        for job in jobs_to_execute:
-            print(f'## START: {job}')
-            worker(job)
-            job_id = job[0]
-
-            # Update the last_run timestamp for the job
-            restweb_main.execute(
-                f"UPDATE search_jobs SET last_run = '{datetime.now()}' WHERE id = {job_id};"
-            )
-
-        # Wait for 30 seconds before checking again
-        time.sleep(30)
+    """Run every job as soon as it is due, keeping the jobs in sync with the database."""
+    prepare_tables()
+    metrics.start_http_server()
+    scheduler = JobScheduler(restweb_main)
+    running = {}
+    waiting = {}
+    next_sync = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(search_job_workers, browser_pool().size))) as executor:
+        while True:
+            if time.monotonic() >= next_sync:
+                try:
+                    job_matcher.remove(scheduler.sync())
+                except Exception as e:
+                    print(f"[REST][RESTWEB-RUNNER] Failed syncing jobs: {e}")
+                next_sync = time.monotonic() + search_job_sync_interval
+                metrics.log_snapshot()
+
+            # Jobs of an area that is crawled right now wait for that crawl to end
+            for area, entries in group_jobs(scheduler.pop_due()).items():
+                waiting.setdefault(area, []).extend(entries)
+            busy = {area for area, _ in running.values()}
+            for area in [x for x in waiting if x not in busy]:
+                entries = waiting.pop(area)
+                now = local_now()
+                for entry in entries:
+                    due = scheduler.due_time(entry[0])
+                    if due is not None:
+                        metrics.observe('scraper_job_lag_seconds', max((now - due).total_seconds(), 0))
+                metrics.log_event('crawl_start', zipcode=area[0], radius=area[1], jobs=[x[0] for x in entries])
+                print(f'## START: {[x[0] for x in entries]}')
+                running[executor.submit(worker, *area, entries)] = (area, entries)
+
+            metrics.set_gauge('scraper_jobs_scheduled', scheduler.pending())
+            metrics.set_gauge('scraper_jobs_due', sum(len(x) for x in waiting.values()))
+
+            # Sleep until the next job is due, a crawl ends or the jobs are synced again
+            timeout = next_sync - time.monotonic()
+            next_due = scheduler.next_due()
+            if next_due is not None:
+                timeout = min(timeout, (next_due - local_now()).total_seconds())
+            if not running:
+                time.sleep(max(timeout, 0))
+                continue
+            finished, _ = wait(running, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for future in finished:
+                area, entries = running.pop(future)
+                try:
+                    future.result()
+                    metrics.inc('scraper_jobs_total', len(entries), result='ok')
+                except Exception as e:
+                    metrics.inc('scraper_jobs_total', len(entries), result='error')
+                    print(f"[REST][RESTWEB-RUNNER] Failed running jobs {[x[0] for x in entries]}: {e}")
+                finish_jobs(scheduler, entries)
 
 if __name__ == "__main__":
     # Start the outer loop to continuously check for and process jobs
@@ -4,11 +4,16 @@ import requests
 from itsdangerous import URLSafeTimedSerializer
 from mysql_wrapper import MySQL
 from kleinanzeigen import Kleinanzeigen
-from datetime import datetime
+from job_matcher import JobMatcher
 from dotenv import load_dotenv, find_dotenv
 import os
 import config
-from multiprocessing import Process, Queue
+import misc
+from misc import local_now
+from webscraper import browser_pool
+from worker_pool import WorkerPool
+import metrics
+from datetime import timedelta
 
 # Load environment variables from .env file
 load_dotenv(find_dotenv())
@@ -36,177 +41,129 @@ restweb_matching_ids = MySQL(
     mysql_password=config.mysql_password
 )
 
+# Compiled filters of the jobs run by this worker process, kept between its tasks
+job_matcher = JobMatcher()
+
 def generate_token(data, expiration=3600):
     """Generate a token with an expiration time."""
     serializer = URLSafeTimedSerializer(SECRET_KEY)
     return serializer.dumps(data)
 
-def filter_dataframe(df, price_min=None, price_max=None, rooms_min=None, rooms_max=None, sqm_min=None, sqm_max=None, filter_include=None, filter_exclude=None):
-    """
-    Filters a pandas DataFrame based on the given criteria.
-    """
-    # Apply price filter
-    if price_min is not None:
-        df = df[df['price'] >= price_min]
-    if price_max is not None:
-        df = df[df['price'] <= price_max]
-
-    # Apply rooms filter
-    if rooms_min is not None:
-        df = df[df['rooms'] >= rooms_min]
-    if rooms_max is not None:
-        df = df[df['rooms'] <= rooms_max]
-
-    # Apply size (sqm) filter
-    if sqm_min is not None:
-        df = df[df['size'] >= sqm_min]
-    if sqm_max is not None:
-        df = df[df['size'] <= sqm_max]
-
-    # Apply include filter
-    if filter_include is not None:
-        include_mask = df['title'].str.contains('|'.join(filter_include), case=False, na=False) | \
-                       df['description'].str.contains('|'.join(filter_include), case=False, na=False)
-        df = df[include_mask]
-
-    # Apply exclude filter
-    if filter_exclude is not None:
-        exclude_mask = ~(df['title'].str.contains('|'.join(filter_exclude), case=False, na=False) | \
-                         df['description'].str.contains('|'.join(filter_exclude), case=False, na=False))
-        df = df[exclude_mask]
-
-    return df
-
-def worker(entry, result_queue):
-    """Process a job from the queue."""
-    try:
-        job_start_time = datetime.now()
-
-        # Extract job details from the entry
-        job_id, user_id, zipcode, radius, price_min, price_max, rooms_min, rooms_max, sqm_min, sqm_max, filter_include, filter_exclude, is_active, last_run = entry
-
-        # Process filter_include and filter_exclude
-        filter_include = filter_include.split(",") if filter_include else None
-        filter_exclude = filter_exclude.split(",") if filter_exclude else None
-
-        # Define table name based on job details
-        tablename = f"{job_id}_{zipcode}_{radius}"
-
-        # Run Kleinanzeigen search
-        Kleinanzeigen.runner(
-            MySQL_DB=restweb_searchjobs,
-            postalcode=zipcode,
-            radius=radius,
-            tablename=tablename
-        )
-
-        # Fetch new entries from the database
-        df_entry = restweb_searchjobs.get_dataframe(
-            table=tablename,
-            column="*",
-            add_query=f"WHERE timestamp > '{job_start_time}'"
-        )
-
-        # Filter the DataFrame based on job criteria
-        df_entry_filtered = filter_dataframe(
-            df_entry,
-            price_min,
-            price_max,
-            rooms_min,
-            rooms_max,
-            sqm_min,
-            sqm_max,
-            filter_include,
-            filter_exclude
-        )
-
-        # Create a table for matching IDs if it doesn't exist
-        restweb_matching_ids.create_table(
-            table=tablename,
-            columns=config.mysql_columns_matching_ids,
-            types=config.mysql_types_matching_ids
+def warm_up():
+    """Start the browser and open the database connections of a worker process once."""
+    with browser_pool().session():
+        pass
+    for mysql_obj in (restweb_searchjobs, restweb_matching_ids):
+        mysql_obj.connect().close()
+
+def worker(entry):
+    """Process a job in a worker process of the pool."""
+    job_start_time = local_now()
+
+    # Extract job details from the entry
+    job_id, zipcode, radius = entry[0], entry[2], entry[3]
+
+    # Define table name based on job details
+    tablename = f"{job_id}_{zipcode}_{radius}"
+
+    # Run Kleinanzeigen search
+    Kleinanzeigen.runner(
+        MySQL_DB=restweb_searchjobs,
+        postalcode=zipcode,
+        radius=radius,
+        tablename=tablename
+    )
+
+    # Fetch new entries from the database
+    df_entry = restweb_searchjobs.get_dataframe(
+        table=tablename,
+        column="*",
+        add_query=f"WHERE timestamp > '{job_start_time}'"
+    )
+
+    # Match the offers of this run against the job's criteria
+    with metrics.timed('match'):
+        id_indices = [x for _, x in job_matcher.match(df_entry, [tuple(entry[:-1]) + (job_start_time,)])]
+
+    # Create a table for matching IDs if it doesn't exist
+    restweb_matching_ids.create_table(
+        table=tablename,
+        columns=config.mysql_columns_matching_ids,
+        types=config.mysql_types_matching_ids
+    )
+
+    # If there are matching results, write them to the database and notify via API
+    if id_indices:
+        restweb_matching_ids.write_list(
+            tablename,
+            config.mysql_columns_matching_ids[:-1],
+            [[int(x), job_start_time] for x in id_indices]
         )
 
-        # If there are matching results, write them to the database and notify via API
-        if len(df_entry_filtered) > 0:
-            restweb_matching_ids.write_list(
-                tablename,
-                config.mysql_columns_matching_ids[:-1],
-                [[int(x), job_start_time] for x in df_entry_filtered.id_index.values]
-            )
-
-            # Generate a token for API authorization
-            token = generate_token(job_id)
-            headers = {
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'
-            }
-            payload = {
-                'indicies': df_entry_filtered.id_index.values.tolist(),
-                'tablename': tablename
-            }
-
-            # Send the request to the API
+        # Generate a token for API authorization
+        token = generate_token(job_id)
+        headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        payload = {
+            'indicies': id_indices,
+            'tablename': tablename
+        }
+
+        # Send the request to the API
+        with metrics.timed('notify'):
             response = requests.post(config.api_url, json=payload, headers=headers)
 
-        # Put the result in the queue
-        result_queue.put((job_id, True))  # (job_id, success)
-    except Exception as e:
-        result_queue.put((job_id, False, str(e)))  # (job_id, success, error_message)
+    return job_id
+
 
 def outer_loop():
-    """Continuously check for new jobs and process them using multiprocessing."""
-    while True:
-        print("# Checking for jobs to run")
-
-        # Fetch new jobs that are active and haven't been run in the last 5 minutes
-        new_entries = restweb_main.execute(
-            query="SELECT * FROM search_jobs WHERE is_active = 1 AND last_run < NOW() - INTERVAL 5 MINUTE",
-            fetch=True
-        )
-        print(new_entries)
-
-        # Use a Queue to collect results from worker processes
-        result_queue = Queue()
-
-        # Create a list to hold active processes
-        processes = []
-
-        # Process each new job using multiprocessing
-        for entry in new_entries:
-            print(f'## START: {entry}')
-            job_id = entry[0]
-
-            # Create a new process for the worker
-            process = Process(target=worker, args=(entry, result_queue))
-            process.start()
-            processes.append(process)
-
-            # Limit the number of concurrent processes to 4
-            if len(processes) >= 4:
-                # Wait for the first process to finish
-                processes[0].join()
-                processes.pop(0)
-
-        # Wait for all remaining processes to finish
-        for process in processes:
-            process.join()
-
-        # Collect results from the queue
-        while not result_queue.empty():
-            result = result_queue.get()
-            job_id, success, *error_message = result
-            if success:
-                print(f"Job {job_id} completed successfully.")
-                # Update the last_run timestamp for the job
-                restweb_main.execute(
-                    f"UPDATE search_jobs SET last_run = '{datetime.now()}' WHERE id = {job_id};"
-                )
-            else:
-                print(f"Job {job_id} failed with error: {error_message[0]}")
-
-        # Wait for 30 seconds before checking again
-        time.sleep(30)
+    """Continuously check for due jobs and hand them to the worker pool."""
+    metrics.start_http_server()
+    pool = WorkerPool(target=worker, initializer=warm_up)
+    try:
+        while True:
+            print("# Checking for jobs to run")
+
+            # Fetch new jobs that are active and haven't been run in the last 5 minutes
+            new_entries = restweb_main.execute(
+                query="SELECT * FROM search_jobs WHERE is_active = 1 AND (last_run IS NULL OR "
+                      f"last_run < CONVERT_TZ(NOW(), @@session.time_zone, '{misc.time_zone}') - INTERVAL 5 MINUTE)",
+                fetch=True
+            )
+            print(new_entries)
+
+            # Jobs still queued or running are not queued again
+            in_flight = pool.in_flight()
+            for entry in new_entries:
+                if entry[0] not in in_flight:
+                    # Jobs are due five minutes after their last run
+                    if entry[-1] is not None:
+                        lag = local_now() - (entry[-1] + timedelta(minutes=5))
+                        metrics.observe('scraper_job_lag_seconds', max(lag.total_seconds(), 0))
+                    print(f'## START: {entry}')
+                    pool.submit(entry[0], entry)
+
+            metrics.set_gauge('scraper_jobs_due', pool.queue_depth())
+
+            # Collect results for 30 seconds before checking again
+            next_check = time.monotonic() + 30
+            while time.monotonic() < next_check:
+                for job_id, success, result, slot in pool.poll(timeout=next_check - time.monotonic()):
+                    metrics.inc('scraper_jobs_total', result='ok' if success else 'error')
+                    if success:
+                        print(f"Job {job_id} completed successfully on worker {slot}.")
+                        # Update the last_run timestamp for the job
+                        restweb_main.execute(
+                            f"UPDATE search_jobs SET last_run = '{local_now()}' WHERE id = {job_id};"
+                        )
+                    else:
+                        print(f"Job {job_id} failed on worker {slot} with error: {result}")
+            print(f"# Workers: {pool.metrics()}")
+            metrics.log_snapshot()
+    finally:
+        pool.shutdown()
 
 if __name__ == "__main__":
     # Start the outer loop to continuously check for and process jobs
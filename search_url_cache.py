@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import fcntl
+import tempfile
+import threading
+import config
+
+# File persisting resolved search URL templates across runs, optional in config.py
+search_url_cache_file = getattr(config, 'search_url_cache_file',
+                                os.path.join(getattr(config, 'tmp_folder', '.'), 'search_url_cache.json'))
+
+
+class SearchUrlCache:
+    """
+    Persistent mapping of (category URL, postal code) to the resolved search URL template.
+
+    Args:
+        path (str): JSON file the cache is stored in.
+    """
+    def __init__(self, path=search_url_cache_file):
+        self.path = path
+        self._lock = threading.Lock()
+        self.urls = self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(category_url, postalcode):
+        return f"{category_url}|{postalcode or ''}"
+
+    def get(self, category_url, postalcode):
+        with self._lock:
+            return self.urls.get(self.key(category_url, postalcode))
+
+    def set(self, category_url, postalcode, url):
+        """Store a resolved URL template and write the cache file atomically."""
+        self.__update(lambda urls: urls.__setitem__(self.key(category_url, postalcode), url))
+
+    def invalidate(self, category_url, postalcode):
+        """Drop a URL template, from the cache file as well."""
+        self.__update(lambda urls: urls.pop(self.key(category_url, postalcode), None))
+
+    def __update(self, change):
+        # Processes sharing the file merge their changes under a file lock, each writing its own temp file
+        with self._lock:
+            change(self.urls)
+            try:
+                with open(self.path + '.lock', 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    urls = self.__load()
+                    change(urls)
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                                    prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+                    try:
+                        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                            json.dump(urls, f, indent=1, sort_keys=True)
+                        os.replace(tmp_path, self.path)
+                    except BaseException:
+                        os.remove(tmp_path)
+                        raise
+                self.urls = urls
+            except OSError as e:
+                print('[PYTHON][SEARCH_URL_CACHE][WARNING] Could not write {}: {}'.format(self.path, e))
+
+
+_search_url_cache = None
+
+def search_url_cache():
+    """Return the search URL cache of this process."""
+    global _search_url_cache
+    if _search_url_cache is None:
+        _search_url_cache = SearchUrlCache()
+    return _search_url_cache
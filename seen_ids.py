@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+
+class SeenIds:
+    """
+    Incrementally updated set of offer ids known to exist in a table.
+
+    Only candidate ids not yet known are checked against the database, with an
+    indexed `WHERE id IN (...)` query, so the cost of a check depends on the
+    number of candidates and not on the size of the table.
+
+    Args:
+        mysql_obj (MySQL): Database holding the table.
+        table (str): The table with an `id` column.
+
+    Attributes:
+        ids (set): Ids known to exist in the table.
+    """
+    def __init__(self, mysql_obj, table):
+        self.mysql_obj = mysql_obj
+        self.table = table
+        self.ids = set()
+        self._lock = threading.Lock()
+
+    def filter_new(self, candidates):
+        """
+        Returns the candidates not present in the table, keeping their order.
+
+        Args:
+            candidates (list[int]): Offer ids to check.
+        """
+        with self._lock:
+            unknown = [x for x in candidates if x not in self.ids]
+        existing = self.mysql_obj.get_existing_ids(self.table, unknown)
+        with self._lock:
+            self.ids.update(int(x) for x in existing)
+            return [x for x in candidates if x not in self.ids]
+
+    def add(self, ids):
+        """Record ids that were written to the table."""
+        with self._lock:
+            self.ids.update(int(x) for x in ids)
+
+
+_seen_ids = {}
+_seen_ids_lock = threading.Lock()
+
+def seen_ids(mysql_obj, table):
+    """Return the process-wide SeenIds of a table in the database of `mysql_obj`."""
+    key = (mysql_obj.host, mysql_obj.database, table)
+    with _seen_ids_lock:
+        if key not in _seen_ids:
+            _seen_ids[key] = SeenIds(mysql_obj, table)
+        return _seen_ids[key]
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from webscraper import (HTTPFetcher, FallbackFetcher, ChallengeException, classify_response,
+                        EMPTY_PAGE_LENGTH, CONSENT_WALL_MAX_LENGTH)
+from ratelimit import OK, BLOCKED, EMPTY, ERROR
+
+OFFER_PAGE = '<html><head><title>Wohnung</title></head><body>' + 'Helle 3-Zimmer-Wohnung. ' * 100 + '</body></html>'
+CHALLENGE_PAGE = '<html><head><title>Access Denied</title></head><body>' + 'x' * EMPTY_PAGE_LENGTH + '</body></html>'
+CONSENT_PAGE = '<html><body><div id="gdpr-banner">Cookies akzeptieren</div>' + 'x' * EMPTY_PAGE_LENGTH + '</body></html>'
+BROWSER_PAGE = '<html><body>loaded in the browser</body></html>'
+
+# Path -> (status, body) served by the local test server
+PAGES = {
+    '/offer': (200, OFFER_PAGE),
+    '/challenge': (200, CHALLENGE_PAGE),
+    '/forbidden': (403, OFFER_PAGE),
+    '/too-many': (429, OFFER_PAGE),
+    '/consent': (200, CONSENT_PAGE),
+    '/error': (500, OFFER_PAGE),
+}
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, body = PAGES.get(self.path, (404, 'not found'))
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeScraper:
+    """Stands in for the browser session of a FallbackFetcher and records the pages it loads."""
+    def __init__(self):
+        self.fetched = []
+
+    def user_agent(self):
+        return 'test-agent'
+
+    def cookies(self):
+        return [{'name': 'consent', 'value': '1', 'domain': '127.0.0.1', 'path': '/'}]
+
+    def fetch(self, url):
+        self.fetched.append(url)
+        return BROWSER_PAGE
+
+    def current_url(self):
+        return self.fetched[-1] if self.fetched else None
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def http_fetcher():
+    fetcher = HTTPFetcher(user_agent='test-agent', timeout=5)
+    # Talk to the local server directly, even if config.py sets a proxy
+    fetcher.session.proxies.clear()
+    fetcher.session.trust_env = False
+    yield fetcher
+    fetcher.close()
+
+
+@pytest.fixture
+def fallback_fetcher(http_fetcher):
+    fetcher = FallbackFetcher(FakeScraper(), timeout=5)
+    fetcher.http = http_fetcher
+    return fetcher
+
+
+def test_http_fetcher_fetches_page(server, http_fetcher):
+    assert http_fetcher.fetch(server + '/offer') == OFFER_PAGE
+    assert http_fetcher.current_url() == server + '/offer'
+    assert http_fetcher.content() == OFFER_PAGE
+
+
+@pytest.mark.parametrize('path', ['/challenge', '/forbidden', '/too-many', '/consent'])
+def test_http_fetcher_raises_on_blocked_page(server, http_fetcher, path):
+    with pytest.raises(ChallengeException):
+        http_fetcher.fetch(server + path)
+
+
+def test_http_fetcher_raises_on_server_error(server, http_fetcher):
+    with pytest.raises(requests.HTTPError):
+        http_fetcher.fetch(server + '/error')
+
+
+def test_fallback_fetcher_uses_http_for_regular_page(server, fallback_fetcher):
+    assert fallback_fetcher.fetch(server + '/offer') == OFFER_PAGE
+    assert not fallback_fetcher.challenged
+    assert fallback_fetcher.scraper.fetched == []
+
+
+@pytest.mark.parametrize('path', ['/challenge', '/forbidden', '/too-many', '/consent'])
+def test_fallback_fetcher_falls_back_to_browser(server, fallback_fetcher, path):
+    assert fallback_fetcher.fetch(server + path) == BROWSER_PAGE
+    assert fallback_fetcher.challenged
+    assert fallback_fetcher.scraper.fetched == [server + path]
+    assert fallback_fetcher.current_url() == server + path
+    # The browser cookies are handed back to the HTTP session
+    assert fallback_fetcher.http.session.cookies.get('consent') == '1'
+
+    # The next regular page goes over HTTP again
+    assert fallback_fetcher.fetch(server + '/offer') == OFFER_PAGE
+    assert not fallback_fetcher.challenged
+
+
+@pytest.mark.parametrize('content, status, expected', [
+    (OFFER_PAGE, 200, OK),
+    (OFFER_PAGE, None, OK),
+    (CHALLENGE_PAGE, 200, BLOCKED),
+    (OFFER_PAGE, 403, BLOCKED),
+    (None, 429, BLOCKED),
+    (CONSENT_PAGE, 200, BLOCKED),
+    # Consent markers on a page long enough to hold regular content are ignored
+    (CONSENT_PAGE + 'x' * CONSENT_WALL_MAX_LENGTH, 200, OK),
+    (None, None, EMPTY),
+    ('', 200, EMPTY),
+    ('<html><body></body></html>', 200, EMPTY),
+    (OFFER_PAGE, 500, ERROR),
+    (None, 503, ERROR),
+])
+def test_classify_response(content, status, expected):
+    assert classify_response(content, status) == expected
@@ -1,15 +1,112 @@
-import signal
+import time
+import contextvars
 from contextlib import contextmanager
 
-class TimeoutException(Exception): pass
+class TimeoutException(Exception):
+    """
+    Raised when a task runs past its deadline.
+
+    Attributes:
+        stage (str): Name of the stage that was running when the deadline passed.
+        seconds (float): The time limit of the deadline.
+    """
+    def __init__(self, stage=None, seconds=None):
+        self.stage = stage
+        self.seconds = seconds
+        message = "Timed out!"
+        if stage:
+            message = "Timed out in stage '{}'".format(stage)
+        if seconds is not None:
+            message += " (limit {}s)".format(seconds)
+        super().__init__(message)
+
+
+class Deadline:
+    """
+    Point in time a task has to finish by.
+
+    Unlike an alarm signal a deadline never interrupts running code. Blocking calls
+    take `remaining()` as their own timeout and `check()` raises between stages, so
+    it works in any thread and in asyncio tasks.
+
+    Args:
+        seconds (float): Time limit from now.
+
+    Attributes:
+        stage (str): Name of the stage currently running.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+        self.stage = None
+
+    def remaining(self):
+        """Seconds left until the deadline, never negative."""
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def check(self, stage=None):
+        """Raise TimeoutException if the deadline has passed."""
+        if self.expired():
+            raise TimeoutException(stage or self.stage, self.seconds)
+
+
+# Deadline of the task running in the current thread or asyncio task
+_current_deadline = contextvars.ContextVar('deadline', default=None)
+
+def current_deadline():
+    """Return the active Deadline, None outside of a `deadline` block."""
+    return _current_deadline.get()
+
+def remaining(default=None):
+    """Return the seconds left of the active deadline, `default` if there is none."""
+    current = _current_deadline.get()
+    return default if current is None else current.remaining()
+
+@contextmanager
+def deadline(seconds):
+    """
+    Run the block under a deadline of `seconds`.
+
+    Nested deadlines never extend an outer one.
+    """
+    outer = _current_deadline.get()
+    current = Deadline(seconds)
+    if outer is not None and outer.expires < current.expires:
+        current.expires = outer.expires
+    token = _current_deadline.set(current)
+    try:
+        yield current
+    finally:
+        _current_deadline.reset(token)
 
 @contextmanager
-def time_limit(seconds):
-    def signal_handler(signum, frame):
-        raise TimeoutException("Timed out!")
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
+def stage(name):
+    """
+    Mark a stage of the current task.
+
+    Raises TimeoutException naming the stage if the deadline passed before the
+    stage starts or while it runs, including errors of calls that were given the
+    remaining time as timeout. Without an active deadline this does nothing.
+    """
+    current = _current_deadline.get()
+    if current is None:
+        yield
+        return
+    current.check(name)
+    outer_stage, current.stage = current.stage, name
     try:
         yield
+    except TimeoutException:
+        raise
+    except Exception as e:
+        # Driver and socket timeouts cut short by the deadline are reported as such
+        if current.expired():
+            raise TimeoutException(name, current.seconds) from e
+        raise
+    else:
+        current.check(name)
     finally:
-        signal.alarm(0)
\ No newline at end of file
+        current.stage = outer_stage
@@ -2,13 +2,86 @@
 # -*- coding: utf-8 -*-
 
 import os
+import atexit
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import urlparse
 import numpy as np
+import requests
 import undetected_chromedriver as uc
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import Select
+from selenium.webdriver.support.ui import Select, WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.service import Service
+import config
 from config import chromedriver_path, webscraper_proxy
+from timeout import remaining, stage, current_deadline
+from page_cache import page_cache, CachedFetcher
+from ratelimit import egress_limiter, OK, BLOCKED, EMPTY, ERROR
+import metrics
+
+# Browser pool settings, optional in config.py
+webscraper_pool_size = getattr(config, 'webscraper_pool_size', 1)
+webscraper_recycle_after = getattr(config, 'webscraper_recycle_after', 500)
+# Page fetch backend: 'selenium' drives the browser for every page, 'http' uses a plain HTTP session
+webscraper_backend = getattr(config, 'webscraper_backend', 'selenium')
+
+# Markers of bot-challenge / access-denied pages served instead of the requested content
+CHALLENGE_MARKERS = (
+    '<title>Access Denied</title>',
+    'challenge-platform',
+    'cf-browser-verification',
+    'px-captcha',
+    'captcha-delivery.com',
+    '_Incapsula_Resource',
+)
+CHALLENGE_STATUS_CODES = (403, 429)
+# Markers of cookie consent walls, only counted on pages too short to hold regular content
+CONSENT_MARKERS = (
+    'gdpr-banner',
+    'consentmanager',
+    'cookie-consent',
+)
+CONSENT_WALL_MAX_LENGTH = 20000
+# Pages shorter than this are counted as empty responses
+EMPTY_PAGE_LENGTH = 512
+# Page load timeout of chromedriver when none is set
+DEFAULT_PAGE_LOAD_TIMEOUT = 300
+
+def is_challenge_page(content):
+    """Check whether a page source is a bot-challenge page instead of regular content."""
+    return any(marker in content for marker in CHALLENGE_MARKERS)
+
+def classify_response(content, status=None):
+    """
+    Classify a response for the rate control.
+
+    Args:
+        content (str): Page source, None if there is none.
+        status (int): HTTP status code, if known.
+
+    Returns:
+        str: BLOCKED for bot challenges, captcha and consent walls, EMPTY for missing or
+            near-empty pages, ERROR for server errors and OK otherwise.
+    """
+    if status in CHALLENGE_STATUS_CODES or (content and is_challenge_page(content)):
+        return BLOCKED
+    if status is not None and status >= 500:
+        return ERROR
+    if not content or len(content) < EMPTY_PAGE_LENGTH:
+        return EMPTY
+    if len(content) < CONSENT_WALL_MAX_LENGTH and any(marker in content for marker in CONSENT_MARKERS):
+        return BLOCKED
+    return OK
+
+@lru_cache(maxsize=None)
+def get_chrome_version():
+    """Return the major version of the installed Chromium, determined once per process."""
+    return int(os.popen('chromium-browser --version').read().split()[1].split('.')[0])
 
 class WebScraper:
     """
@@ -23,15 +96,22 @@ class WebScraper:
         proxy (str): Proxy server for the browser.
         driver (webdriver.Chrome): Chrome WebDriver instance.
         content (str): Page source content of the loaded web page.
+        pages_loaded (int): Number of pages loaded since the browser was started.
+        page_load_timeout (float): Page load timeout in seconds, shortened to the
+            remaining time when a task deadline is active.
     """
     def __init__(self):
         self.chrome_driver_path = chromedriver_path
         self.proxy = webscraper_proxy
-        self.driver = self.__init_driver()
+        self.pages_loaded = 0
+        self.page_load_timeout = DEFAULT_PAGE_LOAD_TIMEOUT
+        self._applied_page_load_timeout = DEFAULT_PAGE_LOAD_TIMEOUT
+        with metrics.timed('browser_start'):
+            self.driver = self.__init_driver()
         
     def __init_driver(self):
         # Determine the version of Chrome
-        self.chrome_version = int(os.popen('chromium-browser --version').read().split()[1].split('.')[0])
+        self.chrome_version = get_chrome_version()
 
         self.port = np.random.randint(9000,15000)
         
@@ -67,13 +147,53 @@ class WebScraper:
         return driver
     
     def url(self, url):
-        self.driver.get(url)
+        self.__apply_page_load_timeout()
+        with metrics.timed('page_load', backend='selenium'):
+            self.driver.get(url)
+        self.pages_loaded += 1
+        metrics.inc('scraper_pages_total', backend='selenium')
+
+    def set_page_load_timeout(self, seconds):
+        """Limit the time a page load may take before the driver raises."""
+        self.page_load_timeout = seconds
+        self.__apply_page_load_timeout()
+
+    def __apply_page_load_timeout(self):
+        # The page load timeout of the driver is bounded by the deadline of the current task
+        seconds = self.page_load_timeout
+        left = remaining()
+        if left is not None:
+            seconds = max(min(seconds, left), 0.01)
+        if seconds != self._applied_page_load_timeout:
+            self.driver.set_page_load_timeout(seconds)
+            self._applied_page_load_timeout = seconds
+
+    def is_alive(self):
+        """Check whether the browser session still responds."""
+        try:
+            self.driver.execute_script('return 1')
+            return True
+        except Exception:
+            return False
 
     def current_url(self):
         return self.driver.current_url
 
     def content(self):
         return self.driver.page_source
+
+    def fetch(self, url):
+        """Load a URL and return its page source."""
+        self.url(url)
+        return self.content()
+
+    def user_agent(self):
+        """Return the user agent string of the browser."""
+        return self.driver.execute_script('return navigator.userAgent')
+
+    def cookies(self):
+        """Return the cookies of the current browser session."""
+        return self.driver.get_cookies()
     
     def snapshot(self, filename):
         """Take a screenshot of the current page and save it to a file."""
@@ -89,6 +209,22 @@ class WebScraper:
         form_field = self.driver.find_element(By.ID, form_id)
         form_field.send_keys(input1)
 
+    def is_present(self, by, value):
+        """Check right away, without waiting, whether an element is on the page."""
+        return bool(self.driver.find_elements(by, value))
+
+    def wait_for_clickable(self, by, value, timeout=10):
+        """Wait until an element is visible and enabled and return it."""
+        return WebDriverWait(self.driver, timeout).until(EC.element_to_be_clickable((by, value)))
+
+    def wait_for_invisible(self, by, value, timeout=10):
+        """Wait until an element is hidden or removed from the page."""
+        WebDriverWait(self.driver, timeout).until(EC.invisibility_of_element_located((by, value)))
+
+    def wait_for_url_change(self, url, timeout=10):
+        """Wait until the browser navigated away from `url`."""
+        WebDriverWait(self.driver, timeout).until(EC.url_changes(url))
+
     def click_button_xpath(self, xpath):
         """Click an HTML button using its XPath."""
         button = self.driver.find_element(By.XPATH, value=xpath)
@@ -128,7 +264,379 @@ class WebScraper:
     def shutdown(self):
         self.driver.close()
         self.driver.quit()
-        
+
+
+class BrowserPool:
+    """
+    A pool of long-lived WebScraper sessions that are checked out and returned.
+
+    Sessions are started lazily up to `size`, health-checked on checkout and
+    return, and replaced after `recycle_after` page loads.
+
+    Args:
+        size (int): Maximum number of browser sessions kept by the pool.
+        recycle_after (int): Number of page loads after which a session is replaced.
+
+    Attributes:
+        pid (int): Process id owning the browsers of this pool.
+    """
+    def __init__(self, size=webscraper_pool_size, recycle_after=webscraper_recycle_after):
+        self.size = size
+        self.recycle_after = recycle_after
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Check out a healthy browser session, starting a new one if the pool is not full.
+
+        Args:
+            timeout (float): Seconds to wait for a free session when the pool is exhausted.
+
+        Returns:
+            WebScraper: A browser session owned by the caller until `release` is called.
+        """
+        while True:
+            try:
+                scraper = self._idle.get_nowait()
+            except queue.Empty:
+                scraper = self.__start() or self._idle.get(timeout=timeout)
+            if scraper.is_alive():
+                return scraper
+            print('[PYTHON][WEBSCRAPER][POOL][WARNING] Dropping unresponsive browser')
+            self.__discard(scraper)
+
+    def release(self, scraper):
+        """Return a session to the pool, recycling it if it is worn out or broken."""
+        if scraper.pages_loaded >= self.recycle_after or not scraper.is_alive():
+            print('[PYTHON][WEBSCRAPER][POOL] Recycling browser after {} pages'.format(scraper.pages_loaded))
+            self.__discard(scraper)
+        else:
+            self._idle.put(scraper)
+
+    def acquire_many(self, count, timeout=None):
+        """
+        Check out up to `count` sessions in one step.
+
+        Only the first session is waited for, the others are taken if they are free or can
+        be started right away. A caller never holds sessions while waiting for more, so
+        concurrent callers cannot deadlock each other on a partly taken pool.
+
+        Args:
+            count (int): Number of sessions wanted.
+            timeout (float): Seconds to wait for the first session when the pool is exhausted.
+
+        Returns:
+            list[WebScraper]: Between 1 and `count` sessions owned by the caller.
+        """
+        scrapers = [self.acquire(timeout=timeout)]
+        try:
+            while len(scrapers) < count:
+                scrapers.append(self.acquire(timeout=0))
+        except queue.Empty:
+            pass
+        except BaseException:
+            for scraper in scrapers:
+                self.release(scraper)
+            raise
+        return scrapers
+
+    @contextmanager
+    def session(self, timeout=None):
+        """Context manager checking out a session and returning it afterwards."""
+        scraper = self.acquire(timeout=timeout)
+        try:
+            yield scraper
+        finally:
+            self.release(scraper)
+
+    @contextmanager
+    def sessions(self, count, timeout=None):
+        """Context manager checking out up to `count` sessions with `acquire_many` and returning them afterwards."""
+        scrapers = self.acquire_many(count, timeout=timeout)
+        try:
+            yield scrapers
+        finally:
+            for scraper in scrapers:
+                self.release(scraper)
+
+    def shutdown(self):
+        """Quit all idle browser sessions."""
+        while True:
+            try:
+                scraper = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.__discard(scraper)
+
+    def __start(self):
+        with self._lock:
+            if self._created >= self.size:
+                return None
+            self._created += 1
+        try:
+            print('[PYTHON][WEBSCRAPER][POOL] Starting browser {}/{}'.format(self._created, self.size))
+            return WebScraper()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def __discard(self, scraper):
+        try:
+            scraper.quit()
+        except Exception as e:
+            print('[PYTHON][WEBSCRAPER][POOL][WARNING] Failed to quit browser:', e)
+        with self._lock:
+            self._created -= 1
+
+
+class ChallengeException(Exception): pass
+
+
+class HTTPFetcher:
+    """
+    Fetches pages over a keep-alive HTTP session instead of a browser.
+
+    Mirrors the navigation methods of WebScraper (`url`, `current_url`, `content`,
+    `fetch`) so it can be used wherever only page sources are needed.
+
+    Args:
+        user_agent (str): User agent sent with every request.
+        cookies (list[dict]): Browser cookies in Selenium format to start the session with.
+        timeout (float): Request timeout in seconds.
+
+    Attributes:
+        session (requests.Session): The underlying keep-alive session.
+        last_url (str): Final URL of the last request after redirects.
+        last_content (str): Body of the last response.
+    """
+    def __init__(self, user_agent=None, cookies=None, timeout=30):
+        self.timeout = timeout
+        self.proxy = webscraper_proxy
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Encoding': 'gzip, deflate',
+            'Accept-Language': 'de-DE,de;q=0.9',
+            'Connection': 'keep-alive',
+        })
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+        if self.proxy:
+            proxy = self.proxy if '://' in self.proxy else 'http://' + self.proxy
+            self.session.proxies.update({'http': proxy, 'https': proxy})
+        self.load_cookies(cookies or [])
+        self.last_url = None
+        self.last_content = None
+
+    @classmethod
+    def from_browser(cls, scraper, timeout=30):
+        """Create a fetcher sharing the user agent and cookies of a WebScraper session."""
+        return cls(user_agent=scraper.user_agent(), cookies=scraper.cookies(), timeout=timeout)
+
+    def load_cookies(self, cookies):
+        """Add cookies in Selenium format to the session."""
+        for cookie in cookies:
+            self.session.cookies.set(cookie['name'], cookie['value'],
+                                     domain=cookie.get('domain'), path=cookie.get('path', '/'))
+
+    def fetch(self, url):
+        """
+        Request a URL and return the response body.
+
+        Raises:
+            ChallengeException: If a bot-challenge page or a consent wall is served instead of the content.
+            requests.HTTPError: For any other unsuccessful response.
+        """
+        with metrics.timed('page_load', backend='http'):
+            response = self.session.get(url, timeout=max(min(self.timeout, remaining(self.timeout)), 0.01))
+        metrics.inc('scraper_pages_total', backend='http')
+        if classify_response(response.text, response.status_code) == BLOCKED:
+            raise ChallengeException(f'Bot challenge on {url} (HTTP {response.status_code})')
+        response.raise_for_status()
+        self.last_url = response.url
+        self.last_content = response.text
+        return self.last_content
+
+    def url(self, url):
+        self.fetch(url)
+
+    def current_url(self):
+        return self.last_url
+
+    def content(self):
+        return self.last_content
+
+    def close(self):
+        """Close all pooled connections of the session."""
+        self.session.close()
+
+
+class FallbackFetcher:
+    """
+    Fetches pages over HTTP and falls back to the browser on bot-challenge pages and consent walls.
+
+    After a browser fallback the HTTP session picks up the browser cookies again,
+    so later requests can continue over HTTP. `challenged` tells whether the last
+    page needed the fallback.
+
+    Args:
+        scraper (WebScraper): Browser session used for the fallback and as cookie source.
+        timeout (float): Request timeout in seconds for the HTTP backend.
+    """
+    def __init__(self, scraper, timeout=30):
+        self.scraper = scraper
+        self.timeout = timeout
+        self.http = None
+        self.challenged = False
+        self.last_url = None
+        self.last_content = None
+
+    def fetch(self, url):
+        # Cookies are taken from the browser on first use, after any consent dialogs were handled
+        if self.http is None:
+            self.http = HTTPFetcher.from_browser(self.scraper, timeout=self.timeout)
+        self.challenged = False
+        try:
+            self.last_content = self.http.fetch(url)
+            self.last_url = self.http.current_url()
+        except ChallengeException as e:
+            print('[PYTHON][WEBSCRAPER][FETCH][WARNING] {}, falling back to browser'.format(e))
+            metrics.inc('scraper_challenges_total')
+            self.challenged = True
+            self.last_content = self.scraper.fetch(url)
+            self.last_url = self.scraper.current_url()
+            self.http.load_cookies(self.scraper.cookies())
+        return self.last_content
+
+    def url(self, url):
+        self.fetch(url)
+
+    def current_url(self):
+        return self.last_url or self.scraper.current_url()
+
+    def content(self):
+        return self.last_content
+
+    def close(self):
+        if self.http is not None:
+            self.http.close()
+
+
+class AdaptiveFetcher:
+    """
+    Paces the page loads of a fetcher with the adaptive rate limiter of their host and egress.
+
+    Every response is classified with `classify_response` and recorded, so the rate
+    backs off on blocks, empty pages and errors and ramps up again on healthy pages.
+    Blocked pages raise a ChallengeException instead of being handed to the parser.
+    A bot challenge the browser fallback got past still slows the rate down.
+
+    Args:
+        fetcher: The fetcher loading the pages.
+        egress (str): Proxy the requests leave through, None for direct requests.
+    """
+    def __init__(self, fetcher, egress=webscraper_proxy):
+        self.fetcher = fetcher
+        self.egress = egress
+        self.last_content = None
+
+    def fetch(self, url):
+        limiter = egress_limiter(url, self.egress)
+        with stage('rate_limit'):
+            limiter.acquire()
+        # A wait that used up the deadline is no response to learn from
+        if current_deadline() is not None:
+            current_deadline().check('rate_limit')
+        try:
+            self.last_content = self.fetcher.fetch(url)
+        except Exception as e:
+            self.__record(limiter, url, self.__classify_exception(e))
+            raise
+        outcome = classify_response(self.last_content)
+        if outcome == OK and getattr(self.fetcher, 'challenged', False):
+            outcome = ERROR
+        self.__record(limiter, url, outcome)
+        if outcome == BLOCKED:
+            raise ChallengeException(f'Blocked on {url}')
+        return self.last_content
+
+    def url(self, url):
+        self.fetch(url)
+
+    def current_url(self):
+        return self.fetcher.current_url()
+
+    def content(self):
+        return self.last_content
+
+    def close(self):
+        if hasattr(self.fetcher, 'close'):
+            self.fetcher.close()
+
+    @staticmethod
+    def __classify_exception(exception):
+        if isinstance(exception, ChallengeException):
+            return BLOCKED
+        status = getattr(getattr(exception, 'response', None), 'status_code', None)
+        if status is not None:
+            # Missing offers are a healthy answer of the host
+            return OK if status in (404, 410) else classify_response(None, status)
+        return ERROR
+
+    @staticmethod
+    def __record(limiter, url, outcome):
+        metrics.inc('scraper_responses_total', outcome=outcome)
+        if hasattr(limiter, 'record'):
+            rate = limiter.record(outcome)
+            metrics.set_gauge('scraper_request_rate', rate, host=urlparse(url).netloc)
+            if outcome == BLOCKED:
+                print('[PYTHON][WEBSCRAPER][RATE][WARNING] Blocked on {}, {:.2f} requests/s, pausing for {:.0f}s'.format(
+                    url, rate, limiter.paused_until - time.monotonic()))
+
+
+def wait_for_egress(url, egress=webscraper_proxy):
+    """Block while requests to the host of `url` through `egress` are paused after a block."""
+    limiter = egress_limiter(url, egress)
+    if hasattr(limiter, 'wait_paused'):
+        limiter.wait_paused()
+
+
+def get_fetcher(scraper, backend=webscraper_backend):
+    """
+    Return the page fetcher for the configured backend.
+
+    Args:
+        scraper (WebScraper): Browser session, used directly for the 'selenium' backend
+            and as fallback and cookie source for the 'http' backend.
+        backend (str): 'selenium' or 'http'.
+
+    The fetcher is paced by an AdaptiveFetcher. With a page cache configured it is
+    wrapped in a CachedFetcher on top, so cached pages are served without waiting.
+    """
+    fetcher = AdaptiveFetcher(FallbackFetcher(scraper) if backend == 'http' else scraper)
+    cache = page_cache()
+    if cache is not None:
+        fetcher = CachedFetcher(fetcher, cache)
+    return fetcher
+
+
+_browser_pool = None
+
+def browser_pool():
+    """
+    Return the browser pool of the current process.
+
+    A forked child never reuses the browsers of its parent; it gets a fresh pool.
+    """
+    global _browser_pool
+    if _browser_pool is None or _browser_pool.pid != os.getpid():
+        _browser_pool = BrowserPool()
+        atexit.register(_browser_pool.shutdown)
+    return _browser_pool
 
 
 # url = 'https://www.kleinanzeigen.de/s-wohnung-kaufen/c196'
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import itertools
+import resource
+import threading
+import collections
+import multiprocessing
+import multiprocessing.connection
+import config
+import metrics
+
+# Worker pool settings, optional in config.py. The pool size should fit the cores and
+# the RAM of the host, every worker keeps its own browser and database connections.
+runner_pool_size = getattr(config, 'runner_pool_size', 4)
+# Seconds a task may run before its worker is replaced
+runner_task_timeout = getattr(config, 'runner_task_timeout', 3600)
+# Seconds between heartbeats of a worker and without one before it is replaced
+runner_heartbeat_interval = getattr(config, 'runner_heartbeat_interval', 10)
+runner_heartbeat_timeout = getattr(config, 'runner_heartbeat_timeout', 120)
+# Seconds before a worker that failed to start is started again, doubled per failed start up to the maximum
+runner_restart_backoff = getattr(config, 'runner_restart_backoff', 1)
+runner_restart_max_backoff = getattr(config, 'runner_restart_max_backoff', 300)
+
+
+def _heartbeat(slot, send, interval, stop):
+    while not stop.wait(interval):
+        send(('heartbeat', slot, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, metrics.registry.snapshot()))
+
+def _worker_main(slot, target, initializer, conn, heartbeat_interval):
+    """Main loop of a worker process: run the tasks sent over its pipe until the stop sentinel."""
+    lock = threading.Lock()
+    def send(event):
+        with lock:
+            conn.send(event)
+
+    if initializer is not None:
+        initializer()
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(slot, send, heartbeat_interval, stop), daemon=True).start()
+    send(('ready', slot, os.getpid()))
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+        seq, task = item
+        send(('start', slot, seq))
+        start = time.monotonic()
+        try:
+            result, ok = target(task), True
+        except Exception as e:
+            result, ok = f'{type(e).__name__}: {e}', False
+        send(('done', slot, seq, ok, result, time.monotonic() - start))
+    stop.set()
+
+
+class WorkerPool:
+    """
+    Fixed number of long-lived worker processes running the tasks handed to them.
+
+    Workers keep their process state between tasks, so browsers and database
+    connections opened by `initializer` or by earlier tasks stay warm. Every worker
+    talks to the pool over a pipe of its own and gets one task at a time, the
+    queue of waiting tasks stays in the pool's process. Killing a worker therefore
+    never breaks a channel shared with the others. The pool is supervised from `poll`:
+    a worker that died, stopped sending heartbeats or runs a task longer than
+    `task_timeout` is killed and replaced. A task it had reported as started is
+    failed, a task it had not started yet is queued again. A worker that dies before
+    it is ready, e.g. because `initializer` raised, is started again only after a
+    delay that doubles with every failed start in a row.
+
+    Args:
+        target (callable): Function run in a worker for every task, its return value
+            is reported back. Has to be a module level function.
+        size (int): Number of worker processes.
+        initializer (callable): Function run once when a worker starts.
+        task_timeout (float): Seconds a task may run.
+
+    Attributes:
+        stats (dict): Worker slot -> metrics of the worker in that slot, see `metrics`.
+    """
+    def __init__(self, target, size=runner_pool_size, initializer=None, task_timeout=runner_task_timeout,
+                 heartbeat_interval=runner_heartbeat_interval, heartbeat_timeout=runner_heartbeat_timeout,
+                 restart_backoff=runner_restart_backoff, restart_max_backoff=runner_restart_max_backoff):
+        self.target = target
+        self.size = size
+        self.initializer = initializer
+        self.task_timeout = task_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_backoff = restart_backoff
+        self.restart_max_backoff = restart_max_backoff
+        self.pending = collections.deque()
+        self.processes = {}
+        self.conns = {}
+        # Slot -> seq of the task handed to the worker in that slot, None while idle
+        self.assigned = {}
+        self.stats = {}
+        # Slot -> time at which the worker of a slot that failed to start is started again
+        self.restart_at = {}
+        self.tasks_by_seq = {}
+        self.running = set()
+        self._seq = itertools.count()
+        for slot in range(size):
+            self.stats[slot] = {'pid': None, 'tasks': 0, 'failures': 0, 'busy_seconds': 0.0,
+                                'restarts': 0, 'max_rss_mb': None, 'task': None, 'failed_starts': 0}
+            self.__start(slot)
+
+    def __start(self, slot):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_worker_main, name=f'worker-{slot}',
+            args=(slot, self.target, self.initializer, child_conn, self.heartbeat_interval)
+        )
+        process.start()
+        child_conn.close()
+        self.processes[slot] = process
+        self.conns[slot] = conn
+        self.assigned[slot] = None
+        self.stats[slot].update(pid=process.pid, task=None, heartbeat=time.monotonic(), ready=False)
+
+    def __replace(self, slot, reason):
+        """Kill the worker of a slot, fail its started task, queue its unstarted one again and start a new worker."""
+        process = self.processes[slot]
+        print(f'[WORKER_POOL][WARNING] Replacing worker {slot} (pid {process.pid}): {reason}')
+        if process.is_alive():
+            process.kill()
+        process.join(5)
+        self.conns.pop(slot).close()
+        failed = []
+        seq = self.assigned[slot]
+        if seq in self.running:
+            self.running.discard(seq)
+            self.stats[slot]['failures'] += 1
+            failed.append((self.tasks_by_seq.pop(seq)[0], False, reason, slot))
+        elif seq in self.tasks_by_seq:
+            self.pending.appendleft(seq)
+        stats = self.stats[slot]
+        stats['restarts'] += 1
+        if stats['ready']:
+            self.__start(slot)
+        else:
+            stats['failed_starts'] += 1
+            delay = min(self.restart_backoff * 2 ** (stats['failed_starts'] - 1), self.restart_max_backoff)
+            print(f'[WORKER_POOL][WARNING] Worker {slot} failed to start {stats["failed_starts"]} times in a row, '
+                  f'starting it again in {delay}s')
+            self.processes[slot] = None
+            stats.update(pid=None, task=None)
+            self.restart_at[slot] = time.monotonic() + delay
+        return failed
+
+    def submit(self, task_id, task):
+        """Queue a task, `task_id` identifies it in the results of `poll`."""
+        seq = next(self._seq)
+        self.tasks_by_seq[seq] = (task_id, task)
+        self.pending.append(seq)
+        self.__dispatch()
+
+    def __dispatch(self):
+        for slot in self.processes:
+            if not self.pending:
+                return
+            if self.processes[slot] is not None and self.assigned[slot] is None:
+                seq = self.pending.popleft()
+                try:
+                    self.conns[slot].send((seq, self.tasks_by_seq[seq][1]))
+                except OSError:
+                    # The worker is gone, supervision replaces it
+                    self.pending.appendleft(seq)
+                    continue
+                self.assigned[slot] = seq
+
+    def in_flight(self):
+        """Return the ids of all tasks queued or running."""
+        return {task_id for task_id, _ in self.tasks_by_seq.values()}
+
+    def poll(self, timeout=None):
+        """
+        Wait for results and supervise the workers.
+
+        Args:
+            timeout (float): Seconds to wait for the first result.
+
+        Returns:
+            list: (task_id, success, result or error message, worker slot) of every finished task.
+        """
+        results = []
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            results.extend(self.__receive(max(0.0, min(deadline - time.monotonic(), 1.0))))
+            results.extend(self.__supervise())
+            self.__dispatch()
+            if results or time.monotonic() >= deadline:
+                break
+        # Collect whatever else arrived without waiting again
+        results.extend(self.__receive(0))
+        self.__dispatch()
+        return results
+
+    def __receive(self, timeout):
+        results = []
+        slots = {conn: slot for slot, conn in self.conns.items()}
+        for conn in multiprocessing.connection.wait(list(slots), timeout):
+            try:
+                while conn.poll():
+                    results.extend(self.__handle(conn.recv()))
+            except (EOFError, OSError):
+                # A dead worker is replaced by the supervision
+                pass
+        return results
+
+    def __handle(self, event):
+        kind, slot = event[0], event[1]
+        stats = self.stats[slot]
+        stats['heartbeat'] = time.monotonic()
+        if kind == 'ready':
+            stats.update(ready=True, failed_starts=0)
+        elif kind == 'heartbeat':
+            stats['max_rss_mb'] = round(event[2] / 1024, 1)
+            # Metrics of the worker process are exposed by the registry of the pool's process
+            metrics.registry.add_snapshot(('worker', slot), event[3], worker=slot)
+        elif kind == 'start':
+            seq = event[2]
+            if seq in self.tasks_by_seq:
+                self.running.add(seq)
+                stats['task'] = (seq, time.monotonic())
+        elif kind == 'done':
+            seq, ok, result, seconds = event[2:]
+            self.running.discard(seq)
+            self.assigned[slot] = None
+            stats['task'] = None
+            if seq not in self.tasks_by_seq:
+                return []
+            task_id, _ = self.tasks_by_seq.pop(seq)
+            stats['tasks'] += 1
+            stats['failures'] += not ok
+            stats['busy_seconds'] += seconds
+            return [(task_id, ok, result, slot)]
+        return []
+
+    def __supervise(self):
+        failed = []
+        now = time.monotonic()
+        for slot, process in list(self.processes.items()):
+            stats = self.stats[slot]
+            if process is None:
+                if now >= self.restart_at[slot]:
+                    self.__start(slot)
+            elif not process.is_alive():
+                failed += self.__replace(slot, f'exited with code {process.exitcode}')
+            elif stats['task'] is not None and now - stats['task'][1] > self.task_timeout:
+                failed += self.__replace(slot, f'task {self.tasks_by_seq[stats["task"][0]][0]} exceeded {self.task_timeout}s')
+            elif now - stats['heartbeat'] > self.heartbeat_timeout:
+                failed += self.__replace(slot, f'no heartbeat for {self.heartbeat_timeout}s')
+        return failed
+
+    def queue_depth(self):
+        """Return the number of tasks queued but not started."""
+        return len(self.tasks_by_seq) - len(self.running)
+
+    def metrics(self):
+        """Return the metrics of every worker slot."""
+        now = time.monotonic()
+        return {
+            slot: {
+                'pid': stats['pid'],
+                'tasks': stats['tasks'],
+                'failures': stats['failures'],
+                'busy_seconds': round(stats['busy_seconds'], 1),
+                'restarts': stats['restarts'],
+                'max_rss_mb': stats['max_rss_mb'],
+                'task': self.tasks_by_seq[stats['task'][0]][0] if stats['task'] else None,
+                'task_seconds': round(now - stats['task'][1], 1) if stats['task'] else None,
+            }
+            for slot, stats in self.stats.items()
+        }
+
+    def shutdown(self, timeout=10):
+        """Stop all workers after their current task, killing those that do not stop within `timeout`."""
+        for conn in self.conns.values():
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for slot, process in self.processes.items():
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            self.conns[slot].close()